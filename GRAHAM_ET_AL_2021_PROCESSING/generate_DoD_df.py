@@ -1,12 +1,10 @@
 ## NOT USED - data frame creation is done from rasters in R 'create_spatial_dataframe.R'
 # Compare the relative change of the different woodland zones.
 
-import geopandas as gpd
-import rasterio
-from rasterio.mask import mask
 import os
-import json
 import pandas as pd
+from sfm_gridz import zonal_stats
+from sfm_gridz import zone_tiles
 
 # suppress warnings for now...
 import warnings
@@ -81,25 +79,9 @@ def main():
 def compare_zones(zones, diff_ras, feed_signs, name, method, band, **kwargs):
     model_type = kwargs.get('model_type', 'canopy_change')
 
-    z_gdf = gpd.read_file(zones)
-    z_gdf['id'] = z_gdf.index
-    z_gdf['area'] = z_gdf.area
+    # the foraging / no foraging zones are built once for the zone and sign files and reused for every raster
+    zones_comb = zone_tiles.sign_zones(zones, feed_signs, buffer_dist=10)
 
-    fs_gdf = gpd.read_file(feed_signs)
-    fs_gdf_buff = fs_gdf.copy()
-    fs_gdf_buff.geometry = fs_gdf.geometry.buffer(10)
-
-    beav_zone = get_union(z_gdf, fs_gdf_buff)
-    beav_zone['signs_YN'] = 1
-    beav_zone = beav_zone.dissolve(by='signs_YN')
-    beav_zone = beav_zone.reset_index()
-
-    no_beav_zone = gpd.overlay(z_gdf, beav_zone, how='symmetric_difference')
-    no_beav_zone['signs_YN'] = 0
-    no_beav_zone = no_beav_zone.dissolve(by='signs_YN')
-    no_beav_zone = no_beav_zone.reset_index()
-
-    # zones_comb = pd.concat([beav_zone, no_beav_zone])
     # ax = zones_comb.plot(column='signs_YN', colormap='Dark2', edgecolor='None')
     # fs_gdf.plot(color='red', ax=ax, markersize=8, alpha=0.3)
     # plt.title(name + ' beaver and non beaver zones')
@@ -107,16 +89,10 @@ def compare_zones(zones, diff_ras, feed_signs, name, method, band, **kwargs):
     # zones_comb.to_file(BeaverZones_out, driver='GPKG')
 
 
-    beav_zone_df = mask_ras_get_df(beav_zone, diff_ras, band=band, model=model_type)
-    beav_zone_df['signs_YN'] = 1
-    beav_zone_df['signs_YNf'] = 'Foraging Observed'
-
-    no_beav_zone_df = mask_ras_get_df(no_beav_zone, diff_ras, band=band, model=model_type)
-    no_beav_zone_df['signs_YN'] = 0
-    no_beav_zone_df['signs_YNf'] = 'No Foraging'
-
-    cwc_df = pd.concat([beav_zone_df, no_beav_zone_df])
-
+    # both zones are rasterised once to a label grid (cached per raster grid) and the raster is read in one pass
+    cwc_df = zonal_stats.extract_values(zones_comb, diff_ras, band=band + 1, zone_column='signs_YN')
+    cwc_df = cwc_df.rename(columns={'zone': 'signs_YN', 'value': model_type})[[model_type, 'signs_YN']]
+    cwc_df['signs_YNf'] = ['Foraging Observed' if x == 1 else 'No Foraging' for x in cwc_df['signs_YN']]
 
     cwc_df['signs_YNf'] = cwc_df['signs_YNf'].astype('category')
     cwc_df['signs_YNf'] = cwc_df['signs_YNf'].cat.reorder_categories(['No Foraging', 'Foraging Observed'])
@@ -125,42 +101,10 @@ def compare_zones(zones, diff_ras, feed_signs, name, method, band, **kwargs):
     cwc_df['LoD_method'] = method
     return cwc_df
 
-def getFeatures(gdf):
-    """Function to parse features from GeoDataFrame in such a manner that rasterio wants them"""
-    return [json.loads(gdf.to_json())['features'][0]['geometry']]
-
-
-def get_union(to_select, union_shp):
-    """Alternative union function"""
-    union = gpd.GeoDataFrame(
-        gpd.GeoSeries([union_shp.unary_union]),
-        columns=['geometry'],
-        crs=union_shp.crs)
-
-    clip_gdf = gpd.sjoin(to_select, union, op='intersects')
-    clip_gdf = clip_gdf.drop(columns=['index_right'])
-
-    return clip_gdf
-
-
 def mask_ras_get_df(gdf, ras, band, model):
-
-        geom = getFeatures(gdf)  # returns geometries for AOIs
-
-        with rasterio.open(ras) as src:
-            out_image, out_transform = rasterio.mask.mask(src, geom, crop=True)
-            res = src.res[0] * src.res[1]
-
-        out_image_1d = out_image[band].flatten()
-        out_image_1d = out_image_1d[out_image_1d != -999]
-
-        # print('mean: {0}'.format(np.nanmean(out_image_1d)))
-        # print('min: {0}'.format(np.nanmin(out_image_1d)))
-        # print('max: {0}'.format(np.nanmax(out_image_1d)))
-        # print('stdev: {0}'.format(np.nanstd(out_image_1d)))
-
-        out_df = pd.DataFrame(out_image_1d, columns=[model])
-        return out_df
+    """Values of band (0-based) of the raster within the zones of gdf as a one column data frame"""
+    out_df = zonal_stats.extract_values(gdf, ras, band=band + 1)
+    return out_df[['value']].rename(columns={'value': model})
 
 if __name__ == '__main__':
     main()
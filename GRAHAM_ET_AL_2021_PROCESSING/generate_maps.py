@@ -4,7 +4,6 @@ import sfm_gridz
 import sfm_gridz.plot_gridz as pcplot
 import rasterio
 from rasterio.plot import show_hist
-from matplotlib import pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 import geopandas as gpd
 
@@ -38,58 +37,41 @@ beaver_zones = os.path.abspath('C:/HG_Projects/CWC_Drone_work/CHM/Beaver_Zones20
 
 gdf = gpd.read_file(beaver_zones)
 gdf['Beaver_Zone'] = ['Foraging Observed' if x == 1 else 'No Foraging' for x in gdf['signs_YN']]
-def run_functions():
+maps_home = 'C:/HG_Projects/CWC_Drone_work/maps'
+
 
+def figure_specs():
+    """Specs of every map figure for plot_gridz.render_figures"""
+    specs = []
 
     # Combined DEM of Diff plots - Winter & summer
-    pcplot.set_style()
+    beaver_z_cmap = LinearSegmentedColormap.from_list('mycmap', [(0, '#000000'), (1, '#000000')])
+    zones = dict(gpd_gdf=gdf, gdf_column='Beaver_Zone', gdf_cmap=beaver_z_cmap, linestyle=['-', ':'])
 
     def dod_multiplot(dod1, dod2, save_path):
-        beaver_z_cmap = LinearSegmentedColormap.from_list(
-                'mycmap', [(0, '#000000'), (1, '#000000')])
-        fig, axs = plt.subplots(1, 3, sharey=True, figsize=(9.5, 7))
-
-        plt.tight_layout(rect=[0.02, 0.02, 0.98, 0.98])
-        pcplot.plot_dem_of_diff(dod1, v_range=(-4, 4), title="No LoD",
-                                mpl_fig=fig, mpl_ax=axs[0], legend=False, gpd_gdf=gdf, gdf_column='Beaver_Zone',
-                                gdf_cmap=beaver_z_cmap, gdf_legend_kwds=({'loc': 'upper left'}), cmap='seismic_r',
-                                method='basic', linestyle=['-', ':'])
-
-        pcplot.plot_dem_of_diff(dod2, v_range=(-4, 4), title="Weighted LoD95",
-                                mpl_fig=fig, mpl_ax=axs[1], legend=False, gpd_gdf=gdf, gdf_column='Beaver_Zone',
-                                gdf_cmap=beaver_z_cmap, gdf_legend=False, cmap='seismic_r', linestyle=['-', ':'])
-
-        pcplot.plot_dem_of_diff(dod1, v_range=(-4, 4), title="LoDmin threshold",
-                                mpl_fig=fig, mpl_ax=axs[2], gpd_gdf=gdf, gdf_column='Beaver_Zone',
-                                gdf_cmap=beaver_z_cmap, gdf_legend=False, cmap='seismic_r', linestyle=['-', ':'])
-
-        plt.show()
-
-        fig.savefig(fname=save_path, dpi=300, format='png')
+        return {"save_path": save_path, "figsize": (9.5, 7), "ncols": 3, "sharey": True,
+                "tight_layout": [0.02, 0.02, 0.98, 0.98],
+                "panels": [dict(plot='plot_dem_of_diff', raster=dod1, ax=0, v_range=(-4, 4), title="No LoD",
+                                legend=False, gdf_legend_kwds=({'loc': 'upper left'}), cmap='seismic_r',
+                                method='basic', **zones),
+                           dict(plot='plot_dem_of_diff', raster=dod2, ax=1, v_range=(-4, 4), title="Weighted LoD95",
+                                legend=False, gdf_legend=False, cmap='seismic_r', **zones),
+                           dict(plot='plot_dem_of_diff', raster=dod1, ax=2, v_range=(-4, 4),
+                                title="LoDmin threshold", gdf_legend=False, cmap='seismic_r', **zones)]}
 
     # winter DoD maps
-    dod_multiplot(dod_winter_thresh, dod_winter_weight, 'C:/HG_Projects/CWC_Drone_work/maps/DEMofDiff_winter.png')
-
+    specs.append(dod_multiplot(dod_winter_thresh, dod_winter_weight, os.path.join(maps_home, 'DEMofDiff_winter.png')))
     # summer DoD maps
-    dod_multiplot(dod_summer_thresh, dod_summer_weight, 'C:/HG_Projects/CWC_Drone_work/maps/DEMofDiff_summer.png')
+    specs.append(dod_multiplot(dod_summer_thresh, dod_summer_weight, os.path.join(maps_home, 'DEMofDiff_summer.png')))
 
     # LOD plots
-
     def gen_lod_map(lod_ras, save_path):
-        fig, ax = plt.subplots(1, 1, sharey=True, sharex=True, figsize=(3.5, 7))
-        plt.tight_layout(rect=[0.05, 0, 0.97, 1])
-
-        pcplot.plot_lod(lod_ras, title=None, v_range=(0, 10),
-                                mpl_fig=fig, mpl_ax=ax, cmap='Oranges')
-
-        plt.show()
-
-        fig.savefig(fname=save_path, dpi=300, format='png')
+        return {"save_path": save_path, "figsize": (3.5, 7), "tight_layout": [0.05, 0, 0.97, 1],
+                "panels": [dict(plot='plot_lod', raster=lod_ras, title=None, v_range=(0, 10), cmap='Oranges')]}
 
     # winter LoD
-    gen_lod_map(dod_winter_thresh, 'C:/HG_Projects/CWC_Drone_work/maps/WinterLoD.png')
-    gen_lod_map(dod_summer_thresh, 'C:/HG_Projects/CWC_Drone_work/maps/SummerLoD.png')
-
+    specs.append(gen_lod_map(dod_winter_thresh, os.path.join(maps_home, 'WinterLoD.png')))
+    specs.append(gen_lod_map(dod_summer_thresh, os.path.join(maps_home, 'SummerLoD.png')))
 
     # define lists for multiplots.
 
@@ -107,81 +89,56 @@ def run_functions():
         if map_type == 'dsm':
             cp = 'bone'
             scale_range = (75, 100)
-            method = pcplot.plot_dsm
+            method = 'plot_dsm'
         else:
             cp = 'cubehelix_r'
             scale_range = (0, 20)
-            method = pcplot.plot_chm
-
-        fig, axs = plt.subplots(1, 2, sharey=True, sharex=True,  figsize=(7, 7))
-        plt.tight_layout(rect=[0.02, 0.02, 0.96, 0.98])
-
-        for idx, path, name in zip(range(0,2), dem_list, ts_names):
-            if idx == 1:
-                method(path, title=name, v_range=scale_range, mpl_fig=fig, mpl_ax=axs[1],
-                                cmap=cp)
-            else:
-                method(path, title=name, legend=None, v_range=scale_range,
-                                mpl_fig=fig, mpl_ax=axs[0], cmap=cp)
-
-        plt.show()
-        fig.savefig(fname=save_path, dpi=300, format='png')
-
-        # winter dsm/chm
-
-    dem_panel(dsm_list_wint, ts_names_wint, 'C:/HG_Projects/CWC_Drone_work/maps/DSM_winter.png', map_type='dsm')
-    # summer dsm/chm
-    dem_panel(dsm_list_summ, ts_names_summ, 'C:/HG_Projects/CWC_Drone_work/maps/DSM_summer.png', map_type='dsm')
-
-    dem_panel(chm_list_wint, ts_names_wint, 'C:/HG_Projects/CWC_Drone_work/maps/CHM_winter.png', map_type='chm')
-    # summer dsm/chm
-    dem_panel(chm_list_summ, ts_names_summ, 'C:/HG_Projects/CWC_Drone_work/maps/CHM_summer.png', map_type='chm')
-
-
-
+            method = 'plot_chm'
+
+        return {"save_path": save_path, "figsize": (7, 7), "ncols": 2, "sharex": True, "sharey": True,
+                "tight_layout": [0.02, 0.02, 0.96, 0.98],
+                "panels": [dict(plot=method, raster=dem_list[0], ax=0, title=ts_names[0], legend=None,
+                                v_range=scale_range, cmap=cp),
+                           dict(plot=method, raster=dem_list[1], ax=1, title=ts_names[1], v_range=scale_range,
+                                cmap=cp)]}
+
+    # winter / summer dsm
+    specs.append(dem_panel(dsm_list_wint, ts_names_wint, os.path.join(maps_home, 'DSM_winter.png'), map_type='dsm'))
+    specs.append(dem_panel(dsm_list_summ, ts_names_summ, os.path.join(maps_home, 'DSM_summer.png'), map_type='dsm'))
+    # winter / summer chm
+    specs.append(dem_panel(chm_list_wint, ts_names_wint, os.path.join(maps_home, 'CHM_winter.png'), map_type='chm'))
+    specs.append(dem_panel(chm_list_summ, ts_names_summ, os.path.join(maps_home, 'CHM_summer.png'), map_type='chm'))
 
     def prec_rough_panel(pcp_list, dsm_list, ts_names, save_path):
-
-        fig, axs = plt.subplots(2, 2, sharey=True, sharex=True, figsize=(5, 12))
-        plt.tight_layout(rect=[0.09, 0.02, 1, 0.98])
-
-        for idx, path, name in zip(range(0, 4), pcp_list, ts_names):
-
-            if idx == 1:
-                pcplot.plot_precision(prec_map_path=path, title=name, v_range=(0, 0.1),
-                                 mpl_fig=fig, mpl_ax=axs[1, 0], cmap='viridis',
-                                      leg_orient='horizontal',leg_pos='bottom', title_pos='left')
-            else:
-                pcplot.plot_precision(prec_map_path=path, title=name, legend=None, v_range=(0, 0.1),
-                                mpl_fig=fig, mpl_ax=axs[0, 0], cmap='viridis', title_pos='left')
-
-        for idx, path in enumerate(dsm_list):
-            if idx == 1:
-                pcplot.plot_roughness(dsm_path=path, title=None, v_range=(0, 10),
-                                 mpl_fig=fig, mpl_ax=axs[1, 1], cmap='RdPu',
-                                      leg_orient='horizontal', leg_pos='bottom')
-            else:
-                pcplot.plot_roughness(dsm_path=path, title=None, legend=None, v_range=(0, 10),
-                                mpl_fig=fig, mpl_ax=axs[0, 1], cmap='RdPu')
-        plt.setp(plt.gcf().get_axes(), xticks=[], yticks=[])
-
-        plt.show()
-
-        fig.savefig(fname=save_path, dpi=300, format='png')
+        # axes are counted across the rows: 0 - top left, 1 - top right, 2 - bottom left, 3 - bottom right
+        return {"save_path": save_path, "figsize": (5, 12), "nrows": 2, "ncols": 2, "sharex": True, "sharey": True,
+                "tight_layout": [0.09, 0.02, 1, 0.98], "hide_ticks": True,
+                "panels": [dict(plot='plot_precision', raster=pcp_list[0], ax=0, title=ts_names[0], legend=None,
+                                v_range=(0, 0.1), cmap='viridis', title_pos='left'),
+                           dict(plot='plot_precision', raster=pcp_list[1], ax=2, title=ts_names[1],
+                                v_range=(0, 0.1), cmap='viridis', leg_orient='horizontal', leg_pos='bottom',
+                                title_pos='left'),
+                           dict(plot='plot_roughness', raster=dsm_list[0], ax=1, title=None, legend=None,
+                                v_range=(0, 10), cmap='RdPu'),
+                           dict(plot='plot_roughness', raster=dsm_list[1], ax=3, title=None, v_range=(0, 10),
+                                cmap='RdPu', leg_orient='horizontal', leg_pos='bottom')]}
 
     # winter prec/rough panel
-    prec_rough_panel(pcp_list_wint, dsm_list_wint, ts_names_wint,
-                     'C:/HG_Projects/CWC_Drone_work/maps/PREC_ROUGH_winter.png')
+    specs.append(prec_rough_panel(pcp_list_wint, dsm_list_wint, ts_names_wint,
+                                  os.path.join(maps_home, 'PREC_ROUGH_winter.png')))
     # summer prec/rough panel
-    prec_rough_panel(pcp_list_summ, dsm_list_summ, ts_names_summ,
-                     'C:/HG_Projects/CWC_Drone_work/maps/PREC_ROUGH_summer.png')
+    specs.append(prec_rough_panel(pcp_list_summ, dsm_list_summ, ts_names_summ,
+                                  os.path.join(maps_home, 'PREC_ROUGH_summer.png')))
 
     # Plot Terrain Model
-    fig, ax = plt.subplots(1, 1, sharey=True, sharex=True, figsize=(3.5, 7))
-    plt.tight_layout(rect=[0.05, 0, 0.97, 1])
-    pcplot.plot_dtm(chm_path=chm1809, title=None, save_path='C:/HG_Projects/CWC_Drone_work/maps/DTM.png',
-                    mpl_fig=fig, mpl_ax=ax)
-    plt.show()
+    specs.append({"save_path": os.path.join(maps_home, 'DTM.png'), "figsize": (3.5, 7),
+                  "tight_layout": [0.05, 0, 0.97, 1], "panels": [dict(plot='plot_dtm', raster=chm1809, title=None)]})
+
+    return specs
+
+
+def run_functions():
+    pcplot.render_figures(figure_specs())
 
 
 if __name__ == '__main__':
@@ -1,7 +1,7 @@
 # This is hugh's CWC workflow and is a bit more specific to the use case...
 
-import sfm_gridz
 import sfm_gridz.plot_gridz as pcplot
+from sfm_gridz.pipeline import Pipeline
 import os
 import sys
 
@@ -67,69 +67,61 @@ DoD_Sep17_Sep18_Weight = os.path.join(out_ras_home, "DoD_Sep17_Sep18_weight.tif"
 # --- DEFINE CRS ---
 epsg_code = 27700
 
+# --- DEFINE PIPELINE ---
+# Stages run in parallel where they can and are skipped on re-runs if their inputs and parameters haven't changed.
+def build_pipeline():
+    pipe = Pipeline(os.path.join(out_ras_home, "pipeline_state.json"))
+
+    pipe.add('dsm1', 'dsm', point_cloud=dpc1_path, out_raster=dsm1_out, resolution=0.5, window_size=10,
+             epsg=epsg_code, mask=mask_shp)
+    for n, dpc, dsm_out in [(3, dpc3_path, dsm3_out), (4, dpc4_path, dsm4_out), (6, dpc6_path, dsm6_out)]:
+        pipe.add('dsm{0}'.format(n), 'dsm', point_cloud=dpc, out_raster=dsm_out, resolution=0.5, window_size=10,
+                 epsg=epsg_code, bounds='@dsm1.bounds', mask=mask_shp)
+
+    # the DSMs share a grid so the DTM is resampled once (and cached on disk) for all four CHMs
+    pipe.add('chms', 'chm_batch', dsm_files=['@dsm1.path', '@dsm3.path', '@dsm4.path', '@dsm6.path'],
+             dtm_file=dtm_path, chm_save_names=[chm1_out, chm3_out, chm4_out, chm6_out])
+
+    for n, pcp, pcp_out in [(1, pcp1_path, pcp1_out), (3, pcp3_path, pcp3_out), (4, pcp4_path, pcp4_out),
+                            (6, pcp6_path, pcp6_out)]:
+        pipe.add('pcc{0}'.format(n), 'precision', prec_point_cloud=pcp, out_raster=pcp_out, resolution=1,
+                 prec_dimension='z', epsg=epsg_code, bounds='@dsm1.bounds', mask=mask_shp)
+
+    # DoDs - each epoch is loaded and aligned once for all four
+    epochs = {'Dec16': ['@chms.paths.0', '@pcc1.path'], 'Sep17': ['@chms.paths.1', '@pcc3.path'],
+              'Jan18': ['@chms.paths.2', '@pcc4.path'], 'Sep18': ['@chms.paths.3', '@pcc6.path']}
+
+    dod_jobs = [['Dec16', 'Jan18', 'threshold', DoD_Dec16_Jan18_Thresh],  # winter
+                ['Dec16', 'Jan18', 'weighted', DoD_Dec16_Jan18_Weight],
+                ['Sep17', 'Sep18', 'threshold', DoD_Sep17_Sep18_Thresh],  # summer
+                ['Sep17', 'Sep18', 'weighted', DoD_Sep17_Sep18_Weight]]
+
+    pipe.add('dods', 'difference_batch', epochs=epochs, jobs=dod_jobs, epsg=epsg_code, mask=mask_shp)
+
+    return pipe
+
+
 # --- MAIN CODE BLOCK ---
 def main():
 
-    dsm1 = sfm_gridz.dsm(point_cloud=dpc1_path, out_raster=dsm1_out, resolution=0.5, window_size=10,
-                         epsg=epsg_code, mask=mask_shp)
-    dsm3 = sfm_gridz.dsm(point_cloud=dpc3_path, out_raster=dsm3_out, resolution=0.5, window_size=10,
-                         epsg=epsg_code, bounds=dsm1.bounds, mask=mask_shp)
-    dsm4 = sfm_gridz.dsm(point_cloud=dpc4_path, out_raster=dsm4_out, resolution=0.5, window_size=10,
-                         epsg=epsg_code, bounds=dsm1.bounds, mask=mask_shp)
-    dsm6 = sfm_gridz.dsm(point_cloud=dpc6_path, out_raster=dsm6_out, resolution=0.5, window_size=10,
-                         epsg=epsg_code, bounds=dsm1.bounds, mask=mask_shp)
-
-    for x in [dsm1, dsm3, dsm4, dsm6]:
-        pcplot.plot_dsm(dsm_path=x.path)
-        pcplot.plot_roughness(dsm_path=x.path)
-
-    chm1 = sfm_gridz.chm(dsm_file=dsm1.path, dtm_file=dtm_path, chm_save_name=chm1_out)
-    chm3 = sfm_gridz.chm(dsm_file=dsm3.path, dtm_file=dtm_path, chm_save_name=chm3_out)
-    chm4 = sfm_gridz.chm(dsm_file=dsm4.path, dtm_file=dtm_path, chm_save_name=chm4_out)
-    chm6 = sfm_gridz.chm(dsm_file=dsm6.path, dtm_file=dtm_path, chm_save_name=chm6_out)
-
-    for x in [chm1, chm3, chm4, chm6]:
-        pcplot.plot_chm(chm_path=x.path)
-        pcplot.plot_roughness(dsm_path=x.path)
-        # pcplot.plot_dtm(chm_path=x.path)
-
-    prras1 = sfm_gridz.precision(prec_point_cloud=pcp1_path, out_raster=pcp1_out, resolution=1,
-                                 prec_dimension='z', epsg=epsg_code, bounds=dsm1.bounds, mask=mask_shp)
-    prras3 = sfm_gridz.precision(prec_point_cloud=pcp3_path, out_raster=pcp3_out, resolution=1,
-                                 prec_dimension='z', epsg=epsg_code, bounds=dsm1.bounds, mask=mask_shp)
-    prras4 = sfm_gridz.precision(prec_point_cloud=pcp4_path, out_raster=pcp4_out, resolution=1,
-                                 prec_dimension='z', epsg=epsg_code, bounds=dsm1.bounds, mask=mask_shp)
-    prras6 = sfm_gridz.precision(prec_point_cloud=pcp6_path, out_raster=pcp6_out, resolution=1,
-                                 prec_dimension='z', epsg=epsg_code, bounds=dsm1.bounds, mask=mask_shp)
-
-    print(prras6.pr_dim)
-
-    for x in [prras1, prras3, prras4, prras6]:
-        pcplot.plot_precision(prec_map_path=x.path, fill_gaps=True)
-
-    # generate DoDs
-    #Summer
-    Sep17_Sep18_thresh = sfm_gridz.difference(raster_1=chm1_out, raster_2=chm4_out,
-                                       prec_point_cloud_1=pcp1_out, prec_point_cloud_2=pcp4_out,
-                                       out_ras=DoD_Dec16_Jan18_Thresh, epsg=epsg_code, mask=mask_shp,
-                                              lod_method='threshold')
-    Sep17_Sep18_weight = sfm_gridz.difference(raster_1=chm1_out, raster_2=chm4_out,
-                                       prec_point_cloud_1=pcp1_out, prec_point_cloud_2=pcp4_out,
-                                       out_ras=DoD_Dec16_Jan18_Weight, epsg=epsg_code, mask=mask_shp,
-                                              lod_method='weighted')
-
-    # #winter
-    Dec16_Jan18_thresh = sfm_gridz.difference(raster_1=chm3_out, raster_2=chm6_out,
-                                       prec_point_cloud_1=pcp3_out, prec_point_cloud_2=pcp6_out,
-                                       out_ras=DoD_Sep17_Sep18_Thresh, epsg=epsg_code, mask=mask_shp,
-                                       lod_method='threshold')
-    Dec16_Jan18_weight = sfm_gridz.difference(raster_1=chm3_out, raster_2=chm6_out,
-                                       prec_point_cloud_1=pcp3_out, prec_point_cloud_2=pcp6_out,
-                                       out_ras=DoD_Sep17_Sep18_Weight, epsg=epsg_code, mask=mask_shp,
-                                       lod_method='weighted')
-
-    for x in [Sep17_Sep18_thresh, Sep17_Sep18_weight, Dec16_Jan18_thresh, Dec16_Jan18_weight]:
-        pcplot.plot_dem_of_diff(dem_o_diff_path=x.ras_out_path)
+    pipe = build_pipeline()
+    results = pipe.run()
+
+    # only re-plot the rasters that were remade
+    for name in pipe.timings:
+        if name.startswith('dsm'):
+            pcplot.plot_dsm(dsm_path=results[name]['path'])
+            pcplot.plot_roughness(dsm_path=results[name]['path'])
+        elif name == 'chms':
+            for path in results[name]['paths']:
+                pcplot.plot_chm(chm_path=path)
+                pcplot.plot_roughness(dsm_path=path)
+                # pcplot.plot_dtm(chm_path=path)
+        elif name.startswith('pcc'):
+            pcplot.plot_precision(prec_map_path=results[name]['path'], fill_gaps=True)
+        elif name == 'dods':
+            for path in results[name]['paths']:
+                pcplot.plot_dem_of_diff(dem_o_diff_path=path)
 
 
 if __name__ == '__main__':
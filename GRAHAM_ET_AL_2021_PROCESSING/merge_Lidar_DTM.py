@@ -4,10 +4,9 @@
 # create polygon of woodland area.
 
 import rasterio
-from rasterio.merge import merge
 from rasterio.plot import show
 import os
-from glob import glob
+from sfm_gridz import dtm_mosaic
 
 # --- Inputs ---
 home = os.path.abspath("C:/HG_Projects/CWC_Drone_work/Prec_Anal_Exports/Rasters_v3")
@@ -17,26 +16,11 @@ raw_dtm_folder = os.path.abspath('C:/HG_Projects/CWC_Drone_work/DTM/Download_146
 dtm_out_path = os.path.abspath('C:/HG_Projects/CWC_Drone_work/DTM/Lidar_mosaic/CWC_Lidar_DTM.tif')
 
 def main():
+    # only the tiles under the DSM are read - written clipped to the DSM extent on the 2m LiDAR grid
+    dtm_mosaic.mosaic_dtm(raw_dtm_folder, dtm_out_path, dsm_path, pattern='*.asc')
 
-    asc_files = glob(os.path.join(raw_dtm_folder, '*.asc'))
-
-    src_files_to_mosaic = []
-    for asc in asc_files:
-        src = rasterio.open(asc)
-        src_files_to_mosaic.append(src)
-
-    mosaic, out_trans = merge(src_files_to_mosaic)
-
-    with rasterio.open(dsm_path) as src:
-        loc_crs = src.crs
-        # show(src.read(1, masked=True), cmap='terrain', transform=src.transform)
-
-    with rasterio.open(dtm_out_path, 'w+', count=1, dtype='float32', driver='GTiff', transform=out_trans,
-                      height=mosaic.shape[-2], width=mosaic.shape[-1]) as dataset:
-        dataset.crs = loc_crs
-        dataset.write(mosaic)
-
-        show(dataset.read(1, masked=True), cmap='magma', transform=src.transform)
+    with rasterio.open(dtm_out_path) as dataset:
+        show(dataset.read(1, masked=True), cmap='magma', transform=dataset.transform)
 
 
 if __name__ == '__main__':
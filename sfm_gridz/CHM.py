@@ -3,130 +3,181 @@
 # Identify canopy >2m and classify
 # create polygon of woodland area.
 
-import rasterio
 from rasterio.plot import show
-from rasterio.mask import mask
-import geopandas as gpd
-from rasterio.enums import Resampling
-from shapely.geometry import box
+from rasterio.windows import Window
 import os
-import numpy as np
-import json
+import hashlib
+import tempfile
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from sfm_gridz import align
+from sfm_gridz import raster_profile
+from sfm_gridz import raster_data
 
 
-def canopy_height(dsm_path, dtm_path, chm_out):
+def canopy_height(dsm_path, dtm_path, chm_out, block_rows=1024, profile=None):
     print("Calculating Canopy Height Model...")
 
-    chm_process = CanopyHeightModel(dsm_path, dtm_path, chm_out)
+    chm_process = CanopyHeightModel(dsm_path, dtm_path, chm_out, block_rows, profile)
     chm_process.get_chm()
 
     return chm_process
 
 
+def canopy_height_batch(dsm_paths, dtm_path, chm_outs, block_rows=1024, profile=None, cache_dir=None, n_threads=None):
+    """CHMs of many DSMs from one DTM. The DTM is resampled once for each distinct DSM grid (cached on disk in
+    cache_dir for DTM files) and the CHMs are then made on n_threads threads, reading the aligned DTM by window."""
+    print("Calculating {0} Canopy Height Models...".format(len(dsm_paths)))
+    if len(dsm_paths) != len(chm_outs):
+        raise InputError("give one CHM output (or None) for each DSM")
+
+    batch_process = BatchChm(dsm_paths, dtm_path, chm_outs, block_rows, profile, cache_dir, n_threads)
+    batch_process.align_dtm()
+    batch_process.get_chms()
+
+    return batch_process
+
+
+class BatchChm:
+    def __init__(self, dsm_pths, dtm_pth, chm_out_pths, block_rows=1024, profile=None, cache_dir=None,
+                 n_threads=None):
+        self.dsm_paths = list(dsm_pths)
+        self.dtm_path = dtm_pth
+        self.block_rows = block_rows
+        self.profile = profile
+        self.n_threads = n_threads
+        self.chms = [CanopyHeightModel(dsm, dtm_pth, out, block_rows, profile)
+                     for dsm, out in zip(self.dsm_paths, chm_out_pths)]
+
+        if cache_dir is None:
+            first = next((p for p in chm_out_pths if p is not None), None)
+            cache_dir = (os.path.join(tempfile.gettempdir(), 'sfm_gridz_dtm_cache') if first is None
+                         else os.path.join(os.path.dirname(os.path.abspath(first)), 'dtm_cache'))
+        self.cache_dir = cache_dir
+        self.aligned_dtms = {}  # grid: aligned DTM (cached path or in-memory raster)
+
+    @property
+    def paths(self):
+        return [c.path for c in self.chms]
+
+    def align_dtm(self):
+        """Resample the DTM once onto each distinct DSM grid - each CHM then reads its DTM without warping"""
+        for chm in self.chms:
+            with raster_data.open_raster(chm.dsm_path) as src:
+                grid = align.grid_of(src)
+            if grid not in self.aligned_dtms:
+                self.aligned_dtms[grid] = aligned_dtm(self.dtm_path, grid, self.cache_dir, self.block_rows)
+            chm.dtm_path = self.aligned_dtms[grid]
+
+    def get_chms(self):
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            for _ in pool.map(lambda c: c.get_chm(), self.chms):
+                pass
+
+
+def aligned_dtm(dtm_path, grid, cache_dir, block_rows=1024):
+    """The DTM on grid (bilinear) - the DTM itself if it is already on the grid's pixels, an in-memory raster for in-memory
+    DTMs, otherwise a GeoTIFF in cache_dir named by the DTM file (path, size and modification time) and the grid so
+    it is reused by later runs"""
+    with raster_data.open_raster(dtm_path) as dataset:
+        if align.pixel_shift(dataset, grid) is not None:
+            return dtm_path  # already on the grid's pixels - read through offset windows
+
+        meta = raster_profile.apply(grid.meta(count=1), {"cog": False, "overviews": False})
+        out_path = None
+        if not isinstance(dataset, raster_data.RasterData):
+            stat = os.stat(dtm_path)
+            key = repr((os.path.abspath(dtm_path), stat.st_size, stat.st_mtime_ns, grid.key()))
+            out_path = os.path.join(cache_dir, "dtm_{0}.tif".format(hashlib.sha1(key.encode()).hexdigest()[:16]))
+            if os.path.exists(out_path):
+                print("using cached aligned DTM {0}".format(out_path))
+                return out_path
+            os.makedirs(cache_dir, exist_ok=True)
+
+        print("aligning DTM to a {0} x {1} grid...".format(grid.width, grid.height))
+        if dataset.crs is None:
+            warnings.warn("DTM CRS is not set - continuing assuming it matches the DSM")
+        elif grid.crs is not None and dataset.crs != grid.crs:
+            raise CrsError("DTM CRS and DSM CRS do not match - reproject DTM before running chm module.")
+
+        dtm = align.AlignedRaster(dataset, grid, src_crs=grid.crs)
+        tmp_path = None if out_path is None else out_path + '.{0}.tmp.tif'.format(os.getpid())
+        try:
+            with raster_data.open_output(tmp_path, meta) as dest:
+                for row in range(0, grid.height, block_rows):
+                    window = Window(0, row, grid.width, min(block_rows, grid.height - row))
+                    dest.write(dtm.read(1, window=window).astype('float32'), 1, window=window)
+        finally:
+            dtm.close()
+
+    if out_path is None:
+        return dest.raster
+    os.replace(tmp_path, out_path)  # a whole file or nothing is left in the cache
+    return out_path
+
+
 class CanopyHeightModel:
-    def __init__(self, dsm_pth, dtm_pth, chm_out_pth):
+    def __init__(self, dsm_pth, dtm_pth, chm_out_pth, block_rows=1024, profile=None):
         self.dsm_path = dsm_pth
         self.dtm_path = dtm_pth
-        self.path = chm_out_pth
+        self.path = chm_out_pth  # None to keep the CHM in memory (self.raster)
+        self.raster = None
+        self.block_rows = block_rows
+        self.profile = profile
         self.epsg = None
 
 
     def get_chm(self):
 
-        def reshape_arr(b_arr, difference):
-            if difference[0] > 0:
-                b_arr = np.delete(b_arr, (range(0, difference[0])), axis=0)
-            else:
-                ins_list = []
-                for i in range(0, abs(difference[0])):
-                    ins_list.append(0)
-                b_arr = np.insert(b_arr, ins_list, -999, axis=0)
-            if difference[1] > 0:
-                b_arr = np.delete(b_arr, (range(b_arr.shape[-1] - (difference[1]), b_arr.shape[-1])),
-                                  axis=1)
-            else:
-                ind = b_arr.shape[1]
-                ins_list = []
-                for i in range(0, abs(difference[1])):
-                    ins_list.append(ind)
-                b_arr = np.insert(b_arr, ins_list, -999, axis=1)
-
-            return b_arr
-
-        def getFeatures(gdf):
-            """Function to parse features from GeoDataFrame in such a manner that rasterio wants them"""
-            return [json.loads(gdf.to_json())['features'][0]['geometry']]
-
-        with rasterio.open(self.dsm_path) as src:
-            dsm_arr = src.read(1)
-            roughness = src.read(2)
-            bounds = src.bounds
-            bbox = box(bounds.left, bounds.bottom, bounds.right, bounds.top)
-            geo = gpd.GeoDataFrame({'geometry': bbox}, index=[0], crs=src.crs.data)
-            coords = getFeatures(geo)
-            dsm_meta = src.meta
+        """Write the 3 band CHM on the DSM grid: 1 - CHM (DSM - DTM), 2 - DSM roughness, 3 - DTM. The DTM is sampled
+        onto the DSM grid (bilinear) and everything is done in strips of block_rows rows so only one strip of each
+        raster is in memory and the output is written once. The DSM and DTM can be paths or in-memory rasters."""
+
+        with raster_data.open_raster(self.dsm_path) as src, raster_data.open_raster(self.dtm_path) as dataset:
             loc_crs = src.crs
             no_dat_val = src.nodata
-            target_xres, target_yres = src.transform[0], abs(src.transform[4])
 
-        with rasterio.open(self.dtm_path, 'r+') as dataset:
             if dataset.crs is None:
                 warnings.warn("DTM CRS is not set - continuing assuming it matches the DSM")
-                dataset.crs = loc_crs
             elif dataset.crs != loc_crs:
                 raise CrsError("DTM CRS and DSM CRS do not match - reproject DTM before running chm module.")
 
-            xscale = dataset.transform[0]/target_xres
-            yscale = abs(dataset.transform[4])/target_yres
-
-            data = dataset.read(
-                out_shape=(
-                    dataset.count,
-                    int(dataset.width * xscale),
-                    int(dataset.height * yscale)
-                ),
-                resampling=Resampling.bilinear
-            )
-            data = data.reshape((data.shape[-2], data.shape[-1]))
-
-            transform = dataset.transform * dataset.transform.scale(
-                (dataset.width / data.shape[-2]),
-                (dataset.height / data.shape[-1])
-            )
+            dtm = align.AlignedRaster(dataset, align.grid_of(src), src_crs=loc_crs)
 
-            save_meta = dataset.meta
+            save_meta = src.meta.copy()
+            save_meta.update(count=3, dtype='float32', nodata=-999)
+            save_meta = raster_profile.apply(save_meta, self.profile)
 
-        save_meta.update(transform=transform, count=1, height=data.shape[-1], width=data.shape[-2], nodata=no_dat_val)
+            with raster_data.open_output(self.path, save_meta) as chm:
+                for row in range(0, src.height, self.block_rows):
+                    window = Window(0, row, src.width, min(self.block_rows, src.height - row))
 
-        with rasterio.open(self.path, 'w+', **save_meta) as chm:
-            chm.write(data, 1)
+                    dsm_arr = src.read(1, window=window)
+                    roughness = src.read(2, window=window)
+                    dtm_arr = dtm.read(1, window=window).astype('float32')
 
-            out_img, out_transform = mask(chm, shapes=coords, crop=True)
-            out_img = out_img.reshape((out_img.shape[-2], out_img.shape[-1]))
+                    dtm_arr[dsm_arr == no_dat_val] = -999
 
-            if out_img.shape != dsm_arr.shape:
+                    chm_arr = dtm_arr.copy()
+                    valid = dtm_arr != -999
+                    chm_arr[valid] = dsm_arr[valid] - dtm_arr[valid]
 
-                diff = tuple(x - y for x, y in zip(out_img.shape,  dsm_arr.shape))
+                    chm.write(chm_arr, 1, window=window)
+                    chm.write(roughness.astype('float32'), 2, window=window)
+                    chm.write(dtm_arr, 3, window=window)
 
-                out_img = reshape_arr(out_img, diff)
+                # show(chm.read(1, masked=True), cmap='viridis', transform=dataset.transform)
+                # show(chm.read(2, masked=True), cmap='magma', transform=dataset.transform)
+                # show(chm.read(3, masked=True), cmap='terrain', transform=dataset.transform)
 
-            out_img[dsm_arr == no_dat_val] = -999
+                self.epsg = chm.crs.data
 
-        save_meta.update(transform=out_transform, count=3, height=out_img.shape[-2], width=out_img.shape[-1])
+            dtm.close()
 
-        with rasterio.open(self.path, 'w+', **save_meta) as chm:
-            chm.write(out_img, 3)
-            chm.write(roughness.astype('float32'), 2)
-            chm_arr = out_img.copy()
-            chm_arr[chm_arr != -999] = dsm_arr[out_img != -999] - out_img[out_img != -999]
-            chm.write(chm_arr, 1)
-
-            # show(chm.read(1, masked=True), cmap='viridis', transform=dataset.transform)
-            # show(chm.read(2, masked=True), cmap='magma', transform=dataset.transform)
-            # show(chm.read(3, masked=True), cmap='terrain', transform=dataset.transform)
-
-            self.epsg = chm.crs.data
+        if self.path is None:
+            self.raster = chm.raster
+        else:
+            raster_profile.finalise(self.path, self.profile)
 
         print("DONE")
 
@@ -139,6 +190,17 @@ class Error(Exception):
     pass
 
 
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
 class CrsError(Error):
     """Exception raised for errors in the input.
 
@@ -1,18 +1,33 @@
 ###  Script to convert the Precision point cloud from MS_Prec_Estim.py into a Raster.
 
+import os
+import shutil
+import tempfile
 import pdal
 import rasterio
 import json
 from datetime import datetime
 from sfm_gridz.mask_AOI import mask_it
+from sfm_gridz import bin_grid
+from sfm_gridz import tile_grid
+from sfm_gridz import raster_profile
+from sfm_gridz import raster_data
 from rasterio.crs import CRS
 
 
-def height_map(point_cloud, out_raster, resolution, window_size, epsg, bounds, mask):
+def height_map(point_cloud, out_raster, resolution, window_size, epsg, bounds, mask, engine='pdal', tiled=False,
+               memory_limit=2048, n_workers=None, tile_size=None, profile=None):
 
     startTime = datetime.now()
 
-    dsm_process = Dsm(point_cloud, out_raster, resolution, window_size, epsg, bounds, mask)
+    if engine not in ['pdal', 'numpy']:
+        raise InputError("engine must be: 'pdal' or 'numpy'")
+    if tiled is True and engine == 'pdal':
+        raise InputError("the tiled mode grids with the 'numpy' engine - use engine='numpy' with tiled=True")
+
+    dsm_process = Dsm(point_cloud, out_raster, resolution, window_size, epsg, bounds, mask, engine, profile)
+    if tiled is True:
+        dsm_process.set_tiling(memory_limit, n_workers, tile_size)
     dsm_process.get_reader()
     dsm_process.Run()
 
@@ -22,10 +37,11 @@ def height_map(point_cloud, out_raster, resolution, window_size, epsg, bounds, m
 
 class Dsm:
 
-    def __init__(self, real_pc, ras_path, ras_res, window, epsg, bbox, maskit):
+    def __init__(self, real_pc, ras_path, ras_res, window, epsg, bbox, maskit, engine='pdal', profile=None):
         self.rpc = real_pc
         self.res = ras_res
-        self.path = ras_path
+        self.path = ras_path  # None to keep the DSM in memory (self.raster)
+        self.raster = None
         self.wind = window
         self.bounds = bbox
         self.mask = maskit
@@ -37,6 +53,19 @@ class Dsm:
         self.statval = 'mean'  # we could add the string to the pdal pipline but in case we decide to later add other
                                # stats it will be more strightforward.
         self.reader = None
+        self.engine = engine
+        self.profile = profile
+        self.tiled = False
+        self.mem_limit = None
+        self.n_workers = None
+        self.tile_size = None
+
+    def set_tiling(self, memory_limit, n_workers, tile_size):
+        """Grid the cloud out-of-core in parallel tiles - gives the same raster as the 'numpy' engine"""
+        self.tiled = True
+        self.mem_limit = memory_limit
+        self.n_workers = n_workers
+        self.tile_size = tile_size
 
     def get_reader(self):
 
@@ -52,6 +81,108 @@ class Dsm:
 
         print("Generating DSM raster...")
 
+        if self.tiled is False and self.engine == 'numpy':
+            self.raster = self.grid_numpy()
+        elif self.path is None:
+            self.raster = self.grid_to_memory()
+        elif self.tiled is True:
+            self.run_tiled(self.path, self.profile)
+        else:
+            self.run_pdal(self.path, self.profile)
+
+        epsg = None if len(self.epsg_code) == 0 else self.epsg_code.data
+
+        if self.raster is not None:
+            # masked in memory - the raster is only written if there is an output path
+            if self.mask is not None:
+                self.raster = raster_data.mask_raster(self.raster, self.mask, epsg)
+            bounds = self.raster.bounds
+            if self.path is not None:
+                self.raster.write(self.path, self.profile)
+                self.raster = None
+        else:
+            if self.mask is not None:
+                mask_it(raster=self.path, shp_path=self.mask, epsg=epsg)
+            raster_profile.finalise(self.path, self.profile)
+            with rasterio.open(self.path) as src:
+                bounds = src.bounds
+
+        if self.bounds is None:
+            self.bounds = ([bounds[0], bounds[2]], [bounds[1], bounds[3]])
+
+    def read_points(self):
+        """Read the point cloud into a numpy structured array with a reader-only PDAL pipeline"""
+        read_pc = {
+            "pipeline": [
+                {
+                    "type": self.reader,
+                    "filename": self.rpc
+                }
+            ]
+        }
+
+        pipeline = pdal.Pipeline(json.dumps(read_pc))
+        pipeline.validate()
+        pipeline.execute()
+
+        if len(self.epsg_code) == 0:
+            self.epsg_code = pipeline_crs(pipeline)
+
+        return pipeline.arrays[0]
+
+    def grid_numpy(self):
+        """Grid the cloud in memory with bin_grid - gives the same grid and statistics as writers.gdal"""
+        points = self.read_points()
+
+        grid = bin_grid.grid_from_bounds(points['X'], points['Y'], self.res, self.bounds)
+        stats = bin_grid.bin_points(points['X'], points['Y'], points['Z'], grid, stats=('mean', 'stdev'),
+                                    window_size=self.wind)
+
+        crs = None if len(self.epsg_code) == 0 else self.epsg_code
+        return raster_data.RasterData([stats['mean'], stats['stdev']], grid.transform, crs, bin_grid.NODATA)
+
+    def grid_to_memory(self):
+        """The pdal and tiled engines write a raster - grid to a temporary file and hold the result in memory"""
+        tmp_dir = tempfile.mkdtemp()
+        tmp_path = os.path.join(tmp_dir, 'dsm.tif')
+        try:
+            if self.tiled is True:
+                self.run_tiled(tmp_path, False)
+            else:
+                self.run_pdal(tmp_path, False)
+            return raster_data.RasterData.from_path(tmp_path)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def read_crs(self):
+        """Read only the header of the point cloud to get its CRS"""
+        read_hdr = {
+            "pipeline": [
+                {
+                    "type": self.reader,
+                    "filename": self.rpc,
+                    "count": 0
+                }
+            ]
+        }
+
+        pipeline = pdal.Pipeline(json.dumps(read_hdr))
+        pipeline.validate()
+        pipeline.execute()
+
+        return pipeline_crs(pipeline)
+
+    def run_tiled(self, path, profile):
+        """Stream the cloud into tiles and grid them in parallel - memory is bounded by self.mem_limit (MB)"""
+        if len(self.epsg_code) == 0:
+            self.epsg_code = self.read_crs()
+
+        crs = None if len(self.epsg_code) == 0 else self.epsg_code
+        tile_grid.grid_tiled(self.rpc, self.reader, path, self.res, self.bounds, self.wind, crs,
+                             self.mem_limit, self.n_workers, self.tile_size, profile=profile)
+
+    def run_pdal(self, path, profile):
+
         if self.bounds is None:
 
 
@@ -65,7 +196,7 @@ class Dsm:
                     },
                     {
                         "type": "writers.gdal",
-                        "filename": self.path,  # output file name
+                        "filename": path,  # output file name
                         "resolution": self.res,
                         "dimension": 'Z',  # raster resolution
                         "nodata": -999,
@@ -85,30 +216,38 @@ class Dsm:
                     },
                     {
                         "type": "writers.gdal",
-                        "filename": self.path,  # output file name
+                        "filename": path,  # output file name
                         "resolution": self.res,
                         "dimension": 'Z',  # raster resolution
                         "nodata": -999,
+                        "bounds": str(self.bounds),
                         "output_type": "mean, stdev",
                         "window_size": self.wind
                     }
                 ]
             }
 
+        dtm_gen["pipeline"][1].update(raster_profile.pdal_options(profile))
+
         pipeline = pdal.Pipeline(json.dumps(dtm_gen)) # define the pdal pipeline
         pipeline.validate()  # validate the pipeline
         pipeline.execute()   #  run the pipeline
 
 
-        if self.mask is not None:
-            if len(self.epsg_code) == 0:
-                mask_it(raster=self.path, shp_path=self.mask, epsg=None)
-            else:
-                mask_it(raster=self.path, shp_path=self.mask, epsg=self.epsg_code.data)
+def pipeline_crs(pipeline):
+    """Return the CRS of an executed PDAL reader pipeline or an empty list if none is set"""
+    metadata = pipeline.metadata
+    if isinstance(metadata, str):
+        metadata = json.loads(metadata)
+    metadata = metadata.get('metadata', metadata)
 
-        if self.bounds is None:
-            with rasterio.open(self.path) as src:
-                self.bounds = ([src.bounds[0], src.bounds[2]], [src.bounds[1], src.bounds[3]])
+    for stage in metadata.values():
+        if isinstance(stage, list):
+            stage = stage[0]
+        wkt = stage.get('comp_spatialreference') or stage.get('spatialreference')
+        if wkt:
+            return CRS.from_wkt(wkt)
+    return []
 
 
 class Error(Exception):
@@ -0,0 +1,60 @@
+# This script is not part of the package it times the fused lod_kernels against the NumPy LoD and DoD functions
+# they replace, on synthetic rasters of increasing size, and checks the results agree.
+
+import numpy as np
+from timeit import default_timer as timer
+from sfm_gridz import dem_of_diff, lod_kernels
+
+sizes = [1000, 4000, 8000]  # raster side lengths
+reg_error = 0.05
+t_value = 1.96
+
+
+def make_bands(side, rng):
+    def band(low, high):
+        arr = rng.uniform(low, high, (side, side)).astype('float32')
+        arr[rng.random((side, side)) < 0.05] = np.nan
+        return arr
+
+    a, c, d, f = band(0.01, 0.2), band(0, 0.5), band(0.01, 0.2), band(0, 0.5)
+    b = band(90, 110)
+    e = b + rng.normal(0, 0.5, b.shape).astype('float32')
+    return a, b, c, d, e, f
+
+
+def original(a, b, c, d, e, f, method):
+    rob_lod = t_value * ((a + c)**2 + (d + f)**2)**0.5 + reg_error
+    diff_arr = e - b
+    nan_mask = (np.isnan(b)) | (np.isnan(e)) | (np.isnan(a)) | (np.isnan(d))
+    if method == 'threshold':
+        rob_dod = dem_of_diff.get_dod(diff_arr, rob_lod, nan_mask)
+    else:
+        rob_dod = dem_of_diff.get_weight_dod(diff_arr, rob_lod, nan_mask)
+    return rob_dod.astype('float32'), rob_lod, diff_arr
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print("numba: {0}".format(lod_kernels.numba is not None))
+
+    for side in sizes:
+        bands = make_bands(side, rng)
+        workspace = lod_kernels.LodWorkspace(bands[0].shape)
+        lod_kernels.lod_dod(*bands, reg_error, t_value, 'threshold', workspace)  # compile/warm up
+
+        for method in lod_kernels.METHODS:
+            start = timer()
+            ref_dod, ref_lod, ref_diff = original(*bands, method)
+            t_orig = timer() - start
+
+            start = timer()
+            dod, lod, diff = lod_kernels.lod_dod(*bands, reg_error, t_value, method, workspace)
+            t_fused = timer() - start
+
+            max_diff = np.max(np.abs(dod - ref_dod))
+            print("{0} x {0} {1}: original {2:.3f}s, fused {3:.3f}s ({4:.1f}x), max abs difference {5}".format(
+                side, method, t_orig, t_fused, t_orig / t_fused, max_diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# This script is not part of the package it compares the time to render a large raster with a full resolution read
+# (as plot_raster used to) and with the decimated, overview aware read plot_raster now uses.
+
+import os
+import numpy as np
+import rasterio
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+from rasterio.transform import from_origin
+from timeit import default_timer as timer
+from sfm_gridz import plot_gridz
+from sfm_gridz import raster_profile
+
+out_home = os.path.abspath("C:/HG_Projects/CWC_Drone_work/Prec_Anal_Exports/Plot_check")
+side = 8000  # raster side length in cells
+
+
+def write_dsm(path, profile):
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 8 * np.pi, side, dtype='float32')
+    z = 100 + 5 * np.sin(x)[None, :] * np.cos(x)[:, None] + rng.normal(0, 0.05, (side, side)).astype('float32')
+    z[rng.random((side, side)) < 0.02] = -999
+
+    meta = {"driver": "GTiff", "height": side, "width": side, "count": 1, "dtype": "float32",
+            "crs": "EPSG:27700", "transform": from_origin(400000, 300000, 0.1, 0.1), "nodata": -999}
+    meta = raster_profile.apply(meta, profile)
+    with rasterio.open(path, 'w', **meta) as dest:
+        dest.write(z, 1)
+    raster_profile.finalise(path, profile)
+
+
+def full_read_plot(path, save_path):
+    """the previous plot_raster read - every cell read, copied with nan for -999 and handed to imshow"""
+    with rasterio.open(path) as ras:
+        arr = ras.read(1)
+        arr[arr == -999] = np.nan
+        v_range = (np.nanmin(arr), np.nanmax(arr))
+        fig, ax = plt.subplots(figsize=(12, 8))
+        ax.imshow(arr, vmin=v_range[0], vmax=v_range[1],
+                  extent=(ras.bounds[0], ras.bounds[2], ras.bounds[1], ras.bounds[3]))
+        fig.savefig(fname=save_path, dpi=300, format='jpg')
+        plt.close(fig)
+
+
+def decimated_plot(path, save_path):
+    fig, ax = plt.subplots(figsize=(12, 8))
+    plot_gridz.plot_dsm(path, save_path=save_path, mpl_fig=fig, mpl_ax=ax, legend=False)
+    plt.close(fig)
+
+
+def main():
+    for name, profile in [('plain', False), ('cog', None)]:
+        path = os.path.join(out_home, "plot_{0}.tif".format(name))
+        write_dsm(path, profile)
+
+        start = timer()
+        full_read_plot(path, os.path.join(out_home, "plot_full_{0}.jpg".format(name)))
+        t_full = timer() - start
+
+        start = timer()
+        decimated_plot(path, os.path.join(out_home, "plot_decimated_{0}.jpg".format(name)))
+        t_dec = timer() - start
+
+        print("{0} raster: full read {1:.2f}s, decimated read {2:.2f}s - {3:.1f}x faster".format(
+            name, t_full, t_dec, t_full / t_dec))
+
+
+if __name__ == '__main__':
+    main()
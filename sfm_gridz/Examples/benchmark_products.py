@@ -0,0 +1,72 @@
+# This script is not part of the package it measures the I/O and wall-clock saving of sfm_gridz.products() against
+# making the same rasters with separate sfm_gridz.dsm() and x, y and z sfm_gridz.precision() calls. Bytes read are
+# taken from /proc/self/io (rchar - every byte read by the process, cached or not), so they are only reported on Linux
+# and leave out memory-mapped reads (the precision cloud .npy sidecar).
+
+import os
+from timeit import default_timer as timer
+import sfm_gridz
+from sfm_gridz.prec_cloud import load_prec_cloud
+
+dpc_path = os.path.abspath("C:/HG_Projects/CWC_Drone_work/17_09_07_Danes_Mill/17_09_07_Exports/"
+                           "17_09_07_DanesCroft_dpc_export.laz")
+
+pcp_path = os.path.abspath("C:/HG_Projects/CWC_Drone_work/17_09_07_Danes_Mill/"
+                           "17_09_07_DanesCroft_SFM_PREC/17_09_07_DanesCroft_Prec_Cloud.txt")
+
+out_home = os.path.abspath("C:/HG_Projects/CWC_Drone_work/Prec_Anal_Exports/Products_check")
+
+resolution = 0.5
+window_size = 10
+epsg_code = 27700
+engine = 'pdal'  # engine of the separate calls - products() always grids with bin_grid
+
+
+def bytes_read():
+    """Bytes read by this process so far (None where /proc/self/io is not available)"""
+    try:
+        with open('/proc/self/io') as f:
+            return int(dict(line.split(': ') for line in f.read().splitlines())['rchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def measure(func):
+    """Wall-clock seconds and MB read by func()"""
+    b0 = bytes_read()
+    start = timer()
+    func()
+    elapsed = timer() - start
+    b1 = bytes_read()
+    return elapsed, None if b0 is None else (b1 - b0) / 1024 ** 2
+
+
+def separate_calls():
+    dsm = sfm_gridz.dsm(dpc_path, os.path.join(out_home, "sep_dsm.tif"), resolution, window_size=window_size,
+                        epsg=epsg_code, engine=engine)
+    for dim in ('x', 'y', 'z'):
+        sfm_gridz.precision(pcp_path, os.path.join(out_home, "sep_{0}err.tif".format(dim)), resolution,
+                            prec_dimension=dim, epsg=epsg_code, bounds=dsm.bounds, engine=engine)
+
+
+def single_pass():
+    sfm_gridz.products(dpc_path, pcp_path, os.path.join(out_home, "products.tif"), resolution,
+                       products=('mean', 'stdev', 'xerr', 'yerr', 'zerr'), window_size=window_size, epsg=epsg_code)
+
+
+def main():
+    # the precision cloud sidecar is built on the first read - build it first so neither path pays for it
+    load_prec_cloud(pcp_path)
+
+    t_sep, mb_sep = measure(separate_calls)
+    t_one, mb_one = measure(single_pass)
+
+    print("separate dsm / precision calls: {0:.2f}s".format(t_sep))
+    print("products(): {0:.2f}s - saves {1:.2f}s ({2:.1f}x faster)".format(t_one, t_sep - t_one, t_sep / t_one))
+    if mb_sep is not None:
+        print("data read: separate calls {0:.1f} MB, products() {1:.1f} MB - saves {2:.1f} MB ({3:.1f}x less)".format(
+            mb_sep, mb_one, mb_sep - mb_one, mb_sep / max(mb_one, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# This script is not part of the package it compares the file size and read speed of a raster written as a plain
+# striped float64 GeoTIFF (the old output) and with the default sfm_gridz output profile (float32 tiled COG).
+
+import os
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from timeit import default_timer as timer
+from sfm_gridz import raster_profile
+
+out_home = os.path.abspath("C:/HG_Projects/CWC_Drone_work/Prec_Anal_Exports/Profile_check")
+side = 6000  # raster side length in cells
+n_windows = 200
+
+
+def synthetic_dsm(rng):
+    """smooth surface with noise and a few no data holes - similar in texture to a DSM"""
+    x = np.linspace(0, 8 * np.pi, side)
+    z = 100 + 5 * np.sin(x)[None, :] * np.cos(x)[:, None] + rng.normal(0, 0.05, (side, side))
+    z[rng.random((side, side)) < 0.02] = -999
+    return z
+
+
+def write(path, arr, profile):
+    meta = {"driver": "GTiff", "height": side, "width": side, "count": 1, "dtype": "float64",
+            "crs": "EPSG:27700", "transform": from_origin(400000, 300000, 0.5, 0.5), "nodata": -999}
+    meta = raster_profile.apply(meta, profile)
+    with rasterio.open(path, 'w', **meta) as dest:
+        dest.write(arr.astype(meta['dtype']), 1)
+    raster_profile.finalise(path, profile)
+
+
+def time_reads(path, rng):
+    offsets = rng.integers(0, side - 512, (n_windows, 2))
+
+    start = timer()
+    with rasterio.open(path) as src:
+        for col, row in offsets:
+            src.read(1, window=Window(int(col), int(row), 512, 512))
+    t_windows = timer() - start
+
+    start = timer()
+    with rasterio.open(path) as src:
+        src.read(1, out_shape=(side // 16, side // 16), resampling=Resampling.average)  # e.g. a plot preview
+    t_preview = timer() - start
+
+    return t_windows, t_preview
+
+
+def main():
+    rng = np.random.default_rng(0)
+    arr = synthetic_dsm(rng)
+
+    results = {}
+    for name, profile in [('plain', False), ('cog', None)]:
+        path = os.path.join(out_home, "profile_{0}.tif".format(name))
+        start = timer()
+        write(path, arr, profile)
+        t_write = timer() - start
+        results[name] = (os.path.getsize(path) / 1024 ** 2, t_write) + time_reads(path, np.random.default_rng(1))
+
+    for name, (size, t_write, t_windows, t_preview) in results.items():
+        print("{0}: {1:.1f} MB, write {2:.2f}s, {3} random 512x512 windows {4:.2f}s, 1/16 preview {5:.2f}s".format(
+            name, size, t_write, n_windows, t_windows, t_preview))
+
+    plain, cog = results['plain'], results['cog']
+    print("size {0:.1f}x smaller, windows {1:.1f}x faster, preview {2:.1f}x faster".format(
+        plain[0] / cog[0], plain[2] / cog[2], plain[3] / cog[3]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# This script is not part of the package it checks that the 'numpy' gridding engine reproduces the rasters made
+# with PDAL writers.gdal for a DSM and a precision map, and that the tiled (out-of-core) DSM is identical to the
+# untiled 'numpy' DSM.
+
+import os
+import numpy as np
+import rasterio
+from datetime import datetime
+import sfm_gridz
+
+dpc_path = os.path.abspath("C:/HG_Projects/CWC_Drone_work/17_09_07_Danes_Mill/17_09_07_Exports/"
+                           "17_09_07_DanesCroft_dpc_export.laz")
+
+pcp_path = os.path.abspath("C:/HG_Projects/CWC_Drone_work/17_09_07_Danes_Mill/"
+                           "17_09_07_DanesCroft_SFM_PREC/17_09_07_DanesCroft_Prec_Cloud.txt")
+
+out_ras_home = os.path.abspath("C:/HG_Projects/CWC_Drone_work/Prec_Anal_Exports/Engine_check")
+
+
+def compare(ras_a, ras_b):
+    with rasterio.open(ras_a) as a, rasterio.open(ras_b) as b:
+        if a.transform != b.transform or a.shape != b.shape:
+            print("grids differ: {0} {1} / {2} {3}".format(a.shape, a.transform, b.shape, b.transform))
+            return
+        for band in range(1, a.count + 1):
+            arr_a = a.read(band)
+            arr_b = b.read(band)
+            same_nodata = np.array_equal(arr_a == -999, arr_b == -999)
+            valid = (arr_a != -999) & (arr_b != -999)
+            max_diff = np.max(np.abs(arr_a[valid] - arr_b[valid])) if valid.any() else 0
+            print("band {0}: nodata match = {1}, max abs difference = {2}, identical = {3}".format(
+                band, same_nodata, max_diff, np.array_equal(arr_a, arr_b)))
+
+
+def main():
+    epsg_code = 27700
+
+    for engine in ['pdal', 'numpy']:
+        start = datetime.now()
+        dsm = sfm_gridz.dsm(point_cloud=dpc_path, out_raster=os.path.join(out_ras_home, "dsm_{0}.tif".format(engine)),
+                            resolution=0.5, window_size=10, epsg=epsg_code, engine=engine)
+        print("{0} DSM: {1}".format(engine, datetime.now() - start))
+
+        start = datetime.now()
+        sfm_gridz.precision(prec_point_cloud=pcp_path, out_raster=os.path.join(out_ras_home,
+                                                                               "pcc_{0}.tif".format(engine)),
+                            resolution=1, epsg=epsg_code, bounds=dsm.bounds, engine=engine)
+        print("{0} precision map: {1}".format(engine, datetime.now() - start))
+
+    # small tiles so the cloud is split over many tiles and their halos
+    start = datetime.now()
+    sfm_gridz.dsm(point_cloud=dpc_path, out_raster=os.path.join(out_ras_home, "dsm_tiled.tif"), resolution=0.5,
+                  window_size=10, epsg=epsg_code, engine='numpy', tiled=True, tile_size=256)
+    print("tiled DSM: {0}".format(datetime.now() - start))
+
+    print("DSM")
+    compare(os.path.join(out_ras_home, "dsm_pdal.tif"), os.path.join(out_ras_home, "dsm_numpy.tif"))
+    print("Tiled DSM")
+    compare(os.path.join(out_ras_home, "dsm_numpy.tif"), os.path.join(out_ras_home, "dsm_tiled.tif"))
+    print("Precision map")
+    compare(os.path.join(out_ras_home, "pcc_pdal.tif"), os.path.join(out_ras_home, "pcc_numpy.tif"))
+
+
+if __name__ == '__main__':
+    main()
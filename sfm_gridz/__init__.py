@@ -2,11 +2,24 @@ from __future__ import absolute_import
 
 __version__ = '0.1'
 
+import os
+
 from sfm_gridz import DSM
 from sfm_gridz import precision_map
 from sfm_gridz import dem_of_diff
 from sfm_gridz import plot_gridz
 from sfm_gridz import CHM
+from sfm_gridz import multi_product
+from sfm_gridz import batch_dod
+from sfm_gridz import datacube
+from sfm_gridz import pipeline
+from sfm_gridz import raster_data
+from sfm_gridz import zonal_stats
+from sfm_gridz import zone_tiles
+from sfm_gridz import dtm_mosaic
+from sfm_gridz import gap_fill
+from sfm_gridz import cloud_change
+from sfm_gridz import dense_precision
 
 def dsm(point_cloud, out_raster, resolution, **kwargs):
     """ Function to run the height map module"""
@@ -15,8 +28,15 @@ def dsm(point_cloud, out_raster, resolution, **kwargs):
     epsg = kwargs.get('epsg', None)
     bounds = kwargs.get('bounds', None)
     mask = kwargs.get('mask', None)
+    tiled = kwargs.get('tiled', False)
+    engine = kwargs.get('engine', 'numpy' if tiled is True else 'pdal')
+    memory_limit = kwargs.get('memory_limit', 2048)
+    n_workers = kwargs.get('n_workers', None)
+    tile_size = kwargs.get('tile_size', None)
+    profile = kwargs.get('profile', None)
 
-    dsm_class = DSM.height_map(point_cloud, out_raster, resolution, window_size, epsg, bounds, mask)
+    dsm_class = DSM.height_map(point_cloud, out_raster, resolution, window_size, epsg, bounds, mask, engine, tiled,
+                               memory_limit, n_workers, tile_size, profile)
 
     return dsm_class
 
@@ -28,13 +48,34 @@ def precision(prec_point_cloud, out_raster, resolution, **kwargs):
     epsg = kwargs.get('epsg', None)
     bounds = kwargs.get('bounds', None)
     mask = kwargs.get('mask', None)
+    engine = kwargs.get('engine', 'pdal')
+    profile = kwargs.get('profile', None)
+    fill = kwargs.get('fill', 'max')
+    fill_distance = kwargs.get('fill_distance', None)
 
     prec_class = precision_map.precision_map(prec_point_cloud, out_raster, resolution,
-                                             prec_dimension, epsg, bounds, mask)
+                                             prec_dimension, epsg, bounds, mask, engine, profile, fill, fill_distance)
 
     return prec_class
 
 
+def products(point_cloud, prec_point_cloud, out_raster, resolution, **kwargs):
+    """ Function to run the single-pass multi-product module"""
+
+    products = kwargs.get('products', ('mean', 'stdev', 'min', 'max', 'count', 'xerr', 'yerr', 'zerr'))
+    window_size = kwargs.get('window_size', 0)
+    epsg = kwargs.get('epsg', None)
+    bounds = kwargs.get('bounds', None)
+    mask = kwargs.get('mask', None)
+    separate = kwargs.get('separate', False)
+    profile = kwargs.get('profile', None)
+
+    mp_class = multi_product.grid_products(point_cloud, prec_point_cloud, out_raster, resolution, products,
+                                           window_size, epsg, bounds, mask, separate, profile)
+
+    return mp_class
+
+
 def difference(raster_1, raster_2,prec_point_cloud_1, prec_point_cloud_2, out_ras, **kwargs):
     """ Function to run the dem of difference module"""
 
@@ -44,16 +85,143 @@ def difference(raster_1, raster_2,prec_point_cloud_1, prec_point_cloud_2, out_ra
     handle_gaps = kwargs.get('handle_gaps', True)
     mask = kwargs.get('mask', None)
     lod_method = kwargs.get('lod_method', 'threshold')
+    block_rows = kwargs.get('block_rows', None)
+    n_threads = kwargs.get('n_threads', None)
+    profile = kwargs.get('profile', None)
 
     demod_class = dem_of_diff.dem_of_diff(raster_1, raster_2, prec_point_cloud_1, prec_point_cloud_2, out_ras,
-                                          epsg_code, reg_error, t_value, handle_gaps, mask, lod_method)
+                                          epsg_code, reg_error, t_value, handle_gaps, mask, lod_method, block_rows,
+                                          n_threads, profile)
 
     return demod_class
 
 
-def chm(dsm_file, dtm_file, chm_save_name):
+def difference_batch(epochs, jobs, **kwargs):
+    """ Function to run the batch multi-epoch dem of difference module"""
+
+    epsg_code = kwargs.get('epsg', None)
+    reg_error = kwargs.get('reg_error', 0)
+    t_value = kwargs.get('t_value', 1)
+    handle_gaps = kwargs.get('handle_gaps', True)
+    mask = kwargs.get('mask', None)
+    block_rows = kwargs.get('block_rows', 1024)
+    n_threads = kwargs.get('n_threads', None)
+    profile = kwargs.get('profile', None)
+
+    batch_class = batch_dod.batch_dem_of_diff(epochs, jobs, epsg_code, reg_error, t_value, handle_gaps, mask,
+                                              block_rows, n_threads, profile)
+
+    return batch_class
+
+
+def fill_gaps(in_raster, out_raster, **kwargs):
+    """ Function to run the gap filling module"""
+
+    band = kwargs.get('band', 1)
+    max_distance = kwargs.get('max_distance', None)
+    n_neighbours = kwargs.get('n_neighbours', gap_fill.N_NEIGHBOURS)
+    power = kwargs.get('power', gap_fill.POWER)
+    block_size = kwargs.get('block_size', gap_fill.BLOCK_SIZE)
+    profile = kwargs.get('profile', None)
+
+    gf_class = gap_fill.fill_gaps(in_raster, out_raster, band, max_distance, n_neighbours, power, block_size, profile)
+
+    return gf_class
+
+
+def m3c2(cloud_1, cloud_2, prec_cloud_1, prec_cloud_2, out_cloud, **kwargs):
+    """ Function to run the point cloud change (M3C2) module"""
+
+    core_points = kwargs.get('core_points', None)
+    core_spacing = kwargs.get('core_spacing', 1.0)
+    normal_scale = kwargs.get('normal_scale', 2.0)
+    projection_scale = kwargs.get('projection_scale', 1.0)
+    max_depth = kwargs.get('max_depth', 5.0)
+    reg_error = kwargs.get('reg_error', 0)
+    t_value = kwargs.get('t_value', 1.96)
+    epsg = kwargs.get('epsg', None)
+    tile_size = kwargs.get('tile_size', cloud_change.TILE_SIZE)
+    n_workers = kwargs.get('n_workers', None)
+
+    cc_class = cloud_change.cloud_change(cloud_1, cloud_2, prec_cloud_1, prec_cloud_2, out_cloud, core_points,
+                                         core_spacing, normal_scale, projection_scale, max_depth, reg_error, t_value,
+                                         epsg, tile_size, n_workers)
+
+    return cc_class
+
+
+def attach_precision(dense_cloud, prec_cloud, out_cloud, **kwargs):
+    """ Function to run the dense cloud precision module"""
+
+    n_neighbours = kwargs.get('n_neighbours', dense_precision.PREC_NEIGHBOURS)
+    chunk_size = kwargs.get('chunk_size', dense_precision.CHUNK_SIZE)
+    n_workers = kwargs.get('n_workers', None)
+    epsg = kwargs.get('epsg', None)
+
+    dp_class = dense_precision.attach_precision(dense_cloud, prec_cloud, out_cloud, n_neighbours, chunk_size,
+                                                n_workers, epsg)
+
+    return dp_class
+
+
+def cube(cube_path, rasters=None, **kwargs):
+    """ Function to open a survey datacube or create it on the common grid of the rasters"""
+
+    chunk = kwargs.get('chunk', 256)
+    mask = kwargs.get('mask', None)
+
+    if os.path.exists(datacube.DataCube.meta_path(cube_path)):
+        return datacube.open_cube(cube_path)
+    if rasters is None:
+        raise datacube.CubeError("no datacube at {0} - give rasters to define its grid".format(cube_path))
+
+    return datacube.create_cube(cube_path, rasters, chunk, mask)
+
+
+def zonal(zones, rasters, **kwargs):
+    """ Function to run the zonal statistics module"""
+
+    bands = kwargs.get('bands', (1,))
+    percentiles = kwargs.get('percentiles', zonal_stats.PERCENTILES)
+    zone_column = kwargs.get('zone_column', None)
+    extract = kwargs.get('extract', False)
+    block_rows = kwargs.get('block_rows', zonal_stats.BLOCK_ROWS)
+
+    return zonal_stats.zonal_stats(zones, rasters, bands, percentiles, zone_column, extract, block_rows)
+
+
+def dtm(tiles, out_raster, extent, **kwargs):
+    """ Function to run the LiDAR DTM mosaic module"""
+
+    crs = kwargs.get('crs', None)
+    buffer = kwargs.get('buffer', 0)
+    pattern = kwargs.get('pattern', '*.asc')
+    block_rows = kwargs.get('block_rows', dtm_mosaic.BLOCK_ROWS)
+    profile = kwargs.get('profile', None)
+
+    return dtm_mosaic.mosaic_dtm(tiles, out_raster, extent, crs, buffer, pattern, block_rows, profile)
+
+
+def chm(dsm_file, dtm_file, chm_save_name, **kwargs):
     """ Function to run Canopy height map module"""
 
-    chm_class = CHM.canopy_height(dsm_file,dtm_file, chm_save_name)
+    block_rows = kwargs.get('block_rows', 1024)
+    profile = kwargs.get('profile', None)
+
+    chm_class = CHM.canopy_height(dsm_file,dtm_file, chm_save_name, block_rows, profile)
+
+    return(chm_class)
+
+
+def chm_batch(dsm_files, dtm_file, chm_save_names, **kwargs):
+    """ Function to run the Canopy height map module for many DSMs and one DTM"""
+
+    block_rows = kwargs.get('block_rows', 1024)
+    profile = kwargs.get('profile', None)
+    cache_dir = kwargs.get('cache_dir', None)
+    n_threads = kwargs.get('n_threads', None)
+
+    batch_class = CHM.canopy_height_batch(dsm_files, dtm_file, chm_save_names, block_rows, profile, cache_dir,
+                                          n_threads)
 
-    return(chm_class)
\ No newline at end of file
+    return batch_class
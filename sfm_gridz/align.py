@@ -0,0 +1,180 @@
+# Module to put rasters onto a common grid without writing temporary files.
+# Rasters that already sit on the target grid (same resolution, whole-pixel offset) are read through offset windows
+# so their values are untouched, anything else is warped on the fly with a WarpedVRT. Reads are windowed so only the
+# block being worked on is ever in memory.
+
+import math
+import numpy as np
+import rasterio
+import rasterio.windows
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+NODATA = -999
+TOL = 1e-6  # fraction of a pixel treated as exact alignment
+
+
+class TargetGrid:
+    """A north-up raster grid - crs, transform and shape"""
+
+    def __init__(self, crs, transform, width, height):
+        self.crs = crs
+        self.transform = transform
+        self.width = int(width)
+        self.height = int(height)
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    @property
+    def res(self):
+        return self.transform.a, -self.transform.e
+
+    def window(self, window):
+        """the part of the grid covered by a rasterio Window"""
+        return TargetGrid(self.crs, rasterio.windows.transform(window, self.transform), window.width, window.height)
+
+    def meta(self, count, dtype='float32'):
+        return {"driver": "GTiff", "height": self.height, "width": self.width, "count": count, "dtype": dtype,
+                "crs": self.crs, "transform": self.transform, "nodata": NODATA}
+
+    def key(self):
+        """hashable description of the grid - for caches keyed on the grid"""
+        return str(self.crs), tuple(round(v, 9) for v in self.transform[:6]), self.width, self.height
+
+    def __eq__(self, other):
+        return isinstance(other, TargetGrid) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+
+def grid_of(dataset):
+    """The grid of an open rasterio dataset"""
+    return TargetGrid(dataset.crs, dataset.transform, dataset.width, dataset.height)
+
+
+def target_grid(datasets, crs=None):
+    """Common grid for a list of open datasets: the finest resolution, snapped to the pixel grid of the finest
+    raster and covering the area where all of the rasters overlap."""
+    ref = min(datasets, key=lambda d: (d.res[0] * d.res[1], d.width * d.height))
+    if crs is None:
+        crs = ref.crs
+
+    left = max(d.bounds.left for d in datasets)
+    right = min(d.bounds.right for d in datasets)
+    bottom = max(d.bounds.bottom for d in datasets)
+    top = min(d.bounds.top for d in datasets)
+    if left >= right or bottom >= top:
+        raise AlignError("The rasters do not overlap - check the extents and CRS of the inputs.")
+
+    x_res, y_res = ref.res
+    x0, y0 = ref.transform.c, ref.transform.f
+
+    col0 = int(math.ceil((left - x0) / x_res - TOL))
+    col1 = int(math.floor((right - x0) / x_res + TOL))
+    row0 = int(math.ceil((y0 - top) / y_res - TOL))
+    row1 = int(math.floor((y0 - bottom) / y_res + TOL))
+
+    transform = Affine(x_res, 0.0, x0 + col0 * x_res, 0.0, -y_res, y0 - row0 * y_res)
+
+    return TargetGrid(crs, transform, col1 - col0, row1 - row0)
+
+
+class AlignedRaster:
+    """Read-only view of an open dataset (or in-memory raster_data.RasterData) on a target grid, read with the same
+    windows as the target grid."""
+
+    def __init__(self, dataset, grid, resampling=Resampling.bilinear, src_crs=None):
+        self.src = dataset
+        self.grid = grid
+        self.vrt = None
+        self.mem_dataset = None
+        self.col_shift = 0
+        self.row_shift = 0
+
+        shift = pixel_shift(dataset, grid)
+        if shift is None:
+            if hasattr(dataset, 'as_dataset'):
+                # in-memory rasters are only handed to GDAL when they need warping
+                dataset = self.mem_dataset = dataset.as_dataset()
+            src_nodata = dataset.nodata if dataset.nodata is not None else NODATA
+            vrt_opts = {} if dataset.crs is not None or src_crs is None else {"src_crs": src_crs}
+            self.vrt = WarpedVRT(dataset, crs=grid.crs, transform=grid.transform, width=grid.width,
+                                 height=grid.height, resampling=resampling, src_nodata=src_nodata, nodata=NODATA,
+                                 **vrt_opts)
+        else:
+            self.col_shift, self.row_shift = shift
+
+    @property
+    def count(self):
+        return self.src.count
+
+    def read(self, band, window=None):
+        if window is None:
+            window = Window(0, 0, self.grid.width, self.grid.height)
+
+        if self.vrt is not None:
+            return self.vrt.read(band, window=window)
+
+        width, height = int(window.width), int(window.height)
+        col_off = int(window.col_off) + self.col_shift
+        row_off = int(window.row_off) + self.row_shift
+
+        out = np.full((height, width), NODATA, dtype=self.src.dtypes[band - 1])
+
+        c0, c1 = max(0, col_off), min(self.src.width, col_off + width)
+        r0, r1 = max(0, row_off), min(self.src.height, row_off + height)
+        if c1 > c0 and r1 > r0:
+            data = self.src.read(band, window=Window(c0, r0, c1 - c0, r1 - r0))
+            if self.src.nodata is not None and self.src.nodata != NODATA:
+                data[data == self.src.nodata] = NODATA
+            out[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off] = data
+
+        return out
+
+    def close(self):
+        if self.vrt is not None:
+            self.vrt.close()
+        if self.mem_dataset is not None:
+            self.mem_dataset.close()
+
+
+def pixel_shift(dataset, grid):
+    """(col, row) offset of the grid origin in the dataset's pixels if the dataset sits on the same pixel grid,
+    otherwise None"""
+    if dataset.crs != grid.crs and dataset.crs is not None and grid.crs is not None:
+        return None
+
+    t = dataset.transform
+    g = grid.transform
+    if t.b != 0 or t.d != 0 or g.b != 0 or g.d != 0:
+        return None
+    if abs(t.a - g.a) > TOL * abs(g.a) or abs(t.e - g.e) > TOL * abs(g.e):
+        return None
+
+    col = (g.c - t.c) / t.a
+    row = (g.f - t.f) / t.e
+    if abs(col - round(col)) > TOL or abs(row - round(row)) > TOL:
+        return None
+
+    return int(round(col)), int(round(row))
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class AlignError(Error):
+    """Exception raised when rasters can't be aligned.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
@@ -0,0 +1,192 @@
+# Module to calculate many DEMs of difference between a set of survey epochs in one go. Every epoch's DSM and
+# precision raster is opened and aligned to a single common grid once, then the grid is worked through in strips: each
+# strip of each epoch is read once and shared by every epoch pair / LoD method that uses it. The per-cell sums are the
+# same as sfm_gridz.dem_of_diff (lod_kernels).
+
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from rasterio.crs import CRS
+from rasterio.windows import Window
+from sfm_gridz import align
+from sfm_gridz import lod_kernels
+from sfm_gridz import mask_AOI
+from sfm_gridz import raster_profile
+from sfm_gridz import raster_data
+
+
+def batch_dem_of_diff(epochs, jobs, epsg_code, reg_error, t_value, handle_gaps, mask, block_rows=1024, n_threads=None,
+                      profile=None):
+    """epochs - {name: (dsm raster, precision raster)}, jobs - [(epoch_1, epoch_2, lod_method, out raster), ...]"""
+    startTime = datetime.now()
+    print("calculating {0} DEMs of difference...".format(len(jobs)))
+
+    if epsg_code is not None:
+        epsg_code = CRS.from_epsg(epsg_code)
+
+    batch_process = BatchDod(epochs, jobs, epsg_code, reg_error, t_value, handle_gaps, mask, block_rows, n_threads,
+                             profile)
+    try:
+        batch_process.load_rasters()
+        batch_process.align_rasters()
+        batch_process.run_raster_calcs()
+    finally:
+        batch_process.close_rasterios()
+
+    print("Total Time: " + str(datetime.now() - startTime))  # get the time
+    return batch_process
+
+
+class DodJob:
+    """One DEM of difference in a batch - epoch_2 minus epoch_1 with the given LoD method"""
+
+    def __init__(self, epoch_1, epoch_2, method, out_ras_p):
+        self.epochs = (epoch_1, epoch_2)
+        self.lod_method = method
+        self.ras_out_path = out_ras_p  # None to keep the DoD in memory (self.raster)
+        self.raster = None
+
+
+class BatchDod:
+
+    def __init__(self, epochs, jobs, epsg_c, r_err, t_val, gap_handle, maskit, block_rows=1024, n_threads=None,
+                 profile=None):
+        self.jobs = [DodJob(*j) for j in jobs]
+        for job in self.jobs:
+            for e in job.epochs:
+                if e not in epochs:
+                    raise InputError("epoch '{0}' is not in the epochs dict".format(e))
+            if job.lod_method not in lod_kernels.METHODS:
+                raise InputError("lod_method must be one of: {0}".format(", ".join(lod_kernels.METHODS)))
+
+        # only the epochs used by a job are loaded
+        used = []
+        for job in self.jobs:
+            used.extend(e for e in job.epochs if e not in used)
+        self.epoch_pths = {e: epochs[e] for e in used}
+
+        self.epsg = epsg_c
+        self.reg_error = r_err
+        self.t_value = t_val
+        self.mask = maskit
+        self.block_rows = block_rows
+        self.n_threads = n_threads
+        self.profile = profile
+
+        if gap_handle is False:
+            self.prec_band = 2
+        else:
+            self.prec_band = 1
+
+        self.rasters = {}  # epoch: (dsm dataset, precision dataset)
+        self.aligned = {}  # epoch: (dsm AlignedRaster, precision AlignedRaster)
+        self.grid = None
+        self.outside = None
+        self.local = threading.local()
+
+    @property
+    def paths(self):
+        return [job.ras_out_path for job in self.jobs]
+
+    def load_rasters(self):
+        for e, (dsm_path, prec_path) in self.epoch_pths.items():
+            self.rasters[e] = (raster_data.open_raster(dsm_path), raster_data.open_raster(prec_path))
+
+    def align_rasters(self):
+        """One common grid for every epoch - the finest resolution over the area where they all overlap"""
+        print("aligning {0} epochs to a common grid...".format(len(self.rasters)))
+        datasets = [ds for pair in self.rasters.values() for ds in pair]
+        grid = align.target_grid(datasets, crs=self.epsg)
+
+        if self.mask is not None:
+            outside = mask_AOI.aoi_mask(self.mask, None if grid.crs is None else grid.crs.data, grid.transform,
+                                        grid.shape)
+            window = mask_AOI.crop_window(outside)
+            if window is not None:
+                grid = grid.window(window)
+                outside = outside[window.toslices()]
+            self.outside = outside
+
+        self.grid = grid
+        self.aligned = {e: (align.AlignedRaster(dsm, grid), align.AlignedRaster(prec, grid))
+                        for e, (dsm, prec) in self.rasters.items()}
+
+    def read_window(self, epoch, window):
+        """(precision, dsm, roughness) of an epoch for a window with -999 set to nan"""
+        dsm, prec = self.aligned[epoch]
+        bands = [prec.read(self.prec_band, window=window), dsm.read(1, window=window), dsm.read(2, window=window)]
+        for arr in bands:
+            arr[arr == -999] = np.nan
+        return bands
+
+    def calc_window(self, first, second, method):
+        workspace = getattr(self.local, 'workspace', None)
+        if workspace is None or workspace.shape != first[0].shape:
+            workspace = self.local.workspace = lod_kernels.LodWorkspace(first[0].shape)
+
+        return lod_kernels.lod_dod(*first, *second, self.reg_error, self.t_value, method, workspace)
+
+    def run_raster_calcs(self):
+        """Work through the grid in strips of block_rows rows on n_threads threads. Each epoch is read once per strip
+        and every job's three bands (DoD, LoD, raw difference - as for dem_of_diff) are written for the strip."""
+        out_meta = raster_profile.apply(self.grid.meta(count=3), self.profile)
+
+        height, width = self.grid.height, self.grid.width
+        rows = height if self.block_rows is None else self.block_rows
+        windows = [Window(0, row, width, min(rows, height - row)) for row in range(0, height, rows)]
+
+        io_lock = threading.Lock()  # rasterio datasets can't be shared between threads without one
+        dests = [raster_data.open_output(job.ras_out_path, out_meta) for job in self.jobs]
+        try:
+            def process(window):
+                with io_lock:
+                    bands = {e: self.read_window(e, window) for e in self.aligned}
+
+                outside = None if self.outside is None else self.outside[window.toslices()]
+
+                for job, dest in zip(self.jobs, dests):
+                    results = self.calc_window(bands[job.epochs[0]], bands[job.epochs[1]], job.lod_method)
+
+                    with io_lock:
+                        for band, arr in enumerate(results, start=1):
+                            if outside is not None:
+                                arr[outside] = mask_AOI.NODATA
+                            dest.write(arr.astype(out_meta['dtype'], copy=False), band, window=window)
+
+            with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+                for _ in pool.map(process, windows):
+                    pass
+        finally:
+            for dest in dests:
+                dest.close()
+
+        for job, dest in zip(self.jobs, dests):
+            if job.ras_out_path is None:
+                job.raster = dest.raster
+            else:
+                raster_profile.finalise(job.ras_out_path, self.profile)
+
+    def close_rasterios(self):
+        for pair in self.aligned.values():
+            for ras in pair:
+                ras.close()
+        for pair in self.rasters.values():
+            for ras in pair:
+                ras.close()
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
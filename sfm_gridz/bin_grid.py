@@ -0,0 +1,240 @@
+# Module to grid point arrays directly with numpy - an alternative engine to the PDAL writers.gdal stage.
+# The grid definition and cell statistics follow writers.gdal so that rasters from either engine line up exactly.
+
+import math
+import numpy as np
+import rasterio
+from sfm_gridz import raster_profile
+from rasterio.transform import Affine
+
+NODATA = -999
+
+STATS = ('mean', 'stdev', 'min', 'max', 'count')
+
+
+class Grid:
+    """An aligned raster grid defined the same way as the PDAL writers.gdal stage.
+
+    The origin is the lower-left corner (minx, miny) and cells are counted up from there, the raster rows are
+    flipped when the transform is built so that row 0 is the northern edge. col_off and row_off place the grid as
+    a window of a larger parent grid with the same origin - cell positions are always worked out from the parent
+    origin so a window bins points exactly as the full grid would.
+    """
+
+    def __init__(self, minx, miny, width, height, res, col_off=0, row_off=0):
+        self.minx = minx
+        self.miny = miny
+        self.width = int(width)
+        self.height = int(height)
+        self.res = res
+        self.col_off = int(col_off)
+        self.row_off = int(row_off)
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    @property
+    def transform(self):
+        return Affine(self.res, 0.0, self.minx + self.res * self.col_off, 0.0, -self.res,
+                      self.miny + self.res * (self.row_off + self.height))
+
+    @property
+    def bounds(self):
+        """bounds in the ([xmin, xmax], [ymin, ymax]) form used by the dsm and precision functions"""
+        left = self.minx + self.res * self.col_off
+        bottom = self.miny + self.res * self.row_off
+        return ([left, left + self.res * self.width], [bottom, bottom + self.res * self.height])
+
+    def window(self, col_off, row_off, width, height):
+        """Return the sub-grid of this grid starting col_off, row_off cells from its lower-left corner"""
+        return Grid(self.minx, self.miny, width, height, self.res, self.col_off + col_off, self.row_off + row_off)
+
+
+def grid_from_bounds(x, y, res, bounds=None):
+    """Define the grid for a point set - uses the bounds if given or the extent of the points if None."""
+    if bounds is None:
+        minx, maxx = float(np.min(x)), float(np.max(x))
+        miny, maxy = float(np.min(y)), float(np.max(y))
+    else:
+        (minx, maxx), (miny, maxy) = bounds
+
+    width = int((maxx - minx) / res) + 1
+    height = int((maxy - miny) / res) + 1
+
+    return Grid(minx, miny, width, height, res)
+
+
+def bin_points(x, y, values, grid, stats=('mean', 'stdev'), window_size=0, radius=None):
+    """Compute per-cell statistics of values on the grid.
+
+    Each point contributes to every cell whose centre lies within radius of it (the writers.gdal default of
+    res * sqrt(2) is used when radius is None). Setting radius to 0 gives a plain bin-per-cell aggregation.
+    Empty cells are filled from the non-empty cells within window_size cells using inverse distance weighting.
+
+    Returns a dict of 2D float64 arrays keyed by stat with NODATA in cells that remain empty.
+    """
+    for s in stats:
+        if s not in STATS:
+            raise InputError("stats must be drawn from: {0}".format(", ".join(STATS)))
+
+    x = np.asarray(x, dtype='f8')
+    y = np.asarray(y, dtype='f8')
+    values = np.asarray(values, dtype='f8')
+
+    if radius is None:
+        radius = grid.res * math.sqrt(2)
+
+    n_cells = grid.width * grid.height
+    count = np.zeros(n_cells, dtype='f8')
+    total = np.zeros(n_cells, dtype='f8')
+    c_min = np.full(n_cells, np.inf) if 'min' in stats else None
+    c_max = np.full(n_cells, -np.inf) if 'max' in stats else None
+
+    # the contributions are generated one search offset at a time (and again for the stdev pass) rather than kept, so
+    # the working memory is a few arrays of the cloud's length whatever the search radius
+    for idx, v in _cell_contributions(x, y, values, grid, radius):
+        count += np.bincount(idx, minlength=n_cells)
+        total += np.bincount(idx, weights=v, minlength=n_cells)
+        if c_min is not None:
+            np.minimum.at(c_min, idx, v)
+        if c_max is not None:
+            np.maximum.at(c_max, idx, v)
+
+    has_data = count > 0
+
+    mean = np.zeros(n_cells, dtype='f8')
+    mean[has_data] = total[has_data] / count[has_data]
+
+    out = {}
+    if 'mean' in stats:
+        out['mean'] = mean
+    if 'stdev' in stats:
+        # second pass about the cell mean to avoid cancellation with large elevation values.
+        sq_dev = np.zeros(n_cells, dtype='f8')
+        for idx, v in _cell_contributions(x, y, values, grid, radius):
+            sq_dev += np.bincount(idx, weights=(v - mean[idx]) ** 2, minlength=n_cells)
+        stdev = np.zeros(n_cells, dtype='f8')
+        stdev[has_data] = np.sqrt(sq_dev[has_data] / count[has_data])
+        out['stdev'] = stdev
+    if 'min' in stats:
+        out['min'] = c_min
+    if 'max' in stats:
+        out['max'] = c_max
+    if 'count' in stats:
+        out['count'] = count.copy()
+
+    out = {k: v.reshape(grid.shape) for k, v in out.items()}
+    count = count.reshape(grid.shape)
+
+    filled = np.zeros(grid.shape, dtype=bool)
+    if window_size > 0:
+        filled = window_fill([v for k, v in out.items() if k != 'count'], count, window_size)
+
+    empty = (count == 0) & ~filled
+    for v in out.values():
+        v[empty] = NODATA
+
+    return out
+
+
+def search_reach(res, radius=None):
+    """Number of cells either side of a point's own cell that it can contribute to"""
+    if radius is None:
+        radius = res * math.sqrt(2)
+    return int(math.floor(radius / res + 0.5))
+
+
+def _cell_contributions(x, y, values, grid, radius):
+    """Yield (flat cell index, value) pairs for every cell a point contributes to."""
+    res = grid.res
+    col0 = np.floor((x - grid.minx) / res).astype(np.int64) - grid.col_off
+    row0 = np.floor((y - grid.miny) / res).astype(np.int64) - grid.row_off  # counted up from the southern edge
+
+    reach = search_reach(res, radius)
+
+    for dj in range(-reach, reach + 1):
+        for di in range(-reach, reach + 1):
+            col = col0 + di
+            row = row0 + dj
+            keep = (col >= 0) & (col < grid.width) & (row >= 0) & (row < grid.height)
+            if radius > 0:
+                dx = x - (grid.minx + (col + grid.col_off + 0.5) * res)
+                dy = y - (grid.miny + (row + grid.row_off + 0.5) * res)
+                keep &= (dx * dx + dy * dy) <= radius * radius
+            elif di != 0 or dj != 0:
+                continue
+
+            idx = (grid.height - 1 - row[keep]) * grid.width + col[keep]
+            yield idx, values[keep]
+
+
+def window_fill(arrays, count, window_size):
+    """Fill empty cells (count == 0) in place from the originally populated cells within window_size cells.
+
+    Donor cells are weighted by the inverse of their distance (in cells) to the empty cell, as in writers.gdal.
+    Returns a boolean array of the cells that were filled.
+    """
+    empty = count == 0
+    if not empty.any():
+        return np.zeros(count.shape, dtype=bool)
+
+    valid = (count > 0).astype('f8')
+    nrows, ncols = count.shape
+    w_sum = np.zeros(count.shape, dtype='f8')
+    acc = [np.zeros(count.shape, dtype='f8') for _ in arrays]
+    src_vals = [np.where(count > 0, a, 0) for a in arrays]
+
+    for dr in range(-window_size, window_size + 1):
+        for dc in range(-window_size, window_size + 1):
+            if dr == 0 and dc == 0:
+                continue
+            if abs(dr) >= nrows or abs(dc) >= ncols:
+                continue
+            weight = 1 / math.hypot(dr, dc)
+            dst = (slice(max(0, -dr), nrows - max(0, dr)), slice(max(0, -dc), ncols - max(0, dc)))
+            src = (slice(max(0, dr), nrows - max(0, -dr)), slice(max(0, dc), ncols - max(0, -dc)))
+
+            wgt = valid[src] * weight
+            w_sum[dst] += wgt
+            for a, s in zip(acc, src_vals):
+                a[dst] += s[src] * wgt
+
+    filled = empty & (w_sum > 0)
+    for arr, a in zip(arrays, acc):
+        arr[filled] = a[filled] / w_sum[filled]
+
+    return filled
+
+
+def raster_meta(grid, crs, count, dtype='float64'):
+    """GeoTIFF metadata for a raster on the grid"""
+    return {"driver": "GTiff", "height": grid.height, "width": grid.width, "count": count,
+            "dtype": dtype, "crs": crs, "transform": grid.transform, "nodata": NODATA}
+
+
+def write_raster(path, bands, grid, crs, dtype='float64', profile=False):
+    """Write a list of 2D arrays to a GeoTIFF on the grid. profile is a raster_profile profile (False for a plain
+    GeoTIFF of dtype)."""
+    meta = raster_profile.apply(raster_meta(grid, crs, len(bands), dtype), profile)
+    dtype = meta['dtype']
+
+    with rasterio.open(path, 'w', **meta) as dest:
+        for i, band in enumerate(bands, start=1):
+            dest.write(band.astype(dtype), i)
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
@@ -0,0 +1,323 @@
+# Module for point cloud to point cloud change detection with the M3C2 method (Lague et al. 2013) and a level of
+# detection from the SfM precision clouds (M3C2-PM, James et al. 2017) - so change under canopy is not lost to
+# rasterising and the LoD does not depend on DSM roughness.
+# Core points are a voxel subsample of the first cloud. At each core point the surface normal is fitted to the first
+# cloud (PCA within normal_scale), and the distance between the epochs is the difference of the mean positions, along
+# the normal, of each cloud's points in a cylinder of diameter projection_scale and half length max_depth. The x, y
+# and z precision of each epoch is interpolated (IDW) from its precision cloud to the core points and projected onto
+# the normal, giving LoD = t * sqrt(sigma_1 ** 2 + sigma_2 ** 2) + reg_error as for the DEMs of difference.
+# Neighbours are found with KD-trees and the core points are worked through in square tiles, in parallel processes,
+# each given only the points within reach of the tile.
+
+import json
+import math
+from datetime import datetime
+import numpy as np
+import pdal
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from sfm_gridz.prec_cloud import load_prec_cloud, PrecisionIndex
+from sfm_gridz.DSM import pipeline_crs
+
+try:
+    from scipy.spatial import cKDTree  # optional - only needed for point cloud change detection
+except ImportError:
+    cKDTree = None
+
+PREC_NEIGHBOURS = 8
+TILE_SIZE = 50  # map units
+
+OUT_DTYPE = np.dtype([('X', 'f8'), ('Y', 'f8'), ('Z', 'f8'), ('NormalX', 'f8'), ('NormalY', 'f8'),
+                      ('NormalZ', 'f8'), ('distance', 'f8'), ('lod', 'f8'), ('significant', 'u1'), ('n_1', 'u4'),
+                      ('n_2', 'u4'), ('std_1', 'f8'), ('std_2', 'f8'), ('sigma_1', 'f8'), ('sigma_2', 'f8')])
+
+
+def cloud_change(cloud_1, cloud_2, prec_cloud_1, prec_cloud_2, out_cloud, core_points=None, core_spacing=1.0,
+                 normal_scale=2.0, projection_scale=1.0, max_depth=5.0, reg_error=0, t_value=1.96, epsg=None,
+                 tile_size=TILE_SIZE, n_workers=None):
+    startTime = datetime.now()
+    if cKDTree is None:
+        raise InputError("point cloud change detection needs scipy (scipy.spatial.cKDTree) - install scipy")
+
+    cc_process = CloudChange(cloud_1, cloud_2, prec_cloud_1, prec_cloud_2, out_cloud, core_points, core_spacing,
+                             normal_scale, projection_scale, max_depth, reg_error, t_value, epsg, tile_size,
+                             n_workers)
+    cc_process.read_clouds()
+    cc_process.get_core_points()
+    cc_process.run_tiles()
+    cc_process.get_lod()
+    if out_cloud is not None:
+        cc_process.write_cloud()
+
+    print("Total Time: " + str(datetime.now() - startTime))  # get the time
+    return cc_process
+
+
+class CloudChange:
+
+    def __init__(self, cloud_1, cloud_2, prec_cloud_1, prec_cloud_2, out_cloud, core_points=None, core_spacing=1.0,
+                 normal_scale=2.0, projection_scale=1.0, max_depth=5.0, reg_error=0, t_value=1.96, epsg=None,
+                 tile_size=TILE_SIZE, n_workers=None):
+        self.clouds = (cloud_1, cloud_2)
+        self.prec_clouds = (prec_cloud_1, prec_cloud_2)
+        self.path = out_cloud  # None to keep the result in memory only (self.points)
+        self.core_path = core_points
+        self.core_spacing = core_spacing
+        self.normal_scale = normal_scale
+        self.projection_scale = projection_scale
+        self.max_depth = max_depth
+        self.reg_error = reg_error
+        self.t_value = t_value
+        self.epsg = epsg
+        self.tile_size = tile_size
+        self.n_workers = n_workers
+
+        self.xyz = None  # (cloud 1, cloud 2) (n, 3) arrays
+        self.points = None  # structured array of the core points and results (OUT_DTYPE)
+
+    def read_clouds(self):
+        print("reading point clouds...")
+        xyz = []
+        for cloud in self.clouds:
+            arr, crs = read_xyz(cloud)
+            if self.epsg is None and len(crs) > 0:
+                self.epsg = crs.to_epsg()
+            xyz.append(arr)
+        self.xyz = tuple(xyz)
+
+    def get_core_points(self):
+        """The core points - a given cloud or one point of the first cloud per core_spacing voxel"""
+        if self.core_path is not None:
+            core = read_xyz(self.core_path)[0]
+        else:
+            core = voxel_subsample(self.xyz[0], self.core_spacing)
+
+        self.points = np.zeros(len(core), dtype=OUT_DTYPE)
+        self.points['X'], self.points['Y'], self.points['Z'] = core[:, 0], core[:, 1], core[:, 2]
+        print("{0} core points".format(len(core)))
+
+    def run_tiles(self):
+        """Normals and distances for the core points, tile by tile in a process pool"""
+        core = np.column_stack([self.points['X'], self.points['Y'], self.points['Z']])
+        reach = max(self.normal_scale / 2, self.projection_scale / 2 + self.max_depth)
+        tiles = spatial_tiles(core, self.xyz, self.tile_size, reach)
+        params = (self.normal_scale / 2, self.projection_scale / 2, self.max_depth)
+        n_tiles = len(np.unique(tile_keys(core, self.tile_size), axis=0))
+        print("measuring change in {0} tiles...".format(n_tiles))
+
+        if self.n_workers == 1 or n_tiles < 2:
+            for idx, p1, p2 in tiles:
+                self.store(idx, tile_change(core[idx], p1, p2, *params))
+            return
+
+        with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+            # tiles are cut as they are submitted and only a couple per worker are in flight so memory stays bounded
+            pending = {}
+            for idx, p1, p2 in tiles:
+                pending[pool.submit(tile_change, core[idx], p1, p2, *params)] = idx
+                if len(pending) >= 2 * self.n_workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.store(pending.pop(future), future.result())
+            for future in pending:
+                self.store(pending[future], future.result())
+
+    def store(self, idx, result):
+        normal, distance, std_1, std_2, n_1, n_2 = result
+        for i, field in enumerate(('NormalX', 'NormalY', 'NormalZ')):
+            self.points[field][idx] = normal[:, i]
+        for field, values in zip(('distance', 'std_1', 'std_2', 'n_1', 'n_2'), (distance, std_1, std_2, n_1, n_2)):
+            self.points[field][idx] = values
+
+    def get_lod(self):
+        """Precision of each epoch along the normal at the core points and the LoD / significance of the change"""
+        core = np.column_stack([self.points['X'], self.points['Y'], self.points['Z']])
+        normal = np.column_stack([self.points['NormalX'], self.points['NormalY'], self.points['NormalZ']])
+
+        for field, ppc in zip(('sigma_1', 'sigma_2'), self.prec_clouds):
+            self.points[field] = normal_precision(load_prec_cloud(ppc), core, normal)
+
+        self.points['lod'] = (self.t_value * np.sqrt(self.points['sigma_1'] ** 2 + self.points['sigma_2'] ** 2)
+                              + self.reg_error)
+        with np.errstate(invalid='ignore'):
+            self.points['significant'] = np.abs(self.points['distance']) > self.points['lod']
+
+    def write_cloud(self):
+        if self.path[-4:] in ('.las', '.laz'):
+            writer = {"type": "writers.las", "filename": self.path, "minor_version": 4, "extra_dims": "all"}
+        elif self.path[-4:] == '.txt':
+            writer = {"type": "writers.text", "filename": self.path, "order": ",".join(OUT_DTYPE.names),
+                      "keep_unspecified": False}
+        else:
+            raise InputError("the output cloud format is not supported - use extension: .las, .laz, .txt")
+        if self.epsg is not None:
+            writer["a_srs"] = "EPSG:{0}".format(self.epsg)
+
+        pipeline = pdal.Pipeline(json.dumps({"pipeline": [writer]}), arrays=[self.points])
+        pipeline.validate()
+        pipeline.execute()
+
+
+def read_xyz(cloud):
+    """(n, 3) X, Y, Z array and crs of a .las, .laz or .txt point cloud"""
+    if cloud[-4:] == '.las' or cloud[-4:] == '.laz':
+        reader = 'readers.las'
+    elif cloud[-4:] == '.txt':
+        reader = 'readers.text'
+    else:
+        raise InputError("the Point cloud format provided is not supported "
+                         "provide file with extension: .las, .laz, .txt")
+
+    pipeline = pdal.Pipeline(json.dumps({"pipeline": [{"type": reader, "filename": cloud}]}))
+    pipeline.validate()
+    pipeline.execute()
+    arr = pipeline.arrays[0]
+
+    return np.column_stack([arr['X'], arr['Y'], arr['Z']]).astype('float64'), pipeline_crs(pipeline)
+
+
+def voxel_subsample(xyz, spacing):
+    """The first point in each spacing sized voxel - keeps points below canopy, unlike a 2D grid"""
+    cells = np.floor((xyz - xyz.min(axis=0)) / spacing).astype('int64')
+    _, first = np.unique(cells, axis=0, return_index=True)
+    return xyz[np.sort(first)]
+
+
+def tile_keys(xyz, tile_size, origin=None):
+    """(column, row) of the square tile of each point"""
+    if origin is None:
+        origin = xyz[:, :2].min(axis=0)
+    return np.floor((xyz[:, :2] - origin) / tile_size).astype('int64')
+
+
+def spatial_tiles(core, clouds, tile_size, reach):
+    """Yield (core point indices, cloud 1 points, cloud 2 points) for square tiles of the core points - each with the
+    points of the clouds within reach of the tile. Tiles are cut one at a time as they are asked for."""
+    origin = core[:, :2].min(axis=0)
+    tile_ids = tile_keys(core, tile_size, origin)
+    ring = int(math.ceil(reach / tile_size))
+
+    binned = []
+    for xyz in clouds:
+        ids = tile_keys(xyz, tile_size, origin)
+        order = np.lexsort((ids[:, 1], ids[:, 0]))
+        binned.append((xyz[order], ids[order]))
+
+    keys, inverse = np.unique(tile_ids, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    core_order = np.argsort(inverse, kind='stable')
+    starts = np.searchsorted(inverse[core_order], np.arange(len(keys) + 1))
+
+    for t, (tx, ty) in enumerate(keys):
+        idx = core_order[starts[t]:starts[t + 1]]
+        lo = np.array([tx * tile_size, ty * tile_size]) + origin - reach
+        hi = lo + tile_size + 2 * reach
+
+        near = []
+        for xyz, ids in binned:
+            parts = []
+            for ix in range(tx - ring, tx + ring + 1):
+                a = np.searchsorted(ids[:, 0], ix, side='left')
+                b = np.searchsorted(ids[:, 0], ix, side='right')
+                col = ids[a:b, 1]
+                a2 = a + np.searchsorted(col, ty - ring, side='left')
+                b2 = a + np.searchsorted(col, ty + ring, side='right')
+                parts.append(xyz[a2:b2])
+            pts = np.concatenate(parts)
+            keep = np.all((pts[:, :2] >= lo) & (pts[:, :2] <= hi), axis=1)
+            near.append(pts[keep])
+
+        yield idx, near[0], near[1]
+
+
+def tile_change(core, pts_1, pts_2, normal_radius, cyl_radius, max_depth):
+    """Worker process - normals, distances (cloud 2 - cloud 1 along the normal), standard deviations along the normal
+    and point counts of each cloud for the core points of a tile"""
+    normal = fit_normals(core, pts_1, normal_radius)
+    mean_1, std_1, n_1 = cylinder_stats(core, normal, pts_1, cyl_radius, max_depth)
+    mean_2, std_2, n_2 = cylinder_stats(core, normal, pts_2, cyl_radius, max_depth)
+
+    return normal, mean_2 - mean_1, std_1, std_2, n_1, n_2
+
+
+def neighbour_pairs(tree, pts, radius):
+    """(query index, point index) pairs of the points within radius (scalar or per query) of each query point"""
+    lists = tree.query_ball_point(pts, radius, return_sorted=False)
+    counts = np.fromiter((len(l) for l in lists), dtype='int64', count=len(lists))
+    if counts.sum() == 0:
+        return np.empty(0, 'int64'), np.empty(0, 'int64')
+    return np.repeat(np.arange(len(pts)), counts), np.concatenate([np.asarray(l, 'int64') for l in lists])
+
+
+def fit_normals(core, pts, radius):
+    """Unit normals (PCA - the direction of least variance, pointing up) of the points within radius of each core
+    point, vertical where there are fewer than 3 points"""
+    normal = np.tile([0.0, 0.0, 1.0], (len(core), 1))
+    if len(pts) < 3:
+        return normal
+
+    q, p = neighbour_pairs(cKDTree(pts), core, radius)
+    n = np.bincount(q, minlength=len(core)).astype('float64')
+    ok = n >= 3
+    if not ok.any():
+        return normal
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.column_stack([np.bincount(q, weights=pts[p, i], minlength=len(core)) for i in range(3)]) / n[:, None]
+    d = pts[p] - mean[q]
+    cov = np.empty((len(core), 3, 3))
+    for i in range(3):
+        for j in range(i, 3):
+            cov[:, i, j] = cov[:, j, i] = np.bincount(q, weights=d[:, i] * d[:, j], minlength=len(core))
+
+    _, vecs = np.linalg.eigh(cov[ok])
+    fitted = vecs[:, :, 0]
+    fitted[fitted[:, 2] < 0] *= -1
+    normal[ok] = fitted
+    return normal
+
+
+def cylinder_stats(core, normal, pts, cyl_radius, max_depth):
+    """Mean and standard deviation of the positions along the normal of the points in each core point's cylinder,
+    and the number of points. The cylinders are found with a 2D tree - the search radius grows with the tilt of the
+    normal so the whole cylinder is covered."""
+    n_core = len(core)
+    if len(pts) == 0:
+        return np.full(n_core, np.nan), np.full(n_core, np.nan), np.zeros(n_core, 'int64')
+
+    tilt = np.sqrt(np.clip(1 - normal[:, 2] ** 2, 0, 1))
+    q, p = neighbour_pairs(cKDTree(pts[:, :2]), core[:, :2], cyl_radius + max_depth * tilt)
+
+    v = pts[p] - core[q]
+    along = np.einsum('ij,ij->i', v, normal[q])
+    perp_sq = np.einsum('ij,ij->i', v, v) - along ** 2
+    inside = (perp_sq <= cyl_radius ** 2) & (np.abs(along) <= max_depth)
+    q, along = q[inside], along[inside]
+
+    count = np.bincount(q, minlength=n_core)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(q, weights=along, minlength=n_core) / count
+        var = np.bincount(q, weights=along ** 2, minlength=n_core) / count - mean ** 2
+    return mean, np.sqrt(np.maximum(var, 0)), count
+
+
+def normal_precision(pcdata, core, normal, k=PREC_NEIGHBOURS):
+    """Precision along the normal at the core points - x, y and z precision interpolated (IDW of the k nearest
+    precision cloud points) and combined as sqrt((nx * xerr) ** 2 + (ny * yerr) ** 2 + (nz * zerr) ** 2)"""
+    err = PrecisionIndex(pcdata, k).interpolate(core)
+    return np.sqrt(((normal * err) ** 2).sum(axis=1))
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
@@ -0,0 +1,241 @@
+# Module for an on-disk datacube of survey epochs - the DSM, roughness, precision and CHM layers of every epoch
+# aligned to one grid (time x band x y x x). Each epoch is stored as a memory-mappable .npy file of square chunks
+# (band x chunk row x chunk col x chunk x chunk) so reads of an area only touch the chunks that cover it, and
+# cube.json records the grid, the bands and each epoch's source rasters. Epochs are added incrementally - an epoch is
+# only re-aligned if one of its source rasters has changed.
+
+import os
+import json
+import math
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.windows import Window, from_bounds
+from sfm_gridz import align
+from sfm_gridz import mask_AOI
+
+NODATA = -999
+BANDS = ('dsm', 'roughness', 'precision', 'chm')
+CUBE_VERSION = 1
+
+# band: (source layer, band of the source raster)
+SOURCES = {'dsm': ('dsm', 1), 'roughness': ('dsm', 2), 'precision': ('precision', 2), 'chm': ('chm', 1)}
+
+
+def create_cube(cube_path, rasters, chunk=256, mask=None, bands=BANDS):
+    """Create an empty cube on the common grid of the rasters (finest resolution over the area they all cover),
+    cropped to the AOI in mask if given."""
+    datasets = [rasterio.open(r) for r in rasters]
+    try:
+        grid = align.target_grid(datasets)
+    finally:
+        for ds in datasets:
+            ds.close()
+
+    if mask is not None:
+        outside = mask_AOI.aoi_mask(mask, None if grid.crs is None else grid.crs.data, grid.transform, grid.shape)
+        window = mask_AOI.crop_window(outside)
+        if window is not None:
+            grid = grid.window(window)
+
+    return DataCube.create(cube_path, grid, chunk, mask, bands)
+
+
+def open_cube(cube_path):
+    return DataCube(cube_path)
+
+
+class DataCube:
+
+    def __init__(self, cube_path):
+        self.path = cube_path
+        with open(self.meta_path(cube_path), 'r') as f:
+            meta = json.load(f)
+
+        if meta.get("version") != CUBE_VERSION:
+            raise CubeError("{0} is not a version {1} datacube".format(cube_path, CUBE_VERSION))
+
+        crs = None if meta["crs"] is None else CRS.from_wkt(meta["crs"])
+        self.grid = align.TargetGrid(crs, Affine(*meta["transform"]), meta["width"], meta["height"])
+        self.chunk = meta["chunk"]
+        self.bands = list(meta["bands"])
+        self.mask = meta["mask"]
+        self.epoch_info = meta["epochs"]  # [{"name":, "sources": {layer: {path, size, mtime_ns}}}, ...]
+        self.outside = None
+
+    @classmethod
+    def create(cls, cube_path, grid, chunk=256, mask=None, bands=BANDS):
+        for b in bands:
+            if b not in SOURCES:
+                raise CubeError("bands must be drawn from: {0}".format(", ".join(SOURCES)))
+
+        if not os.path.isdir(cube_path):
+            os.makedirs(cube_path)
+
+        meta = {"version": CUBE_VERSION, "crs": None if grid.crs is None else grid.crs.to_wkt(),
+                "transform": list(grid.transform)[:6], "width": grid.width, "height": grid.height,
+                "chunk": int(chunk), "bands": list(bands), "mask": None if mask is None else os.path.abspath(mask),
+                "epochs": []}
+        with open(cls.meta_path(cube_path), 'w') as f:
+            json.dump(meta, f, indent=1)
+
+        return cls(cube_path)
+
+    @staticmethod
+    def meta_path(cube_path):
+        return os.path.join(cube_path, 'cube.json')
+
+    @property
+    def epochs(self):
+        return [e["name"] for e in self.epoch_info]
+
+    @property
+    def n_chunks(self):
+        """(chunk rows, chunk cols)"""
+        return int(math.ceil(self.grid.height / self.chunk)), int(math.ceil(self.grid.width / self.chunk))
+
+    @property
+    def shape(self):
+        """(time, band, y, x)"""
+        return len(self.epoch_info), len(self.bands), self.grid.height, self.grid.width
+
+    def epoch_path(self, name):
+        return os.path.join(self.path, "{0}.npy".format(name))
+
+    def save_meta(self):
+        with open(self.meta_path(self.path), 'r') as f:
+            meta = json.load(f)
+        meta["epochs"] = self.epoch_info
+        tmp_path = self.meta_path(self.path) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f, indent=1)
+        os.replace(tmp_path, self.meta_path(self.path))
+
+    def add_epoch(self, name, dsm=None, precision=None, chm=None):
+        """Align an epoch's rasters onto the cube grid and store them. Layers without a raster are no data. If the
+        epoch is already in the cube it is only rebuilt when its sources have changed. Returns True if written."""
+        layers = {"dsm": dsm, "precision": precision, "chm": chm}
+        sources = {k: source_stamp(v) for k, v in layers.items() if v is not None}
+        if len(sources) == 0:
+            raise CubeError("give at least one of dsm, precision or chm for epoch '{0}'".format(name))
+
+        existing = [e for e in self.epoch_info if e["name"] == name]
+        if len(existing) > 0 and existing[0]["sources"] == sources and os.path.exists(self.epoch_path(name)):
+            print("epoch {0} is up to date".format(name))
+            return False
+
+        print("adding epoch {0} to datacube...".format(name))
+        self.write_epoch(name, layers)
+
+        if len(existing) > 0:
+            existing[0]["sources"] = sources
+        else:
+            self.epoch_info.append({"name": name, "sources": sources})
+        self.save_meta()
+        return True
+
+    def remove_epoch(self, name):
+        self.epoch_info = [e for e in self.epoch_info if e["name"] != name]
+        self.save_meta()
+        if os.path.exists(self.epoch_path(name)):
+            os.remove(self.epoch_path(name))
+
+    def get_outside(self):
+        if self.mask is not None and self.outside is None:
+            self.outside = mask_AOI.aoi_mask(self.mask, None if self.grid.crs is None else self.grid.crs.data,
+                                             self.grid.transform, self.grid.shape)
+        return self.outside
+
+    def write_epoch(self, name, layers):
+        n_ty, n_tx = self.n_chunks
+        c = self.chunk
+        width, height = self.grid.width, self.grid.height
+        outside = self.get_outside()
+
+        tmp_path = self.epoch_path(name) + '.tmp.npy'
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype='float32', shape=(len(self.bands), n_ty, n_tx, c, c))
+
+        opened = {k: rasterio.open(v) for k, v in layers.items() if v is not None}
+        try:
+            aligned = {k: align.AlignedRaster(ds, self.grid, src_crs=self.grid.crs) for k, ds in opened.items()}
+
+            # one chunk row at a time - read the strip of each source and cut it into chunks
+            for ty in range(n_ty):
+                rows = min(c, height - ty * c)
+                window = Window(0, ty * c, width, rows)
+                for b, band in enumerate(self.bands):
+                    layer, src_band = SOURCES[band]
+                    strip = np.full((c, n_tx * c), NODATA, dtype='float32')
+                    if layer in aligned and src_band <= aligned[layer].count:
+                        strip[:rows, :width] = aligned[layer].read(src_band, window=window)
+                    if outside is not None:
+                        strip[:rows, :width][outside[ty * c:ty * c + rows]] = NODATA
+                    out[b, ty] = strip.reshape(c, n_tx, c).transpose(1, 0, 2)
+
+            for a in aligned.values():
+                a.close()
+        finally:
+            for ds in opened.values():
+                ds.close()
+
+        out.flush()
+        del out
+        os.replace(tmp_path, self.epoch_path(name))
+
+    def window(self, bounds):
+        """Window of the cube grid for (left, bottom, right, top) bounds in the cube CRS"""
+        win = from_bounds(*bounds, transform=self.grid.transform)
+        return win.round_offsets().round_lengths().intersection(Window(0, 0, self.grid.width, self.grid.height))
+
+    def read(self, epochs=None, bands=None, window=None):
+        """Array of (time, band, y, x) for the epochs and bands (all if None) over a Window of the grid - only the
+        chunks covering the window are read from disk"""
+        epochs = self.epochs if epochs is None else list(epochs)
+        bands = self.bands if bands is None else list(bands)
+        for b in bands:
+            if b not in self.bands:
+                raise CubeError("band '{0}' is not in the cube - bands: {1}".format(b, ", ".join(self.bands)))
+        if window is None:
+            window = Window(0, 0, self.grid.width, self.grid.height)
+
+        c = self.chunk
+        r0, c0 = int(window.row_off), int(window.col_off)
+        r1, c1 = r0 + int(window.height), c0 + int(window.width)
+        ty0, ty1 = r0 // c, (r1 - 1) // c + 1
+        tx0, tx1 = c0 // c, (c1 - 1) // c + 1
+
+        out = np.empty((len(epochs), len(bands), r1 - r0, c1 - c0), dtype='float32')
+        for t, name in enumerate(epochs):
+            if name not in self.epochs:
+                raise CubeError("epoch '{0}' is not in the cube".format(name))
+            data = np.load(self.epoch_path(name), mmap_mode='r')
+            for b, band in enumerate(bands):
+                tiles = data[self.bands.index(band), ty0:ty1, tx0:tx1]
+                block = tiles.transpose(0, 2, 1, 3).reshape((ty1 - ty0) * c, (tx1 - tx0) * c)
+                out[t, b] = block[r0 - ty0 * c:r1 - ty0 * c, c0 - tx0 * c:c1 - tx0 * c]
+        return out
+
+    def window_transform(self, window):
+        return rasterio.windows.transform(window, self.grid.transform)
+
+
+def source_stamp(path):
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class CubeError(Error):
+    """Exception raised for errors with the datacube.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
@@ -1,158 +1,131 @@
 # Module to calculate a DEM of difference with the consideration of a a lOD95 based on precision maps and roughness.
 import sys
-import os
-import rasterio
-from rasterio.enums import Resampling
-import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.windows import Window
 from rasterio.crs import CRS
 import numpy as np
 import warnings
-from sfm_gridz.mask_AOI import mask_it
+from sfm_gridz import mask_AOI
+from sfm_gridz import align
+from sfm_gridz import lod_kernels
+from sfm_gridz import raster_profile
+from sfm_gridz import raster_data
 
 def dem_of_diff(raster_1, raster_2, prec_point_cloud_1, prec_point_cloud_2, out_ras, epsg_code, reg_error, t_value,
-                handle_gaps, mask, lod_method):
+                handle_gaps, mask, lod_method, block_rows=None, n_threads=None, profile=None):
     print("calculating DEM of difference...")
 
     if epsg_code is not None:
         epsg_code = CRS.from_epsg(epsg_code)
 
     dem_od_process = deom_od(raster_1, raster_2, epsg_code, prec_point_cloud_1, prec_point_cloud_2, out_ras, reg_error,
-                             t_value, handle_gaps, mask, lod_method)
+                             t_value, handle_gaps, mask, lod_method, block_rows, n_threads, profile)
 
     dem_od_process.load_rasters()
     dem_od_process.resample_rasters()
     dem_od_process.run_raster_calcs()
     dem_od_process.close_rasterios()
-    dem_od_process.remove_temps()
 
     return dem_od_process
 
 
-class deom_od:
-    def __init__(self, rast1, rast2, epsg_c, prec_ras1, prec_ras2, out_ras_p, r_err, t_val, gap_handle, maskit, method):
-        self.raster_pths = [rast1, rast2, prec_ras1, prec_ras2]
-        self.rasters = [None, None, None, None]
-        self.ras_out_path = out_ras_p
-        self.epsg = epsg_c
-        self.temp_log = []
-        self.out_meta_data = None
-        self.mask = maskit
-        self.reg_error = r_err
-        self.t_value = t_val
+def get_dod(diff_arr, lod, nan_mask):
+    dod = np.zeros(diff_arr.shape)
 
-        if gap_handle is False:
-            self.prec_band = 2
-        else:
-            self.prec_band = 1
+    warnings.filterwarnings('ignore')
+    mask1 = (abs(diff_arr) > lod) & (diff_arr < 0)
+    dod[mask1] = diff_arr[mask1] + lod[mask1]
 
-        self.lod_method = method
+    mask2 = (abs(diff_arr) > lod) & (diff_arr > 0)
+    dod[mask2] = diff_arr[mask2] - lod[mask2]
 
-    def load_rasters(self):
+    dod[nan_mask] = -999
 
-        self.rasters[0] = rasterio.open(self.raster_pths[0], 'r+')
-        self.rasters[1] = rasterio.open(self.raster_pths[1], 'r+')
-        self.rasters[2] = rasterio.open(self.raster_pths[2], 'r+')
-        self.rasters[3] = rasterio.open(self.raster_pths[3], 'r+')
+    return dod
 
-    def resample_rasters(self):
-
-        print("resampling raster to equalise all arrays...")
-        res_list = []
-        for i in self.rasters:
-            x_res = (i.bounds[2] - i.bounds[0]) / i.width
-            y_res = (i.bounds[3] - i.bounds[1]) / i.height
-
-            res_list.append((x_res, y_res))
-        min_res = min(res_list)
-
-        for idx, i in enumerate(self.rasters):
-            x_res = (i.bounds[2] - i.bounds[0]) / i.width
-            y_res = (i.bounds[3] - i.bounds[1]) / i.height
 
-            if (x_res, y_res) != min_res:
-                print("resizing rasters")
+def get_weight_dod(diff_arr, lod, nan_mask):
 
-                out_meta = i.meta.copy()
+    """=IF(OC < 95%LoD, OC * (OC / 95%LoD) * 0.5, OC - 95%LoD + 95%LoD * 0.5)"""
+    dod = np.zeros(diff_arr.shape)
 
-                x_res_factor = x_res / min_res[0]
-                y_res_factor = y_res / min_res[1]
+    warnings.filterwarnings('ignore')
 
-                # resample data to target shape
-                data = i.read(
-                    out_shape=(
-                        i.count,
-                        int(i.width * x_res_factor),
-                        int(i.height * y_res_factor)
-                    ),
-                    resampling=Resampling.bilinear)
+    # weight elevation loss
+    mask1 = (abs(diff_arr) < (lod * 1.96)) & (diff_arr < 0)
+    dod[mask1] = ((diff_arr[mask1] * (diff_arr[mask1] / (lod[mask1]*1.96))) * 0.5) * -1
 
-                trans = i.transform * i.transform.scale(
-                    (i.width / data.shape[-2]),
-                    (i.height / data.shape[-1])
-                )
+    mask1b = (abs(diff_arr) > (lod * 1.96)) & (diff_arr < 0)
+    dod[mask1b] = diff_arr[mask1b] + (lod[mask1b] * 1.96) - ((lod[mask1b] * 1.96) * 0.5)
 
-                out_meta.update(
-                    {"driver": "GTiff", "height": data.shape[2], "width": data.shape[1], "transform": trans,
-                     "crs": self.epsg, "compress": "lzw", "nodata": -999})
-                temp_ras = tempfile.NamedTemporaryFile(suffix=".tif").name
+    # weight elevation gain
 
-                with rasterio.open(temp_ras, "w", **out_meta) as dest:
-                    dest.write(data)
+    mask2 = (abs(diff_arr) < (lod * 1.96)) & (diff_arr > 0)
+    dod[mask2] = ((diff_arr[mask2] * (diff_arr[mask2] / (lod[mask2] * 1.96))) * 0.5)
 
-                self.rasters[idx] = rasterio.open(temp_ras)
+    mask2b = (abs(diff_arr) > (lod * 1.96)) & (diff_arr > 0)
+    dod[mask2b] = diff_arr[mask2b] - (lod[mask2b] * 1.96) + ((lod[mask2b] * 1.96) * 0.5)
 
-                self.temp_log.append(temp_ras)
+    dod[nan_mask] = -999
 
-        # function to return the index of the smallest raster
-        def rasNum(ras_list):
-            size_list = []
-            for i in ras_list:
-                n = i.shape[0]*i.shape[1]
-                size_list.append(n)
-            rasi = size_list.index(min(size_list))
-            sras_shp = ras_list[rasi].shape
-            return rasi, sras_shp
+    return dod
 
-        ras_i, s_ras = rasNum(self.rasters)
 
-        self.out_meta_data = self.rasters[ras_i].meta.copy()
-
-        """This section below resizes arrays that don't match the dimensions of the smallest raster"""
-        if (len(set([i.shape for i in self.rasters])) <= 1) is False: # checks if dims of rasters are not equal
+class deom_od:
+    def __init__(self, rast1, rast2, epsg_c, prec_ras1, prec_ras2, out_ras_p, r_err, t_val, gap_handle, maskit, method,
+                 block_rows=None, n_threads=None, profile=None):
+        self.raster_pths = [rast1, rast2, prec_ras1, prec_ras2]
+        self.rasters = [None, None, None, None]
+        self.aligned = [None, None, None, None]
+        self.ras_out_path = out_ras_p  # None to keep the DoD in memory (self.raster)
+        self.raster = None
+        self.epsg = epsg_c
+        self.out_meta_data = None
+        self.mask = maskit
+        self.outside = None  # cells of the output grid outside the mask AOI
+        self.reg_error = r_err
+        self.t_value = t_val
 
-            for idx, x in enumerate(self.rasters):
-                if x.shape != s_ras:
+        if gap_handle is False:
+            self.prec_band = 2
+        else:
+            self.prec_band = 1
 
-                    diff = tuple(x - y for x, y in zip(x.shape, s_ras))
+        self.lod_method = method
+        self.block_rows = block_rows
+        self.n_threads = n_threads
+        self.profile = profile
+        self.local = threading.local()  # per-thread lod_kernels workspace
 
-                    def reshape_arr(b_arr, difference):
-                        if difference[0] > 0:
-                            b_arr = np.delete(b_arr, (range(0, difference[0])), axis=0)
-                        else:
-                            ins_list = []
-                            for i in range(0, abs(difference[0])):
-                                ins_list.append(0)
-                            b_arr = np.insert(b_arr, ins_list, -999, axis=0)
-                        if difference[1] > 0:
-                            b_arr = np.delete(b_arr, (range(b_arr.shape[-1] - (difference[1]), b_arr.shape[-1])),
-                                              axis=1)
-                        else:
-                            ind = b_arr.shape[1]
-                            ins_list = []
-                            for i in range(0, abs(difference[1])):
-                                ins_list.append(ind)
-                            b_arr = np.insert(b_arr, ins_list, -999, axis=1)
+    def load_rasters(self):
+        """Open the four input rasters - paths or in-memory rasters from earlier stages"""
+        self.rasters[0] = raster_data.open_raster(self.raster_pths[0])
+        self.rasters[1] = raster_data.open_raster(self.raster_pths[1])
+        self.rasters[2] = raster_data.open_raster(self.raster_pths[2])
+        self.rasters[3] = raster_data.open_raster(self.raster_pths[3])
 
-                        return b_arr.astype('float32')
+    def resample_rasters(self):
 
-                    temp_ras = tempfile.NamedTemporaryFile(suffix=".tif").name
+        """Put all four rasters onto one grid - the finest resolution over the area where they all overlap.
+        Rasters already on that pixel grid are read through offset windows, others are warped on the fly (bilinear)
+        so no resampled copies are written to disk."""
 
-                    with rasterio.open(temp_ras, "w", **self.out_meta_data) as dest:
-                        dest.write_band(1, reshape_arr(x.read(1), diff))
-                        dest.write_band(2, reshape_arr(x.read(2), diff))
+        print("aligning rasters to a common grid...")
+        grid = align.target_grid(self.rasters, crs=self.epsg)
 
-                    self.rasters[idx] = rasterio.open(temp_ras)
-                    self.temp_log.append(temp_ras)
+        if self.mask is not None:
+            # crop the grid to the AOI up front - the AOI is then masked block by block as the output is written
+            outside = mask_AOI.aoi_mask(self.mask, None if grid.crs is None else grid.crs.data, grid.transform,
+                                        grid.shape)
+            window = mask_AOI.crop_window(outside)
+            if window is not None:
+                grid = grid.window(window)
+                outside = outside[window.toslices()]
+            self.outside = outside
+
+        self.aligned = [align.AlignedRaster(i, grid) for i in self.rasters]
+        self.out_meta_data = grid.meta(count=3)
 
     def run_raster_calcs(self):
 
@@ -165,101 +138,81 @@ class deom_od:
         e – DEM2
         f – DEM2 roughness
         g – REGISTRATION/ALIGNMENT RMSE
-        """
-
-        a = self.rasters[2].read(self.prec_band)
-        a[a == -999] = np.nan
-        b = self.rasters[0].read(1)
-        b[b == -999] = np.nan
-        c = self.rasters[0].read(2)
-        c[c == -999] = np.nan
-        d = self.rasters[3].read(self.prec_band)
-        d[d == -999] = np.nan
-        e = self.rasters[1].read(1)
-        e[e == -999] = np.nan
-        f = self.rasters[1].read(2)
-        f[f == -999] = np.nan
-        g = self.reg_error
-
-        t = self.t_value  # could also use 1.96
-
-        # Classic LoD - most robust appraoch
-        rob_lod = t * ((a + c)**2 + (d + f)**2)**0.5 + g
-
-        # Lod with Precision only
-        # prec_lod = t * (a**2 + d**2 + g**2)**0.5  # NOT USED FOR NOW POTENTIALLY USEFUL FOR OTHER APPLICATIONS?
-        # rand_noise = np.random.normal(2, 0.5, (a.shape)) #  for testing
-        diff_arr = e - b  # dem of difference
 
-        def get_dod(lod):
-            dod = np.zeros(diff_arr.shape)
-
-            warnings.filterwarnings('ignore')
-            mask1 = (abs(diff_arr) > lod) & (diff_arr < 0)
-            dod[mask1] = diff_arr[mask1] + lod[mask1]
-
-            mask2 = (abs(diff_arr) > lod) & (diff_arr > 0)
-            dod[mask2] = diff_arr[mask2] - lod[mask2]
-
-            mask3 = (np.isnan(b)) | (np.isnan(e)) | (np.isnan(a)) | (np.isnan(d))
-            dod[mask3] = -999
-
-            return dod
-
-        def get_weight_dod(lod):
+        If block_rows is set the rasters are processed in strips of block_rows rows by a pool of n_threads threads
+        and each strip is written as soon as it is done, otherwise the whole arrays are processed at once. Both give
+        the same output.
+        """
 
-            """=IF(OC < 95%LoD, OC * (OC / 95%LoD) * 0.5, OC - 95%LoD + 95%LoD * 0.5)"""
-            dod = np.zeros(diff_arr.shape)
+        if self.lod_method not in ["threshold", "weighted"]:
+            sys.exit("Error: The requested LoD method is not supported use either 'threshold' or 'weighted'.")
 
-            warnings.filterwarnings('ignore')
+        out_meta = raster_profile.apply(self.out_meta_data, self.profile)
 
-            # weight elevation loss
-            mask1 = (abs(diff_arr) < (lod * 1.96)) & (diff_arr < 0)
-            dod[mask1] = ((diff_arr[mask1] * (diff_arr[mask1] / (lod[mask1]*1.96))) * 0.5) * -1
+        height, width = out_meta['height'], out_meta['width']
+        if self.block_rows is None:
+            windows = [Window(0, 0, width, height)]
+        else:
+            windows = [Window(0, row, width, min(self.block_rows, height - row))
+                       for row in range(0, height, self.block_rows)]
 
-            mask1b = (abs(diff_arr) > (lod * 1.96)) & (diff_arr < 0)
-            dod[mask1b] = diff_arr[mask1b] + (lod[mask1b] * 1.96) - ((lod[mask1b] * 1.96) * 0.5)
+        io_lock = threading.Lock()  # rasterio datasets can't be shared between threads without one
 
-            # weight elevation gain
+        with raster_data.open_output(self.ras_out_path, out_meta) as dest:
 
-            mask2 = (abs(diff_arr) < (lod * 1.96)) & (diff_arr > 0)
-            dod[mask2] = ((diff_arr[mask2] * (diff_arr[mask2] / (lod[mask2] * 1.96))) * 0.5)
+            def process(window):
+                with io_lock:
+                    bands = self.read_window(window)
 
-            mask2b = (abs(diff_arr) > (lod * 1.96)) & (diff_arr > 0)
-            dod[mask2b] = diff_arr[mask2b] - (lod[mask2b] * 1.96) + ((lod[mask2b] * 1.96) * 0.5)
+                rob_dod, rob_lod, diff_arr = self.calc_window(*bands)
 
-            mask3 = (np.isnan(b)) | (np.isnan(e)) | (np.isnan(a)) | (np.isnan(d))
-            dod[mask3] = -999
+                if self.outside is not None:
+                    outside = self.outside[window.toslices()]
+                    for arr in (rob_dod, rob_lod, diff_arr):
+                        arr[outside] = mask_AOI.NODATA
 
-            return dod
+                with io_lock:
+                    dest.write(rob_dod.astype(out_meta['dtype'], copy=False), 1, window=window)
+                    dest.write(rob_lod.astype(out_meta['dtype'], copy=False), 2, window=window)
+                    dest.write(diff_arr.astype(out_meta['dtype'], copy=False), 3, window=window)
 
-        # prec_dod = get_dod(lod=prec_lod) # NOT USED FOR NOW.
+            with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+                for _ in pool.map(process, windows):
+                    pass
 
-        if self.lod_method == "threshold":
-            rob_dod = get_dod(lod=rob_lod)
-        elif self.lod_method == "weighted":
-            rob_dod = get_weight_dod(lod=rob_lod)
+        if self.ras_out_path is None:
+            self.raster = dest.raster
         else:
-            sys.exit("Error: The requested LoD method is not supported use either 'threshold' or 'weighted'.")
+            raster_profile.finalise(self.ras_out_path, self.profile)
+
+    def read_window(self, window):
+        """read bands a-f (see run_raster_calcs) for a window with -999 set to nan"""
+        bands = [self.aligned[2].read(self.prec_band, window=window),
+                 self.aligned[0].read(1, window=window),
+                 self.aligned[0].read(2, window=window),
+                 self.aligned[3].read(self.prec_band, window=window),
+                 self.aligned[1].read(1, window=window),
+                 self.aligned[1].read(2, window=window)]
+        for arr in bands:
+            arr[arr == -999] = np.nan
+        return bands
+
+    def calc_window(self, a, b, c, d, e, f):
+        """Classic (most robust) LoD: t * ((a + c)**2 + (d + f)**2)**0.5 + g and the DoD for the lod_method, worked
+        out in one fused float32 pass by lod_kernels. get_dod and get_weight_dod give the same results."""
 
-        with rasterio.open(self.ras_out_path, "w", **self.out_meta_data) as dest:
-            dest.write(rob_dod.astype('float32'), 1)
-            dest.write(rob_lod.astype('float32'), 2)
-            dest.write(diff_arr.astype('float32'), 3)
-            # dest.write(diff_arr.astype('float32'), 3)
+        # Lod with Precision only
+        # prec_lod = t * (a**2 + d**2 + g**2)**0.5  # NOT USED FOR NOW POTENTIALLY USEFUL FOR OTHER APPLICATIONS?
 
-        if self.mask is not None:
-            mask_it(raster=self.ras_out_path, shp_path=self.mask, epsg=self.epsg.data)
+        workspace = getattr(self.local, 'workspace', None)
+        if workspace is None or workspace.shape != a.shape:
+            workspace = self.local.workspace = lod_kernels.LodWorkspace(a.shape)
 
+        return lod_kernels.lod_dod(a, b, c, d, e, f, self.reg_error, self.t_value, self.lod_method, workspace)
 
     def close_rasterios(self):
+        for ras in self.aligned:
+            if ras is not None:
+                ras.close()
         for ras in self.rasters:
             ras.close()
-
-    def remove_temps(self):
-        print('delete the temp raster files.')
-        for i in self.temp_log:
-            try:
-                os.remove(i)
-            except OSError as e:
-                print(e)
@@ -0,0 +1,170 @@
+# Module to put the precision of the sparse _Prec_Cloud.txt tie points onto a dense point cloud. A KD-tree of the
+# precision cloud is built once (in each worker process), the dense LAS/LAZ is streamed in chunks and each dense point
+# gets the xerr, yerr and zerr interpolated (IDW) from its nearest tie points. The chunks are interpolated in parallel
+# and handed back in order to a single streaming PDAL writer (readers.numpy fed by a stream handler), so only a few
+# chunks are ever held in memory. The output keeps every dimension and the crs of the dense cloud, so elevation and
+# precision can then be gridded together from it (e.g. writers.gdal with dimension 'zerr').
+
+import os
+import json
+from collections import deque
+from datetime import datetime
+import numpy as np
+import pdal
+from concurrent.futures import ProcessPoolExecutor
+from sfm_gridz.prec_cloud import load_prec_cloud, PrecisionIndex, PREC_NEIGHBOURS
+
+CHUNK_SIZE = 2000000  # dense points per chunk
+ERR_FIELDS = ('xerr', 'yerr', 'zerr')
+
+_index = None  # PrecisionIndex of the worker process
+
+
+def attach_precision(dense_cloud, prec_cloud, out_cloud, n_neighbours=PREC_NEIGHBOURS, chunk_size=CHUNK_SIZE,
+                     n_workers=None, epsg=None):
+    """Write out_cloud (.las / .laz) - dense_cloud with xerr, yerr and zerr extra dimensions interpolated from the
+    n_neighbours nearest points of prec_cloud. The dense cloud is read chunk_size points at a time and n_workers
+    processes (all cpus if None) interpolate the chunks. epsg overrides the crs of the dense cloud."""
+    startTime = datetime.now()
+    print("Attaching precision to dense cloud...")
+
+    dp_process = DensePrecision(dense_cloud, prec_cloud, out_cloud, n_neighbours, chunk_size, n_workers, epsg)
+    dp_process.Run()
+
+    print("{0} points written to {1}".format(dp_process.n_points, out_cloud))
+    print("Total Time: " + str(datetime.now() - startTime))  # get the time
+    return dp_process
+
+
+class DensePrecision:
+    def __init__(self, dense_cloud, prec_cloud, out_cloud, n_neighbours=PREC_NEIGHBOURS, chunk_size=CHUNK_SIZE,
+                 n_workers=None, epsg=None):
+        if dense_cloud[-4:] not in ('.las', '.laz') or out_cloud[-4:] not in ('.las', '.laz'):
+            raise InputError("the dense and output clouds must be .las or .laz files")
+        self.dense_cloud = dense_cloud
+        self.prec_cloud = prec_cloud
+        self.path = out_cloud
+        self.n_neighbours = n_neighbours
+        self.chunk_size = chunk_size
+        self.n_workers = n_workers if n_workers is not None else (os.cpu_count() or 1)
+        self.epsg = epsg
+        self.n_points = 0
+
+    def Run(self):
+        pcdata = np.asarray(load_prec_cloud(self.prec_cloud))
+        print("interpolating from {0} tie points...".format(len(pcdata)))
+
+        if self.epsg is not None:
+            srs = "EPSG:{0}".format(self.epsg)
+        else:
+            srs = cloud_srs(self.dense_cloud)
+
+        if self.n_workers == 1:
+            init_worker(pcdata, self.n_neighbours)
+            self.n_points = write_stream(map(attach_chunk, stream_chunks(self.dense_cloud, self.chunk_size)),
+                                         self.path, self.chunk_size, srs)
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_workers, initializer=init_worker,
+                                     initargs=(pcdata, self.n_neighbours)) as pool:
+                self.n_points = write_stream(self.attached_chunks(pool), self.path, self.chunk_size, srs)
+
+        if self.n_points == 0:
+            raise InputError("the dense cloud {0} has no points".format(self.dense_cloud))
+
+    def attached_chunks(self, pool):
+        """Yield the chunks of the dense cloud with precision attached, in order - only a couple of chunks per worker
+        are in flight so memory use stays bounded"""
+        pending = deque()
+        for arr in stream_chunks(self.dense_cloud, self.chunk_size):
+            pending.append(pool.submit(attach_chunk, arr))
+            if len(pending) >= 2 * self.n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def cloud_srs(dense_cloud):
+    """WKT of the crs in the header of the dense cloud (None if it has none)"""
+    pipeline = pdal.Pipeline(json.dumps({"pipeline": [{"type": "readers.las", "filename": dense_cloud}]}))
+    info = pipeline.quickinfo.get('readers.las', {})
+    return info.get('srs', {}).get('wkt') or None
+
+
+def stream_chunks(dense_cloud, chunk_size):
+    """Yield the dense cloud as structured arrays of at most chunk_size points (all dimensions)"""
+    pipeline = pdal.Pipeline(json.dumps({"pipeline": [{"type": "readers.las", "filename": dense_cloud}]}))
+    for arr in pipeline.iterator(chunk_size=chunk_size):
+        if len(arr) > 0:
+            yield arr
+
+
+def init_worker(pcdata, n_neighbours):
+    """Build the precision KD-tree once per worker process"""
+    global _index
+    _index = PrecisionIndex(pcdata, n_neighbours)
+
+
+def with_precision(arr, err):
+    """Copy of the structured point array with xerr, yerr and zerr fields added"""
+    fields = [(name, arr.dtype[name]) for name in arr.dtype.names if name not in ERR_FIELDS]
+    out = np.empty(len(arr), dtype=fields + [(f, 'f8') for f in ERR_FIELDS])
+    for name, _ in fields:
+        out[name] = arr[name]
+    for i, f in enumerate(ERR_FIELDS):
+        out[f] = err[:, i]
+    return out
+
+
+def attach_chunk(arr):
+    """Worker process - the chunk of dense points with the interpolated precision attached"""
+    xyz = np.column_stack([arr['X'], arr['Y'], arr['Z']]).astype('float64')
+    return with_precision(arr, _index.interpolate(xyz, workers=1))
+
+
+def write_stream(chunks, out_cloud, chunk_size, srs=None):
+    """Write the chunks (structured arrays of at most chunk_size points, all of one dtype) to a LAS 1.4 file in one
+    streaming PDAL pass, keeping every dimension - the extra dimensions of the dense cloud (e.g. confidence) as well
+    as xerr, yerr and zerr. Returns the number of points written."""
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    if first is None:
+        return 0
+
+    writer = {"type": "writers.las", "filename": out_cloud, "minor_version": 4, "forward": "all", "extra_dims": "all"}
+    if out_cloud[-4:] == '.laz':
+        writer["compression"] = "laszip"
+    if srs is not None:
+        writer["a_srs"] = srs
+
+    # readers.numpy streams from buffer - load_next refills it with the next chunk and returns its size (0 at the end)
+    buffer = np.zeros(chunk_size, dtype=first.dtype)
+    queue = deque([first])
+    n_points = [0]
+
+    def load_next():
+        arr = queue.popleft() if queue else next(chunks, None)
+        if arr is None:
+            return 0
+        buffer[:len(arr)] = arr
+        n_points[0] += len(arr)
+        return len(arr)
+
+    pipeline = pdal.Pipeline(json.dumps({"pipeline": [writer]}), arrays=[buffer], stream_handlers=[load_next])
+    pipeline.execute_streaming(chunk_size=chunk_size)
+    return n_points[0]
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
@@ -0,0 +1,184 @@
+# Module to build a DTM for a survey from a folder of LiDAR DTM tiles (e.g. the Environment Agency 2m .asc tiles).
+# The tile footprints are read from their headers and indexed, only tiles that reach the survey extent are put into
+# a virtual (VRT) mosaic and the mosaic is written, clipped to the extent on the tiles' own pixel grid, window by
+# window - so memory use does not depend on the number or size of the tiles.
+
+import os
+import math
+import warnings
+from glob import glob
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+import numpy as np
+import rasterio
+import shapely
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.windows import Window
+from sfm_gridz import raster_data
+from sfm_gridz import raster_profile
+
+NODATA = -999
+BLOCK_ROWS = 1024
+TOL = 1e-6  # fraction of a pixel treated as exact alignment
+
+_footprint_cache = OrderedDict()  # tile path -> (mtime, footprint)
+
+
+class TileFootprint:
+    """Header information of a DTM tile - bounds, resolution, size, crs and nodata"""
+
+    def __init__(self, path, bounds, res, width, height, crs, nodata):
+        self.path = path
+        self.bounds = bounds
+        self.res = res
+        self.width = width
+        self.height = height
+        self.crs = crs
+        self.nodata = nodata
+
+
+def mosaic_dtm(tiles, out_raster, extent, crs=None, buffer=0, pattern='*.asc', block_rows=BLOCK_ROWS, profile=None):
+    """Mosaic the DTM tiles that cover extent and write them, clipped to extent, to out_raster.
+
+    tiles - folder of tiles (matched with pattern) or a list of tile paths. extent - a raster (path or in-memory
+    raster, e.g. the survey DSM) or bounds (xmin, ymin, xmax, ymax). crs - crs written to the output, if not given the
+    crs of an extent raster is used (so the DTM matches the DSM it is clipped to) and then the crs of the tiles - tiles
+    are not reprojected, a warning is given if their crs differs from the output crs. buffer - distance (map units) added around extent. The output
+    keeps the tiles' resolution and pixel grid, so values are not resampled. Returns the output path.
+    """
+    footprints = tile_index(tiles, pattern)
+    bounds, ext_crs = extent_bounds(extent)
+    bounds = (bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+
+    if crs is None:
+        crs = ext_crs or next((f.crs for f in footprints if f.crs is not None), None)
+
+    selected = select_tiles(footprints, bounds)
+    if len(selected) == 0:
+        raise InputError("none of the {0} DTM tiles overlap the extent {1}".format(len(footprints), bounds))
+    if crs is not None and any(f.crs is not None and CRS.from_user_input(f.crs) != CRS.from_user_input(crs)
+                               for f in selected):
+        warnings.warn("the DTM tile crs differs from the output crs {0} - the tiles are assumed to be in the output "
+                      "crs and are not reprojected".format(CRS.from_user_input(crs).to_string()), Warning)
+    print("mosaicking {0} of {1} DTM tiles...".format(len(selected), len(footprints)))
+
+    transform, width, height = clip_grid(selected, bounds)
+    vrt_xml = build_vrt(selected, transform, width, height, crs)
+
+    meta = {"driver": "GTiff", "height": height, "width": width, "count": 1, "dtype": "float32",
+            "crs": crs, "transform": transform, "nodata": NODATA}
+    meta = raster_profile.apply(meta, profile)
+
+    with rasterio.open(vrt_xml) as vrt, rasterio.open(out_raster, 'w', **meta) as dest:
+        for row in range(0, height, block_rows):
+            window = Window(0, row, width, min(block_rows, height - row))
+            dest.write(vrt.read(1, window=window).astype(meta["dtype"]), 1, window=window)
+
+    raster_profile.finalise(out_raster, profile)
+    return out_raster
+
+
+def tile_index(tiles, pattern='*.asc'):
+    """Footprints of the tiles in a folder (matched with pattern) or list - read from the tile headers and cached on
+    the path and modification time of each tile"""
+    if isinstance(tiles, (str, os.PathLike)):
+        paths = sorted(glob(os.path.join(tiles, pattern)))
+    else:
+        paths = list(tiles)
+    if len(paths) == 0:
+        raise InputError("no DTM tiles found in {0}".format(tiles))
+
+    footprints = []
+    for path in paths:
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        cached = _footprint_cache.get(path)
+        if cached is None or cached[0] != mtime:
+            with rasterio.open(path) as src:
+                cached = (mtime, TileFootprint(path, tuple(src.bounds), src.res, src.width, src.height, src.crs,
+                                               src.nodata))
+            _footprint_cache[path] = cached
+        footprints.append(cached[1])
+
+    return footprints
+
+
+def extent_bounds(extent):
+    """(bounds, crs) of a raster (path or in-memory raster) or a bounds tuple"""
+    if isinstance(extent, (tuple, list)) and len(extent) == 4 and not isinstance(extent[0], str):
+        return tuple(float(v) for v in extent), None
+    with raster_data.open_raster(extent) as src:
+        return tuple(src.bounds), src.crs
+
+
+def select_tiles(footprints, bounds):
+    """Tiles whose footprint overlaps bounds (found with a spatial index), in their original order"""
+    boxes = shapely.box(*np.array([f.bounds for f in footprints]).T)
+    area = shapely.box(*bounds)
+    hits = shapely.STRtree(boxes).query(area, predicate='intersects')
+    hits = [i for i in np.sort(hits) if area.intersection(boxes[i]).area > 0]  # drop tiles only touching the edge
+    return [footprints[i] for i in hits]
+
+
+def clip_grid(selected, bounds):
+    """Transform, width and height of the pixel grid of the finest tile covering bounds, clipped to the
+    extent of the selected tiles"""
+    ref = min(selected, key=lambda f: f.res[0] * f.res[1])
+    x_res, y_res = ref.res
+    x0, y0 = ref.bounds[0], ref.bounds[3]
+
+    left = max(bounds[0], min(f.bounds[0] for f in selected))
+    bottom = max(bounds[1], min(f.bounds[1] for f in selected))
+    right = min(bounds[2], max(f.bounds[2] for f in selected))
+    top = min(bounds[3], max(f.bounds[3] for f in selected))
+
+    col0 = int(math.floor((left - x0) / x_res + TOL))
+    col1 = int(math.ceil((right - x0) / x_res - TOL))
+    row0 = int(math.floor((y0 - top) / y_res + TOL))
+    row1 = int(math.ceil((y0 - bottom) / y_res - TOL))
+
+    transform = Affine(x_res, 0.0, x0 + col0 * x_res, 0.0, -y_res, y0 - row0 * y_res)
+    return transform, col1 - col0, row1 - row0
+
+
+def build_vrt(selected, transform, width, height, crs):
+    """VRT xml of the tiles placed on the output grid. Tile nodata is transparent and, as in rasterio.merge, the
+    first tile wins where tiles overlap (VRT sources later in the list are drawn on top, so they are reversed)."""
+    x_res, y_res = transform.a, -transform.e
+    srs = "<SRS>{0}</SRS>".format(escape(CRS.from_user_input(crs).to_wkt())) if crs is not None else ""
+
+    sources = []
+    for f in reversed(selected):
+        x_off = (f.bounds[0] - transform.c) / x_res
+        y_off = (transform.f - f.bounds[3]) / y_res
+        x_size = (f.bounds[2] - f.bounds[0]) / x_res
+        y_size = (f.bounds[3] - f.bounds[1]) / y_res
+        nodata = "<NODATA>{0!r}</NODATA>".format(float(f.nodata)) if f.nodata is not None else ""
+        sources.append(
+            '<ComplexSource><SourceFilename relativeToVRT="0">{0}</SourceFilename><SourceBand>1</SourceBand>'
+            '<SrcRect xOff="0" yOff="0" xSize="{1}" ySize="{2}"/>'
+            '<DstRect xOff="{3!r}" yOff="{4!r}" xSize="{5!r}" ySize="{6!r}"/>{7}</ComplexSource>'.format(
+                escape(f.path), f.width, f.height, x_off, y_off, x_size, y_size, nodata))
+
+    return ('<VRTDataset rasterXSize="{0}" rasterYSize="{1}">{2}'
+            '<GeoTransform>{3!r}, {4!r}, 0.0, {5!r}, 0.0, {6!r}</GeoTransform>'
+            '<VRTRasterBand dataType="Float32" band="1"><NoDataValue>{7}</NoDataValue>{8}</VRTRasterBand>'
+            '</VRTDataset>').format(width, height, srs, transform.c, transform.a, transform.f, transform.e, NODATA,
+                                    "".join(sources))
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
@@ -0,0 +1,214 @@
+# Module to fill no data cells of DSM and precision rasters by inverse distance weighting (IDW) of the nearest valid
+# cells. The raster is worked through in square blocks, each read with a halo of max_distance so the result does not
+# depend on the block size - every valid cell of the block and its halo goes into the KD-tree of the block, so the
+# n_neighbours nearest valid cells within max_distance of each gap cell are always found. Blocks without gaps are
+# copied straight through. Gap cells with no valid cell within max_distance are left as no data.
+
+import math
+import numpy as np
+from rasterio.windows import Window
+from sfm_gridz import raster_data
+from sfm_gridz import raster_profile
+
+try:
+    from scipy.spatial import cKDTree  # optional - only needed for gap filling
+except ImportError:
+    cKDTree = None
+
+NODATA = -999
+BLOCK_SIZE = 1024
+N_NEIGHBOURS = 8
+POWER = 2
+MAX_CELLS = 10  # default max_distance in cells
+
+
+def fill_gaps(in_raster, out_raster, band=1, max_distance=None, n_neighbours=N_NEIGHBOURS, power=POWER,
+              block_size=BLOCK_SIZE, profile=None):
+    """Fill the gaps of one band of a raster. The output holds every band of the input with the band filled, plus a
+    last band flagging the filled cells (1 - filled, 0 - not). in_raster / out_raster can be in memory (None)."""
+    print("Filling raster gaps...")
+
+    gf_process = GapFill(in_raster, out_raster, band, max_distance, n_neighbours, power, block_size, profile)
+    gf_process.Run()
+
+    print("filled {0} cells, {1} gap cells left".format(gf_process.n_filled, gf_process.n_unfilled))
+    return gf_process
+
+
+class GapFill:
+    def __init__(self, in_ras, out_ras, band=1, max_distance=None, n_neighbours=N_NEIGHBOURS, power=POWER,
+                 block_size=BLOCK_SIZE, profile=None):
+        self.in_raster = in_ras
+        self.path = out_ras  # None to keep the filled raster in memory (self.raster)
+        self.raster = None
+        self.band = band
+        self.max_distance = max_distance
+        self.n_neighbours = n_neighbours
+        self.power = power
+        self.block_size = block_size
+        self.profile = profile
+        self.n_filled = 0
+        self.n_unfilled = 0
+
+    def Run(self):
+        with raster_data.open_raster(self.in_raster) as src:
+            nodata = src.nodata if src.nodata is not None else NODATA
+            meta = src.meta.copy()
+            meta.update(count=src.count + 1, dtype='float32', nodata=NODATA)
+            meta = raster_profile.apply(meta, self.profile)
+
+            with raster_data.open_output(self.path, meta) as dest:
+                for b in range(1, src.count + 1):
+                    if b == self.band:
+                        continue
+                    for window in blocks(src.height, src.width, self.block_size):
+                        arr = src.read(b, window=window)
+                        arr[arr == nodata] = NODATA
+                        dest.write(arr.astype('float32'), b, window=window)
+
+                def write(filled, flag, window):
+                    dest.write(filled.astype('float32'), self.band, window=window)
+                    dest.write(flag.astype('float32'), src.count + 1, window=window)
+
+                self.n_filled, self.n_unfilled = fill_blocks(lambda w: src.read(self.band, window=w), write,
+                                                             src.height, src.width, src.res, nodata,
+                                                             self.max_distance, self.n_neighbours, self.power,
+                                                             self.block_size)
+
+        if self.path is None:
+            self.raster = dest.raster
+        else:
+            raster_profile.finalise(self.path, self.profile)
+
+
+def fill_array(arr, res, max_distance=None, n_neighbours=N_NEIGHBOURS, power=POWER, nodata=NODATA,
+               block_size=BLOCK_SIZE):
+    """Gap filled copy of a 2D array and a bool array of the filled cells - res is the (x, y) cell size"""
+    filled = np.array(arr, copy=True)
+    flag = np.zeros(arr.shape, dtype=bool)
+
+    def write(block, block_flag, window):
+        filled[window.toslices()] = block
+        flag[window.toslices()] = block_flag
+
+    fill_blocks(lambda w: arr[w.toslices()], write, arr.shape[0], arr.shape[1], res, nodata, max_distance,
+                n_neighbours, power, block_size)
+    return filled, flag
+
+
+def blocks(height, width, block_size):
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            yield Window(col, row, min(block_size, width - col), min(block_size, height - row))
+
+
+def fill_blocks(read, write, height, width, res, nodata, max_distance, n_neighbours, power, block_size):
+    """Fill the gaps block by block - read(window) returns the band for a window, write(filled, flag, window) is
+    called for each block. Returns the number of cells filled and left empty."""
+    if cKDTree is None:
+        raise InputError("gap filling needs scipy (scipy.spatial.cKDTree) - install scipy")
+
+    x_res, y_res = abs(res[0]), abs(res[1])
+    if max_distance is None:
+        max_distance = MAX_CELLS * max(x_res, y_res)
+    halo_c = int(math.ceil(max_distance / x_res)) + 1
+    halo_r = int(math.ceil(max_distance / y_res)) + 1
+
+    n_filled = n_unfilled = 0
+    for core in blocks(height, width, block_size):
+        c0, r0 = max(0, core.col_off - halo_c), max(0, core.row_off - halo_r)
+        c1 = min(width, core.col_off + core.width + halo_c)
+        r1 = min(height, core.row_off + core.height + halo_r)
+        arr = read(Window(c0, r0, c1 - c0, r1 - r0))
+
+        gaps = (arr == nodata) | ~np.isfinite(arr)
+        cr, cc = core.row_off - r0, core.col_off - c0
+        core_slice = (slice(cr, cr + core.height), slice(cc, cc + core.width))
+
+        filled = np.where(gaps, NODATA, arr)[core_slice]
+        flag = np.zeros(filled.shape, dtype='uint8')
+
+        gap_rows, gap_cols = np.nonzero(gaps[core_slice])
+        if len(gap_rows) > 0 and not gaps.all():
+            src_rows, src_cols = np.nonzero(~gaps)
+            values = idw(gap_rows + cr, gap_cols + cc, src_rows, src_cols, arr[src_rows, src_cols], x_res, y_res,
+                         max_distance, n_neighbours, power)
+            ok = np.isfinite(values)
+            filled[gap_rows[ok], gap_cols[ok]] = values[ok]
+            flag[gap_rows[ok], gap_cols[ok]] = 1
+            n_filled += int(ok.sum())
+            n_unfilled += int((~ok).sum())
+        else:
+            n_unfilled += len(gap_rows)
+
+        write(filled, flag, core)
+
+    return n_filled, n_unfilled
+
+
+def idw(gap_rows, gap_cols, src_rows, src_cols, src_values, x_res, y_res, max_distance, n_neighbours, power):
+    """IDW value of each gap cell from its n_neighbours nearest valid cells within max_distance (nan if none). Cells
+    tied at the n_neighbours-th distance are all used and distances come from whole cell offsets, so the result does
+    not depend on where the block starts."""
+    n_src = len(src_rows)
+    tree = cKDTree(np.column_stack([src_rows * y_res, src_cols * x_res]))
+    pts = np.column_stack([gap_rows * y_res, gap_cols * x_res])
+    bound = max_distance * (1 + 1e-9)
+
+    k = min(n_neighbours + 4, n_src)
+    idx = np.full((len(pts), k), n_src)
+    todo = np.arange(len(pts))
+    while len(todo) > 0:
+        _, i = tree.query(pts[todo], k=k, distance_upper_bound=bound, workers=-1)
+        i = i.reshape(len(todo), k)
+        if idx.shape[1] < k:
+            idx = np.pad(idx, ((0, 0), (0, k - idx.shape[1])), constant_values=n_src)
+        idx[todo, :k] = i
+
+        # re-query with more neighbours where the tie at the n-th distance may run past the last one returned
+        d = cell_distance(gap_rows[todo], gap_cols[todo], src_rows, src_cols, i, x_res, y_res)
+        d_n = np.sort(d, axis=1)[:, min(n_neighbours, k) - 1]
+        more = np.isfinite(d[:, -1]) & (d[:, -1] <= d_n * (1 + 1e-9)) & (k < n_src)
+        todo = todo[more]
+        k = min(2 * k, n_src)
+
+    d = cell_distance(gap_rows, gap_cols, src_rows, src_cols, idx, x_res, y_res)
+    order = np.lexsort((np.where(idx < n_src, idx, n_src), d), axis=1)
+    d = np.take_along_axis(d, order, axis=1)
+    idx = np.take_along_axis(idx, order, axis=1)
+
+    n = min(n_neighbours, d.shape[1])
+    use = np.isfinite(d) & (d <= d[:, n - 1:n] * (1 + 1e-9)) & (d <= bound)
+    with np.errstate(divide='ignore'):
+        weights = np.where(use, 1.0 / np.maximum(d, 1e-12) ** power, 0.0)
+    vals = np.where(use, np.asarray(src_values, dtype='float64')[np.minimum(idx, n_src - 1)], 0.0)
+
+    total = weights.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total > 0, (weights * vals).sum(axis=1) / total, np.nan)
+
+
+def cell_distance(gap_rows, gap_cols, src_rows, src_cols, idx, x_res, y_res):
+    """Distance from each gap cell to its candidate source cells (inf for missing candidates)"""
+    n_src = len(src_rows)
+    valid = idx < n_src
+    safe = np.minimum(idx, n_src - 1)
+    dr = (src_rows[safe] - gap_rows[:, None]) * y_res
+    dc = (src_cols[safe] - gap_cols[:, None]) * x_res
+    return np.where(valid, np.sqrt(dr * dr + dc * dc), np.inf)
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
@@ -0,0 +1,146 @@
+# Module with fused kernels for the robust LoD and the threshold and weighted DEMs of difference.
+# Each block is computed in float32 into preallocated output arrays. If numba is installed a compiled single pass loop
+# is used, otherwise the same sums are done with in-place NumPy ufuncs on a small set of reusable scratch arrays.
+# dem_of_diff.get_dod and get_weight_dod are the reference versions of these calculations.
+
+import numpy as np
+
+try:
+    import numba  # optional - compiles the per-cell loop
+except ImportError:
+    numba = None
+
+NODATA = -999
+WEIGHT_T = 1.96  # the weighted method scales the LoD to a 95% LoD
+METHODS = ('threshold', 'weighted')
+
+
+class LodWorkspace:
+    """Output and scratch arrays for one block shape - reused between blocks of the same shape"""
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.dod = np.empty(shape, dtype='float32')
+        self.lod = np.empty(shape, dtype='float32')
+        self.diff = np.empty(shape, dtype='float32')
+        self.tmp = np.empty(shape, dtype='float32')
+        self.tmp2 = np.empty(shape, dtype='float32')
+        self.mask = np.empty(shape, dtype=bool)
+        self.mask2 = np.empty(shape, dtype=bool)
+
+
+def lod_dod(a, b, c, d, e, f, reg_error, t_value, method, workspace=None):
+    """Robust LoD, DoD and raw difference for one block - a-f as in dem_of_diff.deom_od.run_raster_calcs with nan
+    for no data. Returns float32 (dod, lod, diff) arrays held by the workspace."""
+    if method not in METHODS:
+        raise InputError("lod method must be one of: {0}".format(", ".join(METHODS)))
+
+    if workspace is None or workspace.shape != a.shape:
+        workspace = LodWorkspace(a.shape)
+
+    if numba is not None:
+        _lod_dod_jit(a.ravel(), b.ravel(), c.ravel(), d.ravel(), e.ravel(), f.ravel(), float(reg_error),
+                     float(t_value), method == 'weighted', workspace.dod.ravel(), workspace.lod.ravel(),
+                     workspace.diff.ravel())
+    else:
+        _lod_dod_numpy(a, b, c, d, e, f, reg_error, t_value, method, workspace)
+
+    return workspace.dod, workspace.lod, workspace.diff
+
+
+def _lod_dod_numpy(a, b, c, d, e, f, reg_error, t_value, method, ws):
+    lod, diff, dod, tmp, tmp2 = ws.lod, ws.diff, ws.dod, ws.tmp, ws.tmp2
+    mask, mask2 = ws.mask, ws.mask2
+
+    # lod = t * ((a + c)**2 + (d + f)**2)**0.5 + g
+    np.add(a, c, out=lod, casting='unsafe')
+    np.square(lod, out=lod)
+    np.add(d, f, out=tmp, casting='unsafe')
+    np.square(tmp, out=tmp)
+    lod += tmp
+    np.sqrt(lod, out=lod)
+    lod *= np.float32(t_value)
+    lod += np.float32(reg_error)
+
+    np.subtract(e, b, out=diff, casting='unsafe')
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if method == 'threshold':
+            # beyond the LoD: shrink the change towards zero by the LoD
+            np.abs(diff, out=tmp)
+            np.greater(tmp, lod, out=mask)
+            np.copysign(lod, diff, out=tmp)
+            np.subtract(diff, tmp, out=dod)
+        else:
+            # inside the 95% LoD: diff * |diff| / LoD95 * 0.5, beyond it: diff -/+ LoD95 * 0.5
+            np.multiply(lod, np.float32(WEIGHT_T), out=tmp)
+            np.abs(diff, out=tmp2)
+            np.less(tmp2, tmp, out=mask)
+            np.greater(tmp2, tmp, out=mask2)
+
+            tmp2 *= diff
+            tmp2 /= tmp
+            tmp2 *= np.float32(0.5)
+            np.copyto(dod, tmp2)
+
+            tmp *= np.float32(0.5)
+            np.copysign(tmp, diff, out=tmp)
+            np.subtract(diff, tmp, out=tmp)
+            np.copyto(dod, tmp, where=mask2)
+
+            np.logical_or(mask, mask2, out=mask)
+
+    # no change where the difference is zero, equal to the LoD or the LoD is unknown
+    np.not_equal(diff, 0, out=mask2)
+    np.logical_and(mask, mask2, out=mask)
+    np.logical_not(mask, out=mask)
+    np.copyto(dod, 0, where=mask)
+
+    np.isnan(a, out=mask)
+    for arr in (b, d, e):
+        np.isnan(arr, out=mask2)
+        np.logical_or(mask, mask2, out=mask)
+    np.copyto(dod, NODATA, where=mask)
+
+
+if numba is not None:
+    @numba.njit(cache=True, nogil=True)
+    def _lod_dod_jit(a, b, c, d, e, f, g, t, weighted, dod, lod, diff):
+        half = np.float32(0.5)
+        for i in range(a.shape[0]):
+            ac = np.float32(a[i] + c[i])
+            df = np.float32(d[i] + f[i])
+            l = np.float32(np.float32(t) * np.float32(np.sqrt(np.float32(ac * ac + df * df))) + np.float32(g))
+            dz = np.float32(e[i] - b[i])
+            lod[i] = l
+            diff[i] = dz
+
+            out = np.float32(0)
+            if np.isnan(a[i]) or np.isnan(b[i]) or np.isnan(d[i]) or np.isnan(e[i]):
+                out = np.float32(NODATA)
+            elif weighted:
+                l95 = np.float32(l * np.float32(WEIGHT_T))
+                adz = abs(dz)
+                if adz < l95 and dz != 0:
+                    out = np.float32(np.float32(adz * dz) / l95) * half
+                elif adz > l95 and dz != 0:
+                    out = dz - np.float32(np.copysign(l95 * half, dz))
+            elif abs(dz) > l and dz != 0:
+                out = dz - np.float32(np.copysign(l, dz))
+            dod[i] = out
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
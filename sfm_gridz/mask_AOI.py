@@ -1,41 +1,145 @@
-import rasterio
-from rasterio.mask import mask
+# Module to mask rasters to an area of interest (AOI) polygon file - cells outside every polygon are set to -999.
+# The AOI is read once per file and rasterised once per grid, both are cached so masking a run of rasters with the
+# same AOI and grid (DSM, precision maps, DoD...) only pays for it the first time. Rasters are masked window by window
+# and only rewritten if they need cropping to the AOI.
+
+import os
 import json
-import geopandas as gpd
 import warnings
-import os
+from collections import OrderedDict
+import numpy as np
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+import geopandas as gpd
+
+NODATA = -999
+BLOCK_ROWS = 1024  # rows read and written at once when masking a raster
+MAX_CACHED = 8  # AOI geometries / rasterised masks kept in memory
+
+_geom_cache = OrderedDict()
+_mask_cache = OrderedDict()
 
 
 def mask_it(raster, shp_path, epsg):
+    """Mask the raster file to the AOI in shp_path, cropping it to the extent of the AOI if it is smaller"""
+    print('masking raster...')
+    with rasterio.open(raster, 'r') as src:
+        outside = aoi_mask(shp_path, epsg, src.transform, src.shape)
+        window = crop_window(outside)
+        meta = src.profile
 
-    aoi = gpd.read_file(shp_path)
+    if window is None:
+        with rasterio.open(raster, 'r+') as dest:
+            mask_windows(dest, dest, outside, Window(0, 0, meta['width'], meta['height']))
+        return
 
-    if epsg is None:
-        warnings.warn("No CRS set for mask - if alignment issues occur set a CRS to the feature")
-    elif aoi.crs != epsg:
-        warnings.warn("CRS mismatch - reprojecting feature geometry to match raster CRS")
-        aoi = aoi.to_crs(epsg)
+    meta.update({"height": int(window.height), "width": int(window.width),
+                 "transform": rasterio.windows.transform(window, meta['transform'])})
 
-    geom = getFeatures(gdf=aoi)
+    tmp_path = raster + '.mask.tif'
+    with rasterio.open(raster, 'r') as src, rasterio.open(tmp_path, 'w', **meta) as dest:
+        mask_windows(src, dest, outside, window)
+    os.replace(tmp_path, raster)
 
-    with rasterio.open(raster, 'r') as src:
-        print('masking raster...')
-        out_image, out_transform = mask(src, geom, crop=True, invert=False, nodata=-999, all_touched=True)
 
-        out_meta = src.meta
+def mask_arrays(arrays, shp_path, epsg, transform):
+    """Mask in-memory 2D arrays on the grid transform before they are written. Returns the arrays, cropped to the AOI
+    if it is smaller, and their transform."""
+    outside = aoi_mask(shp_path, epsg, transform, arrays[0].shape)
+    window = crop_window(outside)
+    if window is not None:
+        outside = outside[window.toslices()]
+        arrays = [arr[window.toslices()] for arr in arrays]
+        transform = rasterio.windows.transform(window, transform)
+
+    for arr in arrays:
+        arr[outside] = NODATA
+    return arrays, transform
+
+
+def mask_windows(src, dest, outside, window):
+    """Copy window of src to dest (starting at dest row 0) in blocks of BLOCK_ROWS rows with cells outside the AOI
+    set to no data"""
+    col_off, row_off = int(window.col_off), int(window.row_off)
+    width, height = int(window.width), int(window.height)
+
+    for row in range(0, height, BLOCK_ROWS):
+        n_rows = min(BLOCK_ROWS, height - row)
+        block = src.read(window=Window(col_off, row_off + row, width, n_rows))
+        block[:, outside[row_off + row:row_off + row + n_rows, col_off:col_off + width]] = NODATA
+        dest.write(block, window=Window(0, row, width, n_rows))
+
 
-    out_meta.update({"height": out_image.shape[1],
-                     "width": out_image.shape[2],
-                     "transform": out_transform})
+def aoi_mask(shp_path, epsg, transform, shape):
+    """Boolean array of the grid (transform, shape) - True for cells outside all of the AOI polygons. Cells touched
+    by a polygon count as inside."""
+    geoms, stamp = aoi_geometries(shp_path, epsg)
+    key = (stamp, tuple(transform)[:6], tuple(shape))
 
-    if os.path.exists(raster):
-        os.remove(raster)
-    with rasterio.open(raster, "w", **out_meta) as dest:
-        dest.write(out_image)
+    if key not in _mask_cache:
+        _mask_cache[key] = geometry_mask(geoms, out_shape=tuple(shape), transform=transform, all_touched=True)
+        _trim(_mask_cache)
+    _mask_cache.move_to_end(key)
+
+    return _mask_cache[key]
+
+
+def aoi_geometries(shp_path, epsg):
+    """All of the AOI geometries in the raster CRS and a key for them - read and reprojected once per file"""
+    path = os.path.abspath(shp_path)
+    stamp = (path, os.stat(path).st_mtime_ns, json.dumps(epsg, sort_keys=True, default=str))
+
+    if stamp not in _geom_cache:
+        aoi = gpd.read_file(shp_path)
+
+        if epsg is None:
+            warnings.warn("No CRS set for mask - if alignment issues occur set a CRS to the feature")
+        elif aoi.crs != epsg:
+            warnings.warn("CRS mismatch - reprojecting feature geometry to match raster CRS")
+            aoi = aoi.to_crs(epsg)
+
+        _geom_cache[stamp] = getFeatures(gdf=aoi)
+        _trim(_geom_cache)
+    _geom_cache.move_to_end(stamp)
+
+    return _geom_cache[stamp], stamp
+
+
+def crop_window(outside):
+    """Window of the cells inside the AOI or None if the AOI covers the whole grid extent"""
+    rows = np.flatnonzero(~outside.all(axis=1))
+    cols = np.flatnonzero(~outside.all(axis=0))
+    if len(rows) == 0:
+        raise InputError("The mask does not overlap the raster - check the AOI file and CRS.")
+
+    window = Window(int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1))
+    if window.width == outside.shape[1] and window.height == outside.shape[0]:
+        return None
+    return window
+
+
+def _trim(cache):
+    while len(cache) > MAX_CACHED:
+        cache.popitem(last=False)
 
 
 def getFeatures(gdf):
     """Function to parse features from GeoDataFrame in such a manner that rasterio wants them"""
-    return [json.loads(gdf.to_json())['features'][0]['geometry']]
+    return [feature['geometry'] for feature in json.loads(gdf.to_json())['features'] if feature['geometry'] is not None]
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
 
+    Attributes:
+        message -- explanation of the error
+    """
 
+    def __init__(self, message):
+        self.message = message
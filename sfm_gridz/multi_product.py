@@ -0,0 +1,160 @@
+# Module to make all the raster products of a survey in one pass - the dense cloud and the precision cloud are each
+# read once and every requested statistic is gridded onto the same aligned grid with bin_grid.
+
+import os
+import warnings
+from datetime import datetime
+import rasterio
+from sfm_gridz import bin_grid
+from sfm_gridz import raster_profile
+from sfm_gridz.DSM import Dsm
+from sfm_gridz.precision_map import PrRas
+from sfm_gridz import mask_AOI
+
+Z_PRODUCTS = ('mean', 'stdev', 'min', 'max', 'count')
+PREC_PRODUCTS = ('xerr', 'yerr', 'zerr')
+
+
+def grid_products(point_cloud, prec_point_cloud, out_raster, resolution, products, window_size, epsg, bounds, mask,
+                  separate, profile=None):
+    startTime = datetime.now()
+
+    for p in products:
+        if p not in Z_PRODUCTS + PREC_PRODUCTS:
+            raise InputError("products must be drawn from: {0}".format(", ".join(Z_PRODUCTS + PREC_PRODUCTS)))
+    if prec_point_cloud is None and any(p in PREC_PRODUCTS for p in products):
+        raise InputError("a prec_point_cloud is needed for the xerr, yerr and zerr products")
+
+    mp_process = MultiProduct(point_cloud, prec_point_cloud, out_raster, resolution, products, window_size, epsg,
+                              bounds, mask, separate, profile)
+    mp_process.read_clouds()
+    mp_process.Run()
+    mp_process.report()
+
+    print("Total Time: " + str(datetime.now() - startTime))  # get the time
+    return mp_process
+
+
+class MultiProduct:
+
+    def __init__(self, real_pc, prec_pc, ras_path, ras_res, products, window, epsg, bbox, maskit, separate,
+                 profile=None):
+        self.rpc = real_pc
+        self.ppc = prec_pc
+        self.path = ras_path
+        self.res = ras_res
+        self.products = list(products)
+        self.wind = window
+        self.bounds = bbox
+        self.mask = maskit
+        self.separate = separate
+        self.profile = profile
+
+        self.dsm = Dsm(real_pc, None, ras_res, window, epsg, bbox, None, 'numpy')
+        self.dsm.get_reader()
+        self.prras = None if prec_pc is None else PrRas(prec_pc, None, ras_res, 'z', bbox, epsg, None, 'numpy')
+
+        self.points = None
+        self.paths = []  # one path per product if separate else the single multi-band raster
+        self.timings = {}
+        self.bytes_read = 0
+
+    def read_clouds(self):
+        """Read each input cloud once"""
+        t = datetime.now()
+        self.points = self.dsm.read_points()
+        self.bytes_read += os.path.getsize(self.rpc)
+
+        if self.prras is not None:
+            self.prras.readPC_xyzerr()
+            self.bytes_read += os.path.getsize(self.ppc)
+            if self.res < self.prras.min_res:
+                warnings.warn("Grid resolution is finer than the mean xy error + stdev of the precision cloud:   "
+                              "{0}".format(self.prras.min_res), Warning)
+
+        self.timings['read'] = datetime.now() - t
+
+    def Run(self):
+        print("Generating raster products: {0}...".format(", ".join(self.products)))
+
+        t = datetime.now()
+        grid = bin_grid.grid_from_bounds(self.points['X'], self.points['Y'], self.res, self.bounds)
+
+        bands = {}
+        z_stats = [p for p in self.products if p in Z_PRODUCTS]
+        if len(z_stats) > 0:
+            bands.update(bin_grid.bin_points(self.points['X'], self.points['Y'], self.points['Z'], grid,
+                                             stats=z_stats, window_size=self.wind))
+
+        for dim in [p for p in self.products if p in PREC_PRODUCTS]:
+            pcdata = self.prras.pcdata
+            bands[dim] = bin_grid.bin_points(pcdata['x'], pcdata['y'], pcdata[dim], grid, stats=('mean',))['mean']
+
+        self.timings['grid'] = datetime.now() - t
+
+        t = datetime.now()
+        crs = None if len(self.dsm.epsg_code) == 0 else self.dsm.epsg_code
+
+        meta = raster_profile.apply(bin_grid.raster_meta(grid, crs, 1), self.profile)
+        if self.mask is not None:
+            # masked and cropped in memory so the rasters are only written once
+            names = list(bands)
+            arrays, meta['transform'] = mask_AOI.mask_arrays([bands[p] for p in names], self.mask,
+                                                             None if crs is None else crs.data, grid.transform)
+            bands = dict(zip(names, arrays))
+            meta['height'], meta['width'] = arrays[0].shape
+
+        if self.separate is True:
+            stem, ext = os.path.splitext(self.path)
+            self.paths = ["{0}_{1}{2}".format(stem, p, ext) for p in self.products]
+            for path, p in zip(self.paths, self.products):
+                self.write(path, [p], bands, meta)
+        else:
+            self.paths = [self.path]
+            self.write(self.path, self.products, bands, meta)
+
+        self.timings['write'] = datetime.now() - t
+
+        if self.bounds is None:
+            self.bounds = grid.bounds
+
+    def write(self, path, products, bands, meta):
+        meta = dict(meta, count=len(products))
+        with rasterio.open(path, 'w', **meta) as dest:
+            for i, p in enumerate(products, start=1):
+                dest.write(bands[p].astype(meta['dtype']), i)
+                dest.set_band_description(i, p)
+
+        raster_profile.finalise(path, self.profile)
+
+    def report(self):
+        """Print the reads of this run and an estimate of the reads of separate dsm and precision calls - the measured
+        saving is given by Examples/benchmark_products.py"""
+        n_prec = len([p for p in self.products if p in PREC_PRODUCTS])
+        dense_size = os.path.getsize(self.rpc)
+        prec_size = 0 if self.ppc is None else os.path.getsize(self.ppc)
+        # each precision() call (pdal engine) parses the cloud with loadtxt and again with the PDAL text reader
+        separate_bytes = dense_size + prec_size * 2 * n_prec
+
+        print("Cloud reads: 1 dense + {0} precision (separate dsm/precision calls: 1 dense + {1} precision)".format(
+            0 if self.ppc is None else 1, 2 * n_prec))
+        print("Data read: {0:.1f} MB (separate calls, estimated: {1:.1f} MB)".format(self.bytes_read / 1024 ** 2,
+                                                                                     separate_bytes / 1024 ** 2))
+        for stage, elapsed in self.timings.items():
+            print("{0} time: {1}".format(stage, elapsed))
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
@@ -0,0 +1,262 @@
+# Module to run a gridz workflow as a pipeline of stages - each stage is one call of sfm_gridz.dsm, precision,
+# fill_gaps, chm, chm_batch, products, difference, difference_batch, m3c2 or attach_precision. Stages name the
+# stages they depend on through '@stage.attribute' strings in their parameters (e.g. bounds='@dsm1.bounds',
+# dsm_file='@dsm1.path'), which makes a DAG. Stages run in a process
+# pool as soon as the stages they depend on are done, and a stage is skipped if its parameters, the contents of its
+# input files and the stages it depends on are unchanged since it last ran and its outputs still exist. The state is
+# kept in a json file next to the outputs.
+
+import os
+import json
+import hashlib
+from datetime import datetime
+from timeit import default_timer as timer
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+KINDS = ('dsm', 'precision', 'fill_gaps', 'chm', 'chm_batch', 'products', 'difference', 'difference_batch', 'm3c2',
+         'attach_precision')
+
+# parameters holding output paths for each kind of stage
+OUTPUT_KEYS = {'dsm': ('out_raster',), 'precision': ('out_raster',), 'fill_gaps': ('out_raster',),
+               'chm': ('chm_save_name',), 'chm_batch': ('chm_save_names',),
+               'products': ('out_raster',), 'difference': ('out_ras',), 'difference_batch': ('jobs',),
+               'm3c2': ('out_cloud',), 'attach_precision': ('out_cloud',)}
+
+# attributes of the returned class objects that later stages can refer to
+RESULT_ATTRS = ('path', 'ras_out_path', 'paths', 'bounds', 'res', 'pr_dim')
+
+HASH_BLOCK = 16 * 1024 ** 2
+
+# files read together with an input file - a change to any of them changes the input
+SIDECARS = {'.shp': ('.shx', '.dbf', '.prj', '.cpg')}
+
+
+class Pipeline:
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.stages = {}  # name: (kind, params) in the order they were added
+        self.timings = {}
+        self.skipped = []
+        self.results = {}
+
+        self.state = {"stages": {}, "files": {}}
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                self.state = json.load(f)
+
+    @classmethod
+    def from_config(cls, config_path, state_file=None):
+        """Pipeline from a json file: {"stages": {name: {"kind": kind, "params": {...}}, ...}}"""
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+        if state_file is None:
+            state_file = os.path.splitext(config_path)[0] + '_state.json'
+
+        pipe = cls(state_file)
+        for name, stage in config["stages"].items():
+            pipe.add(name, stage["kind"], **stage["params"])
+        return pipe
+
+    def add(self, name, kind, **params):
+        """Add a stage - params are the keyword arguments of the sfm_gridz function for the kind of stage"""
+        if kind not in KINDS:
+            raise PipelineError("stage kind must be one of: {0}".format(", ".join(KINDS)))
+        if name in self.stages:
+            raise PipelineError("there is already a stage called '{0}'".format(name))
+        for dep in dependencies(params):
+            if dep not in self.stages:
+                raise PipelineError("stage '{0}' refers to '{1}' which has not been added".format(name, dep))
+
+        self.stages[name] = (kind, params)
+        return name
+
+    def stage_key(self, name, keys):
+        """Hash of the stage kind, parameters, input file contents and the keys of the stages it depends on"""
+        kind, params = self.stages[name]
+        files = {}
+        for value in walk(params):
+            if isinstance(value, str) and not value.startswith('@') and os.path.isfile(value) \
+                    and value not in outputs(kind, params):
+                for path in [value] + sidecars(value):
+                    files[path] = self.file_hash(path)
+
+        deps = {dep: keys[dep] for dep in dependencies(params)}
+        content = json.dumps({"kind": kind, "params": params, "files": files, "deps": deps}, sort_keys=True,
+                             default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def file_hash(self, path):
+        """Content hash of a file - cached against its size and modification time so unchanged files aren't
+        re-read"""
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        cached = self.state["files"].get(os.path.abspath(path))
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b''):
+                sha.update(block)
+        self.state["files"][os.path.abspath(path)] = [stamp, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def up_to_date(self, name, key):
+        kind, params = self.stages[name]
+        done = self.state["stages"].get(name)
+        return done is not None and done["key"] == key and all(os.path.exists(p) for p in outputs(kind, params))
+
+    def run(self, n_workers=None, force=False):
+        """Run the stages - returns {stage name: attributes of the result (path, bounds...)}"""
+        print("running pipeline of {0} stages...".format(len(self.stages)))
+        start = datetime.now()
+
+        keys = {}
+        waiting = dict(self.stages)
+        running = {}
+
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            while len(waiting) > 0 or len(running) > 0:
+                for name in list(waiting):
+                    kind, params = waiting[name]
+                    if any(dep not in self.results for dep in dependencies(params)):
+                        continue
+
+                    del waiting[name]
+                    keys[name] = self.stage_key(name, keys)
+                    if force is False and self.up_to_date(name, keys[name]):
+                        print("{0}: up to date - skipped".format(name))
+                        self.results[name] = self.state["stages"][name]["result"]
+                        self.skipped.append(name)
+                        continue
+
+                    print("{0}: started".format(name))
+                    running[pool.submit(run_stage, kind, resolve(params, self.results))] = name
+
+                if len(running) == 0:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for job in done:
+                    name = running.pop(job)
+                    result, elapsed = job.result()
+                    self.results[name] = result
+                    self.timings[name] = elapsed
+                    self.state["stages"][name] = {"key": keys[name], "result": result}
+                    self.save_state()
+                    print("{0}: done in {1:.1f}s".format(name, elapsed))
+
+        self.save_state()
+        self.report()
+        print("Total Time: " + str(datetime.now() - start))
+        return self.results
+
+    def save_state(self):
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp_path, self.state_file)
+
+    def report(self):
+        for name in self.stages:
+            if name in self.timings:
+                print("{0}: {1:.1f}s".format(name, self.timings[name]))
+            elif name in self.skipped:
+                print("{0}: skipped".format(name))
+        print("ran {0} stages, skipped {1}, stage time {2:.1f}s".format(len(self.timings), len(self.skipped),
+                                                                         sum(self.timings.values())))
+
+
+def run_stage(kind, params):
+    """Worker process - run one stage and return the picklable attributes of its result and the time taken"""
+    import sfm_gridz
+
+    start = timer()
+    out = getattr(sfm_gridz, kind)(**params)
+    elapsed = timer() - start
+
+    result = {}
+    for attr in RESULT_ATTRS:
+        if hasattr(out, attr):
+            result[attr] = json.loads(json.dumps(getattr(out, attr), default=list))
+    return result, elapsed
+
+
+def sidecars(path):
+    """Existing sidecar files of path (e.g. the .shx, .dbf, .prj and .cpg of a shapefile)"""
+    stem, ext = os.path.splitext(path)
+    found = []
+    for side in SIDECARS.get(ext.lower(), ()):
+        for candidate in (stem + side, stem + side.upper()):
+            if os.path.isfile(candidate) and candidate not in found:
+                found.append(candidate)
+                break
+    return found
+
+
+def walk(value):
+    """Every leaf value of nested params"""
+    if isinstance(value, dict):
+        for v in value.values():
+            yield from walk(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            yield from walk(v)
+    else:
+        yield value
+
+
+def dependencies(params):
+    return sorted({v[1:].split('.')[0] for v in walk(params) if isinstance(v, str) and v.startswith('@')})
+
+
+def outputs(kind, params):
+    paths = []
+    for key in OUTPUT_KEYS[kind]:
+        value = params.get(key)
+        if kind == 'difference_batch' and value is not None:
+            paths.extend(job[3] for job in value)
+        elif kind == 'chm_batch' and value is not None:
+            paths.extend(v for v in value if v is not None)
+        elif value is not None:
+            paths.append(value)
+    return paths
+
+
+def resolve(value, results):
+    """Replace '@stage.attribute' strings with the attribute of the stage's result - '@stage.paths.0' for one item of
+    a list attribute"""
+    if isinstance(value, dict):
+        return {k: resolve(v, results) for k, v in value.items()}
+    if isinstance(value, list):
+        return [resolve(v, results) for v in value]
+    if isinstance(value, tuple):
+        return tuple(resolve(v, results) for v in value)
+    if isinstance(value, str) and value.startswith('@'):
+        stage, _, attr = value[1:].partition('.')
+        attr, _, item = attr.partition('.')
+        if attr not in results[stage]:
+            raise PipelineError("stage '{0}' has no result attribute '{1}'".format(stage, attr))
+        if item != '':
+            return results[stage][attr][int(item)]
+        if attr == 'bounds':
+            return tuple(list(b) for b in results[stage][attr])  # ([xmin, xmax], [ymin, ymax]) as the dsm returns
+        return results[stage][attr]
+    return value
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class PipelineError(Error):
+    """Exception raised for errors in the pipeline definition.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
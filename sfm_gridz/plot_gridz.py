@@ -1,9 +1,28 @@
+import os
+import math
 import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 import numpy as np
 import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
 from matplotlib import pyplot as plt
 from matplotlib import rc
 from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
+from sfm_gridz.prec_cloud import load_prec_cloud
+
+MAX_SAMPLE = 1000000  # cells sampled to set the colour range when v_range is None
+MAX_CACHED = 16  # decimated band reads kept in memory
+HIST_ROWS = 1024  # raster rows per block when streaming histogram counts
+HIST_CHUNK = 1000000  # cloud points per chunk when streaming histogram counts
+DEFAULT_BINS = 10  # as matplotlib's hist
+
+# raster map functions that can be used in render_figures specs
+PLOTS = ('plot_dsm', 'plot_chm', 'plot_roughness', 'plot_dtm', 'plot_precision', 'plot_dem_of_diff', 'plot_lod')
+
+_array_cache = OrderedDict()
 
 def set_style():
     plt.style.use('bmh')
@@ -15,22 +34,18 @@ def set_style():
 
 def plot_raster(raster, band, cmap, save_path, dpi, v_range, title, obs, mpl_fig, mpl_ax,
                 legend, gdf, gdf_column, gdf_cmap, gdf_legend, gdf_legend_kwds, gdf_alpha,
-                linestyle, leg_orient, leg_pos, title_pos):
+                linestyle, leg_orient, leg_pos, title_pos, bounds=None):
     # ylabel = kwargs.get('ylabel', None)
 
     set_style()
 
     with rasterio.open(raster) as ras:
 
-        arr = ras.read(band)
-
-        arr[arr == -999] = np.nan
+        window = plot_window(ras, bounds)
+        height, width = int(window.height), int(window.width)
+        ext = ras.window_bounds(window)
 
-        if v_range is None:
-            v_range = (np.nanmin(arr), np.nanmax(arr))
-
-        sh = np.shape(arr)
-        fig_w = round(8/(sh[0]/sh[1]))*1.5
+        fig_w = round(8/(height/width))*1.5
 
         if (mpl_ax is None) or (mpl_fig is None):
             fig, ax = plt.subplots(figsize=(fig_w, 8))
@@ -38,8 +53,14 @@ def plot_raster(raster, band, cmap, save_path, dpi, v_range, title, obs, mpl_fig
             fig = mpl_fig
             ax = mpl_ax
 
-        img = ax.imshow(arr, vmin=v_range[0], vmax=v_range[1],
-                        extent=(ras.bounds[0], ras.bounds[2], ras.bounds[1], ras.bounds[3]))
+        # only as many cells as the axes can show are read - from the overviews if the raster has them
+        out_shape = display_shape(fig, ax, dpi if save_path is not None else None, height, width)
+        arr = read_masked(ras, band, window, out_shape)
+
+        if v_range is None:
+            v_range = sample_range(arr)
+
+        img = ax.imshow(arr, vmin=v_range[0], vmax=v_range[1], extent=(ext[0], ext[2], ext[1], ext[3]))
         img.set_cmap(cmap)
 
         if gdf is not None:
@@ -97,21 +118,114 @@ def plot_raster(raster, band, cmap, save_path, dpi, v_range, title, obs, mpl_fig
             fig.savefig(fname=save_path, dpi=dpi, format='jpg')
 
 
+def plot_window(ras, bounds):
+    """Window of the raster to plot - all of it or the part within (left, bottom, right, top) bounds"""
+    full = Window(0, 0, ras.width, ras.height)
+    if bounds is None:
+        return full
+    return ras.window(*bounds).round_offsets().round_lengths().intersection(full)
+
+
+def display_shape(fig, ax, dpi, height, width):
+    """(rows, cols) to read so the image has at least one cell per pixel it covers on the axes at the figure dpi (or
+    the save dpi if it is higher) - never more than the raster window. imshow keeps the aspect equal so the image is
+    scaled to fit the limiting side of the axes."""
+    pos = ax.get_position()
+    fig_w, fig_h = fig.get_size_inches()
+    dpi = max(fig.dpi, dpi or 0)
+    px_w = max(1.0, pos.width * fig_w * dpi)
+    px_h = max(1.0, pos.height * fig_h * dpi)
+
+    factor = max(1, int(max(width / px_w, height / px_h)))
+    return int(math.ceil(height / factor)), int(math.ceil(width / factor))
+
+
+def read_masked(ras, band, window, out_shape):
+    """Decimated read of a band as a masked array with -999 masked - no copy is made to mask it. Reads are cached by
+    (path, band, window, decimated shape) so panels and figures showing the same band only read it once. The
+    returned array is shared - don't modify it."""
+    stamp = os.stat(ras.name).st_mtime_ns if os.path.isfile(ras.name) else None
+    key = (os.path.abspath(ras.name), stamp, band, tuple(int(v) for v in window.flatten()), tuple(out_shape))
+
+    if key not in _array_cache:
+        arr = ras.read(band, window=window, out_shape=out_shape, resampling=Resampling.nearest)
+        _array_cache[key] = np.ma.masked_equal(arr, -999, copy=False)
+        while len(_array_cache) > MAX_CACHED:
+            _array_cache.popitem(last=False)
+    _array_cache.move_to_end(key)
+
+    return _array_cache[key]
+
+
+def sample_range(arr):
+    """(min, max) of a regular sample of at most MAX_SAMPLE cells"""
+    step = max(1, int(math.sqrt(arr.size / MAX_SAMPLE)))
+    sample = np.ma.compressed(arr[::step, ::step])
+    sample = sample[np.isfinite(sample)]
+    if len(sample) == 0:
+        return 0, 1
+    return float(sample.min()), float(sample.max())
+
+
+def render_figures(specs, n_workers=None):
+    """Render a list of figure specs (see render_figure) to file in a pool of n_workers processes with the
+    non-interactive Agg backend - nothing is shown. Returns the saved paths."""
+    startTime = datetime.now()
+    print("rendering {0} figures...".format(len(specs)))
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=use_agg) as pool:
+        paths = list(pool.map(render_figure, specs))
+
+    print("Total Time: " + str(datetime.now() - startTime))  # get the time
+    return paths
+
+
+def use_agg():
+    plt.switch_backend('Agg')
+
+
+def render_figure(spec):
+    """Draw and save one figure. spec is a dict:
+        save_path - output image path (required)
+        figsize, nrows, ncols, sharex, sharey - as plt.subplots [Default: (8, 8), 1, 1, False, False]
+        tight_layout - rect for fig.tight_layout or None [Default: None]
+        dpi, format - as fig.savefig [Default: 300, 'png']
+        hide_ticks - remove the ticks from every axes [Default: False]
+        panels - list of dicts: {"plot": one of PLOTS, "raster": path, "ax": index of the axes (counted across the
+                 rows) [Default: 0], any other keyword arguments of the plot function}"""
+    dpi = spec.get('dpi', 300)
+    fig, axs = plt.subplots(spec.get('nrows', 1), spec.get('ncols', 1), sharex=spec.get('sharex', False),
+                            sharey=spec.get('sharey', False), figsize=spec.get('figsize', (8, 8)), squeeze=False)
+    fig.set_dpi(dpi)  # so the rasters are read at the resolution they are saved at
+    axs = axs.flatten()
+    if spec.get('tight_layout') is not None:
+        fig.tight_layout(rect=spec['tight_layout'])
+
+    for panel in spec['panels']:
+        panel = dict(panel)
+        plot = panel.pop('plot')
+        if plot not in PLOTS:
+            raise InputError("panel plot must be one of: {0}".format(", ".join(PLOTS)))
+        globals()[plot](panel.pop('raster'), mpl_fig=fig, mpl_ax=axs[panel.pop('ax', 0)], **panel)
+
+    if spec.get('hide_ticks', False) is True:
+        plt.setp(fig.get_axes(), xticks=[], yticks=[])
+
+    fig.savefig(fname=spec['save_path'], dpi=dpi, format=spec.get('format', 'png'))
+    plt.close(fig)
+    return spec['save_path']
+
+
 def plot_hist(raster, band, v_range, n_bins, colour, density, title, xlabel, save_path, dpi):
     set_style()
 
     with rasterio.open(raster) as ras:
-        arr = ras.read(band)
-
-        arr[arr == -999] = np.nan
-
-        if v_range is None:
-            v_range = (np.nanmin(arr), np.nanmax(arr))
+        # the band is streamed in blocks - once for the range if v_range is None and once for the counts
+        counts, edges = stream_histogram(lambda: raster_blocks(ras, band), n_bins, v_range)
 
         fig, ax = plt.subplots(figsize=(8, 7))
 
-        img = ax.hist(x=arr[~np.isnan(arr)].flatten(), bins=n_bins, color=colour, histtype='bar',
-                range=v_range, density=density, edgecolor='black', linewidth=0.8)
+        img = plot_counts(ax, counts, edges, colour, density)
         plt.title(title)
 
         if ras.crs.linear_units == 'metre':
@@ -131,6 +245,59 @@ def plot_hist(raster, band, v_range, n_bins, colour, density, title, xlabel, sav
         plt.show()
 
 
+def raster_blocks(ras, band):
+    """The valid values (not -999 or nan) of a band in blocks of HIST_ROWS rows"""
+    for row in range(0, ras.height, HIST_ROWS):
+        arr = ras.read(band, window=Window(0, row, ras.width, min(HIST_ROWS, ras.height - row)))
+        yield arr[(arr != -999) & np.isfinite(arr)]
+
+
+def array_chunks(arrays):
+    """The finite values of 1D arrays (e.g. memory-mapped cloud fields) in chunks of HIST_CHUNK values"""
+    for arr in arrays:
+        for i in range(0, len(arr), HIST_CHUNK):
+            chunk = np.asarray(arr[i:i + HIST_CHUNK])
+            yield chunk[np.isfinite(chunk)]
+
+
+def stream_range(blocks):
+    """(min, max) over an iterable of value blocks"""
+    v_min, v_max = np.inf, -np.inf
+    for b in blocks:
+        if len(b) > 0:
+            v_min = min(v_min, float(b.min()))
+            v_max = max(v_max, float(b.max()))
+    if v_min > v_max:
+        return 0, 1
+    return v_min, v_max
+
+
+def stream_histogram(get_blocks, n_bins, v_range):
+    """Histogram counts and bin edges accumulated block by block so only one block is in memory. get_blocks returns
+    a new iterable of value blocks - it is called twice if v_range is None: a first pass finds the range."""
+    if n_bins is None:
+        n_bins = DEFAULT_BINS
+    if isinstance(n_bins, str):
+        raise InputError("n_bins must be a number of bins or a sequence of bin edges")
+
+    if v_range is None and np.ndim(n_bins) == 0:
+        v_range = stream_range(get_blocks())
+
+    # bins and range are passed on as they are so each block is binned exactly as np.histogram / ax.hist would
+    edges = np.histogram_bin_edges(np.empty(0), bins=n_bins, range=v_range)
+    counts = np.zeros(len(edges) - 1, dtype='int64')
+    for b in get_blocks():
+        counts += np.histogram(b, bins=n_bins, range=v_range)[0]
+
+    return counts, edges
+
+
+def plot_counts(ax, counts, edges, colour, density):
+    """Draw precomputed histogram counts as ax.hist would draw the values"""
+    return ax.hist(x=edges[:-1], bins=edges, weights=counts, color=colour, histtype='bar', density=density,
+                   edgecolor='black', linewidth=0.8)
+
+
 def plot_dsm(dsm_path, **kwargs ):
     save_path = kwargs.get('save_path', None)
     dpi = kwargs.get('dpi', 300)
@@ -151,11 +318,13 @@ def plot_dsm(dsm_path, **kwargs ):
     leg_orient = kwargs.get('leg_orient', 'vertical')
     leg_pos = kwargs.get('leg_pos', 'right')
     title_pos = kwargs.get('title_pos', 'top')
+    bounds = kwargs.get('bounds', None)
 
     plot_raster(raster=dsm_path, band=1, cmap=cmap, save_path=save_path, dpi=dpi, v_range=v_range, title=title,
                 obs=colmap_label, mpl_fig=mpl_fig, mpl_ax=mpl_ax, legend=legend, gdf=gdf, gdf_column=gdf_column,
                 gdf_cmap=gdf_cmap, gdf_legend=gdf_legend, gdf_legend_kwds=gdf_legend_kwds, gdf_alpha=gdf_alpha,
-                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos)
+                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos,
+                bounds=bounds)
 
 
 def plot_chm(chm_path, **kwargs):
@@ -178,11 +347,13 @@ def plot_chm(chm_path, **kwargs):
     leg_orient = kwargs.get('leg_orient', 'vertical')
     leg_pos = kwargs.get('leg_pos', 'right')
     title_pos = kwargs.get('title_pos', 'top')
+    bounds = kwargs.get('bounds', None)
 
     plot_raster(raster=chm_path, band=1, cmap=cmap, save_path=save_path, dpi=dpi, v_range=v_range, title=title,
                 obs=colmap_label, mpl_fig=mpl_fig, mpl_ax=mpl_ax, legend=legend, gdf=gdf, gdf_column=gdf_column,
                 gdf_cmap=gdf_cmap, gdf_legend=gdf_legend, gdf_legend_kwds=gdf_legend_kwds, gdf_alpha=gdf_alpha,
-                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos)
+                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos,
+                bounds=bounds)
 
 
 def plot_roughness(dsm_path, **kwargs ):
@@ -205,11 +376,13 @@ def plot_roughness(dsm_path, **kwargs ):
     leg_orient = kwargs.get('leg_orient', 'vertical')
     leg_pos = kwargs.get('leg_pos', 'right')
     title_pos = kwargs.get('title_pos', 'top')
+    bounds = kwargs.get('bounds', None)
 
     plot_raster(raster=dsm_path, band=2, cmap=cmap, save_path=save_path, dpi=dpi, v_range=v_range, title=title,
                 obs=colmap_label, mpl_fig=mpl_fig, mpl_ax=mpl_ax, legend=legend, gdf=gdf, gdf_column=gdf_column,
                 gdf_cmap=gdf_cmap, gdf_legend=gdf_legend, gdf_legend_kwds=gdf_legend_kwds, gdf_alpha=gdf_alpha,
-                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos)
+                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos,
+                bounds=bounds)
 
 
 def plot_dtm(chm_path, **kwargs ):
@@ -232,11 +405,13 @@ def plot_dtm(chm_path, **kwargs ):
     leg_orient = kwargs.get('leg_orient', 'vertical')
     leg_pos = kwargs.get('leg_pos', 'right')
     title_pos = kwargs.get('title_pos', 'top')
+    bounds = kwargs.get('bounds', None)
 
     plot_raster(raster=chm_path, band=3, cmap=cmap, save_path=save_path, dpi=dpi, v_range=v_range, title=title,
                 obs=colmap_label, mpl_fig=mpl_fig, mpl_ax=mpl_ax, legend=legend, gdf=gdf, gdf_column=gdf_column,
                 gdf_cmap=gdf_cmap, gdf_legend=gdf_legend, gdf_legend_kwds=gdf_legend_kwds, gdf_alpha=gdf_alpha,
-                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos)
+                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos,
+                bounds=bounds)
 
 
 def plot_precision(prec_map_path, **kwargs ):
@@ -260,6 +435,7 @@ def plot_precision(prec_map_path, **kwargs ):
     leg_orient = kwargs.get('leg_orient', 'vertical')
     leg_pos = kwargs.get('leg_pos', 'right')
     title_pos = kwargs.get('title_pos', 'top')
+    bounds = kwargs.get('bounds', None)
 
 
     if fill_gaps is not True or False:
@@ -272,7 +448,8 @@ def plot_precision(prec_map_path, **kwargs ):
     plot_raster(raster=prec_map_path, band=rband, cmap=cmap, save_path=save_path, dpi=dpi, v_range=v_range, title=title,
                 obs=colmap_label, mpl_fig=mpl_fig, mpl_ax=mpl_ax, legend=legend, gdf=gdf, gdf_column=gdf_column,
                 gdf_cmap=gdf_cmap, gdf_legend=gdf_legend, gdf_legend_kwds=gdf_legend_kwds, gdf_alpha=gdf_alpha,
-                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos)
+                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos,
+                bounds=bounds)
 
 
 def plot_dem_of_diff(dem_o_diff_path, **kwargs ):
@@ -296,6 +473,7 @@ def plot_dem_of_diff(dem_o_diff_path, **kwargs ):
     leg_orient = kwargs.get('leg_orient', 'vertical')
     leg_pos = kwargs.get('leg_pos', 'right')
     title_pos = kwargs.get('title_pos', 'top')
+    bounds = kwargs.get('bounds', None)
 
     if method == 'robust':
         b = 1
@@ -310,7 +488,8 @@ def plot_dem_of_diff(dem_o_diff_path, **kwargs ):
     plot_raster(raster=dem_o_diff_path, band=b, cmap=cmap, save_path=save_path, dpi=dpi, v_range=v_range, title=title,
                 obs=colmap_label, mpl_fig=mpl_fig, mpl_ax=mpl_ax, legend=legend, gdf=gdf, gdf_column=gdf_column,
                 gdf_cmap=gdf_cmap, gdf_legend=gdf_legend, gdf_legend_kwds=gdf_legend_kwds, gdf_alpha=gdf_alpha,
-                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos)
+                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos,
+                bounds=bounds)
 
 
 def plot_lod(dem_o_diff_path, **kwargs ):
@@ -333,12 +512,14 @@ def plot_lod(dem_o_diff_path, **kwargs ):
     leg_orient = kwargs.get('leg_orient', 'vertical')
     leg_pos = kwargs.get('leg_pos', 'right')
     title_pos = kwargs.get('title_pos', 'top')
+    bounds = kwargs.get('bounds', None)
 
 
     plot_raster(raster=dem_o_diff_path, band=2, cmap=cmap, save_path=save_path, dpi=dpi, v_range=v_range, title=title,
                 obs=colmap_label, mpl_fig=mpl_fig, mpl_ax=mpl_ax, legend=legend, gdf=gdf, gdf_column=gdf_column,
                 gdf_cmap=gdf_cmap, gdf_legend=gdf_legend, gdf_legend_kwds=gdf_legend_kwds, gdf_alpha=gdf_alpha,
-                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos)
+                linestyle=linestyle, leg_orient=leg_orient, leg_pos=leg_pos, title_pos=title_pos,
+                bounds=bounds)
 
 
 def hist_dsm(dsm_path, **kwargs ):
@@ -381,26 +562,27 @@ def hist_precision(ppc_path, **kwargs):
     dimension = kwargs.get('dimension', 'z')
     xlabel = kwargs.get('x_label', '{0} Precision'.format(dimension))
 
-    ppc_arr = np.loadtxt(fname=ppc_path, skiprows=1)
+    # the cloud is memory-mapped from its sidecar (prec_cloud) and streamed in chunks
+    pcdata = load_prec_cloud(ppc_path)
     if dimension == 'z':
-        ppc_arr = ppc_arr[:, 5]
+        fields = ['zerr']
     elif dimension == 'x':
-        ppc_arr = ppc_arr[:, 3]
+        fields = ['xerr']
     elif dimension == 'y':
-        ppc_arr = ppc_arr[:, 4]
+        fields = ['yerr']
     elif dimension == 'xyz':
-        ppc_arr = ppc_arr[:, 3:6]
-        ppc_arr = ppc_arr[~np.isnan(ppc_arr)].flatten()
+        fields = ['xerr', 'yerr', 'zerr']
     else:
         raise(InputError("If dimension is provided it must be one of:\n"
                          "'x', 'y', 'z' or 'xyz'"))
 
-    vrange = kwargs.get('range', (np.nanmin(ppc_arr), np.nanmax(ppc_arr)))
+    vrange = kwargs.get('range', None)
+
+    counts, edges = stream_histogram(lambda: array_chunks([pcdata[f] for f in fields]), n_bins, vrange)
 
     fig, ax = plt.subplots(figsize=(8, 7))
 
-    ax.hist(x=ppc_arr, bins=n_bins, color=colour, histtype='bar',
-             range=vrange, density=density, edgecolor='black', linewidth=0.8)
+    plot_counts(ax, counts, edges, colour, density)
     plt.title(title)
     plt.xlabel(xlabel)
 
@@ -0,0 +1,182 @@
+# Module to load the _Prec_Cloud.txt precision point clouds written by sfm_precision.
+# The text is parsed once in large chunks and saved to a .npy sidecar next to the cloud, later loads memory-map the
+# sidecar so no parsing or copying is needed. The sidecar records the size and modification time of the text file
+# and is rebuilt if either changes. PrecisionIndex interpolates the precision of the cloud to other points.
+
+import io
+import os
+import json
+import warnings
+import numpy as np
+
+try:
+    import pandas as pd  # optional - the C csv parser is a few times faster than numpy.loadtxt
+except ImportError:
+    pd = None
+
+try:
+    from scipy.spatial import cKDTree  # optional - only needed to interpolate precision (PrecisionIndex)
+except ImportError:
+    cKDTree = None
+
+FIELDS = ('x', 'y', 'z', 'xerr', 'yerr', 'zerr')
+PC_DTYPE = np.dtype([(f, 'f8') for f in FIELDS])
+
+SIDECAR_VERSION = 1
+CHUNK_BYTES = 64 * 1024 ** 2
+CHUNK_ROWS = 1000000
+PREC_NEIGHBOURS = 8
+
+
+def sidecar_paths(ppc_path):
+    return ppc_path + '.npy', ppc_path + '.npy.json'
+
+
+def source_stamp(ppc_path):
+    stat = os.stat(ppc_path)
+    return {"version": SIDECAR_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_prec_cloud(ppc_path, use_sidecar=True):
+    """Return the precision cloud as a structured array with fields x, y, z, xerr, yerr, zerr.
+
+    With use_sidecar the array is a read-only memory map of the cached .npy sidecar (built on the first call).
+    """
+    if use_sidecar is False:
+        return parse_prec_cloud(ppc_path)
+
+    npy_path, stamp_path = sidecar_paths(ppc_path)
+    stamp = source_stamp(ppc_path)
+
+    if os.path.exists(npy_path) and os.path.exists(stamp_path):
+        with open(stamp_path, 'r') as f:
+            if json.load(f) == stamp:
+                return np.load(npy_path, mmap_mode='r')
+
+    try:
+        build_sidecar(ppc_path, npy_path, stamp_path, stamp)
+    except OSError as e:
+        warnings.warn("Could not write precision cloud sidecar ({0}) - parsing in memory".format(e), Warning)
+        return parse_prec_cloud(ppc_path)
+
+    return np.load(npy_path, mmap_mode='r')
+
+
+def count_rows(ppc_path):
+    """Number of data rows - newlines counted in binary blocks, less the header"""
+    n_lines = 0
+    last = b'\n'
+    with open(ppc_path, 'rb') as f:
+        while True:
+            block = f.read(CHUNK_BYTES)
+            if not block:
+                break
+            n_lines += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        n_lines += 1  # no newline after the last row
+    return n_lines - 1
+
+
+def iter_chunks(ppc_path):
+    """Yield (n, 6) float arrays of the rows of the cloud - parsed with pandas if available or in large text
+    blocks with numpy.loadtxt if not"""
+    with open(ppc_path, 'rb') as f:
+        header = f.readline().split()
+        if len(header) != len(FIELDS):
+            raise InputError("precision cloud must have the columns: {0}".format(" ".join(FIELDS)))
+
+        if pd is not None:
+            for chunk in pd.read_csv(f, sep=' ', header=None, names=FIELDS, dtype='f8', engine='c',
+                                     chunksize=CHUNK_ROWS):
+                yield chunk.to_numpy()
+            return
+
+        remainder = b''
+        while True:
+            block = f.read(CHUNK_BYTES)
+            if not block:
+                text = remainder
+            else:
+                text = remainder + block
+                cut = text.rfind(b'\n') + 1
+                text, remainder = text[:cut], text[cut:]
+
+            if text.strip():
+                yield np.loadtxt(io.BytesIO(text), dtype='f8', delimiter=' ', ndmin=2)
+            if not block:
+                break
+
+
+def parse_prec_cloud(ppc_path):
+    chunks = list(iter_chunks(ppc_path))
+    arr = np.concatenate(chunks) if chunks else np.empty((0, len(FIELDS)))
+    return np.ascontiguousarray(arr).view(PC_DTYPE).reshape(-1)
+
+
+def build_sidecar(ppc_path, npy_path, stamp_path, stamp):
+    print("building precision cloud sidecar...")
+    n_rows = count_rows(ppc_path)
+    tmp_path = npy_path + '.tmp'
+
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=PC_DTYPE, shape=(n_rows,))
+    start = 0
+    for chunk in iter_chunks(ppc_path):
+        end = start + len(chunk)
+        out[start:end] = np.ascontiguousarray(chunk).view(PC_DTYPE).reshape(-1)
+        start = end
+    out.flush()
+
+    if start != n_rows:
+        # blank lines in the text - save just the parsed rows
+        np.save(npy_path, out[:start])
+        del out
+        os.remove(tmp_path)
+    else:
+        del out
+        os.replace(tmp_path, npy_path)
+
+    with open(stamp_path, 'w') as f:
+        json.dump(stamp, f)
+
+
+class PrecisionIndex:
+    """KD-tree of a precision cloud (from load_prec_cloud) - interpolates xerr, yerr and zerr to other points by
+    inverse distance weighting (power 2) of the k nearest precision points"""
+
+    def __init__(self, pcdata, k=PREC_NEIGHBOURS):
+        if cKDTree is None:
+            raise InputError("interpolating precision needs scipy (scipy.spatial.cKDTree) - install scipy")
+        if len(pcdata) == 0:
+            raise InputError("the precision cloud has no points")
+
+        self.tree = cKDTree(np.column_stack([pcdata['x'], pcdata['y'], pcdata['z']]))
+        self.err = np.column_stack([pcdata['xerr'], pcdata['yerr'], pcdata['zerr']])
+        self.k = min(k, len(pcdata))
+
+    def interpolate(self, xyz, workers=-1):
+        """(n, 3) array of the xerr, yerr and zerr at the (n, 3) points xyz"""
+        dist, idx = self.tree.query(xyz, k=self.k, workers=workers)
+        dist, idx = dist.reshape(len(xyz), self.k), idx.reshape(len(xyz), self.k)
+
+        with np.errstate(divide='ignore'):
+            weights = 1.0 / np.maximum(dist, 1e-9) ** 2
+        weights /= weights.sum(axis=1, keepdims=True)
+
+        return np.einsum('nk,nkj->nj', weights, self.err[idx])
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
@@ -7,17 +7,29 @@ import numpy as np
 import math
 import rasterio
 import os
+import shutil
+import tempfile
 import warnings
-from sfm_gridz.mask_AOI import mask_it
+from sfm_gridz import mask_AOI
+from sfm_gridz import bin_grid
+from sfm_gridz import raster_data
+from sfm_gridz import gap_fill
+from sfm_gridz.prec_cloud import load_prec_cloud
 from rasterio.crs import CRS
 
-def precision_map(prec_point_cloud, out_raster, resolution, prec_dimension, epsg, bounds, mask):
+def precision_map(prec_point_cloud, out_raster, resolution, prec_dimension, epsg, bounds, mask, engine='pdal',
+                  profile=None, fill='max', fill_distance=None):
     startTime = datetime.now()
     if prec_dimension not in ['x', 'y', 'z']:
         raise(InputError("prec_dimension must be: 'x', 'y' or 'z'"))
+    if engine not in ['pdal', 'numpy']:
+        raise(InputError("engine must be: 'pdal' or 'numpy'"))
+    if fill not in ['max', 'idw']:
+        raise(InputError("fill must be: 'max' or 'idw'"))
 
 
-    ppc_process = PrRas(prec_point_cloud, out_raster, resolution, prec_dimension, bounds, epsg, mask)
+    ppc_process = PrRas(prec_point_cloud, out_raster, resolution, prec_dimension, bounds, epsg, mask, engine, profile,
+                        fill, fill_distance)
     ppc_process.readPC_xyzerr()
     ppc_process.Run()
 
@@ -27,10 +39,12 @@ def precision_map(prec_point_cloud, out_raster, resolution, prec_dimension, epsg
 
 class PrRas:
 
-    def __init__(self, prec_pc, ras_path, ras_res, prec_dim, bbox, epsg, maskit):
+    def __init__(self, prec_pc, ras_path, ras_res, prec_dim, bbox, epsg, maskit, engine='pdal', profile=None,
+                 fill='max', fill_distance=None):
         self.ppc = prec_pc
         self.res = ras_res
-        self.path = ras_path
+        self.path = ras_path  # None to keep the precision map in memory (self.raster)
+        self.raster = None
 
         if prec_dim == 'z':
             self.pr_dim = 'zerr'
@@ -49,11 +63,13 @@ class PrRas:
         self.min_res = None
         self.pcdata = None
         self.max_prec = None
+        self.engine = engine
+        self.profile = profile
+        self.fill = fill
+        self.fill_distance = fill_distance
 
     def readPC_xyzerr(self):
-        pcdata = np.loadtxt(self.ppc, delimiter=' ', skiprows=1,
-                             dtype={'names': ('x', 'y', 'z', 'xerr', 'yerr', 'zerr'),
-                                    'formats': ('f8', 'f8', 'f8', 'f8', 'f8', 'f8')})
+        pcdata = load_prec_cloud(self.ppc)
 
         min_val = max([np.mean(pcdata['xerr']) + np.std(pcdata['xerr']),
                        np.mean(pcdata['yerr']) + np.std(pcdata['yerr'])])
@@ -62,6 +78,8 @@ class PrRas:
 
         self.max_prec = math.ceil(np.nanmax(pcdata['zerr']) * 10000) / 10000
 
+        self.pcdata = pcdata
+
 
     def Run(self):
         print("Generating Precision Raster...")
@@ -72,8 +90,66 @@ class PrRas:
             warnings.warn("Desired precision raster resolution too low!! \n"
                           "Resolution set to the mean xy error + stdev:   {0}".format(self.min_res), Warning)
 
-        if os.path.exists(self.path):
-            os.remove(self.path)
+        if self.engine == 'numpy':
+            arr, meta = self.grid_numpy()
+        else:
+            arr, meta = self.grid_pdal()
+
+        if self.fill == 'idw':
+            # gaps near tie points are interpolated from the surrounding cells, the rest still get max_prec.
+            # band 3 flags the filled cells: 1 - interpolated, 2 - max_prec
+            res = (meta['transform'].a, -meta['transform'].e)
+            arr_fill, interp = gap_fill.fill_array(arr, res, self.fill_distance)
+            flag = np.where(interp, 1, np.where(arr_fill == -999, 2, 0)).astype(arr.dtype)
+            arr_fill[arr_fill == -999] = self.max_prec
+            bands = [arr_fill, arr, flag]
+        else:
+            arr_fill = np.copy(arr)
+            # self.max_prec = np.nanmax(arr_fill)
+            arr_fill[arr_fill == -999] = self.max_prec
+            bands = [arr_fill, arr]
+        transform = meta['transform']
+        if self.mask is not None:
+            # masked in memory so the raster is written once and never read back
+            epsg = None if len(self.epsg_code) == 0 else self.epsg_code.data
+            bands, transform = mask_AOI.mask_arrays(bands, self.mask, epsg, transform)
+
+        self.raster = raster_data.RasterData(np.stack(bands), transform, meta['crs'], -999)
+
+        if self.bounds is None:
+            b = self.raster.bounds
+            self.bounds = ([b[0], b[2]], [b[1], b[3]])
+
+        if self.path is not None:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.raster.write(self.path, self.profile)
+            self.raster = None
+
+        if self.pr_dim == 'zerr':
+            self.pr_dim = 'z'
+        if self.pr_dim == 'xerr':
+            self.pr_dim = 'x'
+        if self.pr_dim == 'yerr':
+            self.pr_dim = 'y'
+
+    def grid_numpy(self):
+        """Grid the precision cloud already held in pcdata - no text re-parse, PDAL run or temporary raster"""
+        grid = bin_grid.grid_from_bounds(self.pcdata['x'], self.pcdata['y'], self.res, self.bounds)
+        stats = bin_grid.bin_points(self.pcdata['x'], self.pcdata['y'], self.pcdata[self.pr_dim], grid,
+                                    stats=('mean',))
+
+        meta = {"driver": "GTiff", "height": grid.height, "width": grid.width, "count": 1, "dtype": 'float64',
+                "crs": None if len(self.epsg_code) == 0 else self.epsg_code, "transform": grid.transform,
+                "nodata": -999}
+
+        return stats['mean'], meta
+
+    def grid_pdal(self):
+        """Grid the precision cloud with writers.gdal - PDAL can only write to a file so it goes to a temporary raster
+        which is read back and removed"""
+        tmp_dir = tempfile.mkdtemp()
+        tmp_path = os.path.join(tmp_dir, 'precision.tif')
 
         if self.bounds is None:
 
@@ -85,7 +161,7 @@ class PrRas:
                         "override_srs": str(self.epsg_code)
                     },
                     {"type": "writers.gdal",
-                     "filename": self.path,  # output file name
+                     "filename": tmp_path,  # output file name
                      "resolution": self.res,
                      "dimension": self.pr_dim,  # raster resolution
                      "nodata": -999,
@@ -104,7 +180,7 @@ class PrRas:
                         "override_srs": str(self.epsg_code)
                     },
                     {"type": "writers.gdal",
-                     "filename": self.path,  # output file name
+                     "filename": tmp_path,  # output file name
                      "resolution": self.res,
                      "dimension": self.pr_dim,  # raster resolution
                      "nodata": -999,
@@ -115,39 +191,18 @@ class PrRas:
                 ]
             }
 
-        pipeline = pdal.Pipeline(json.dumps(dtm_gen)) # define the pdal pipeline
-        pipeline.validate()  # validate the pipeline
-        pipeline.execute()   #  run the pipeline
-
-        with rasterio.open(self.path, 'r') as src:
-            meta = src.meta
-            arr = src.read(1)
+        try:
+            pipeline = pdal.Pipeline(json.dumps(dtm_gen)) # define the pdal pipeline
+            pipeline.validate()  # validate the pipeline
+            pipeline.execute()   #  run the pipeline
 
-        arr_fill = np.copy(arr)
-        # self.max_prec = np.nanmax(arr_fill)
-        arr_fill[arr_fill == -999] = self.max_prec
-        meta.update(count=2)
+            with rasterio.open(tmp_path, 'r') as src:
+                meta = src.meta
+                arr = src.read(1)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
-        with rasterio.open(self.path, 'w', **meta) as src:
-            src.write_band(1, arr_fill)
-            src.write_band(2, arr)
-
-        if self.mask is not None:
-            if len(self.epsg_code) == 0:
-                mask_it(raster=self.path, shp_path=self.mask, epsg=None)
-            else:
-                mask_it(raster=self.path, shp_path=self.mask, epsg=self.epsg_code.data)
-
-        if self.bounds is None:
-            with rasterio.open(self.path) as src:
-                self.bounds = ([src.bounds[0], src.bounds[2]], [src.bounds[1], src.bounds[3]])
-
-        if self.pr_dim == 'zerr':
-            self.pr_dim = 'z'
-        if self.pr_dim == 'xerr':
-            self.pr_dim = 'x'
-        if self.pr_dim == 'yerr':
-            self.pr_dim = 'y'
+        return arr, meta
 
 
 class Error(Exception):
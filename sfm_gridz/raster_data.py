@@ -0,0 +1,175 @@
+# Module for rasters held in memory so sfm_gridz stages can hand their results straight to the next stage without
+# writing and re-reading GeoTIFFs. A RasterData holds a (band, row, col) array with its transform, CRS and nodata and
+# offers the parts of the rasterio dataset interface the stages read through (shape, bounds, res, read with a
+# window...), so it can be given anywhere a raster path is taken. Where GDAL itself is needed (warping onto a different
+# grid) it is opened as an in-memory dataset. Writing to disk is an explicit step - RasterData.write.
+
+import numpy as np
+import rasterio
+import rasterio.windows
+from rasterio.coords import BoundingBox
+from rasterio.io import MemoryFile
+from rasterio.windows import Window
+from sfm_gridz import raster_profile
+from sfm_gridz import mask_AOI
+
+NODATA = -999
+
+
+class RasterData:
+
+    def __init__(self, array, transform, crs, nodata=NODATA, descriptions=None):
+        array = np.asarray(array)
+        if array.ndim == 2:
+            array = array[np.newaxis]
+        self.array = array
+        self.transform = transform
+        self.crs = crs
+        self.nodata = nodata
+        self.descriptions = tuple(descriptions) if descriptions is not None else (None,) * array.shape[0]
+        self.name = '<in memory>'
+        self._memfile = None
+
+    @classmethod
+    def from_path(cls, path):
+        with rasterio.open(path) as src:
+            return cls(src.read(), src.transform, src.crs, src.nodata, src.descriptions)
+
+    @property
+    def count(self):
+        return self.array.shape[0]
+
+    @property
+    def height(self):
+        return self.array.shape[1]
+
+    @property
+    def width(self):
+        return self.array.shape[2]
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    @property
+    def dtypes(self):
+        return (str(self.array.dtype),) * self.count
+
+    @property
+    def res(self):
+        return self.transform.a, -self.transform.e
+
+    @property
+    def bounds(self):
+        left, top = self.transform.c, self.transform.f
+        return BoundingBox(left, top + self.transform.e * self.height, left + self.transform.a * self.width, top)
+
+    @property
+    def meta(self):
+        return {"driver": "GTiff", "dtype": str(self.array.dtype), "nodata": self.nodata, "width": self.width,
+                "height": self.height, "count": self.count, "crs": self.crs, "transform": self.transform}
+
+    def read(self, indexes=None, window=None):
+        """Copy of a band (or all bands if indexes is None) as rasterio's dataset.read"""
+        arr = self.array
+        if window is not None:
+            arr = arr[(slice(None),) + window.toslices()]
+        if indexes is None:
+            return arr.copy()
+        return arr[indexes - 1].copy()
+
+    def window(self, window):
+        """The part of the raster covered by a rasterio Window - a view, not a copy"""
+        return RasterData(self.array[(slice(None),) + window.toslices()],
+                          rasterio.windows.transform(window, self.transform), self.crs, self.nodata, self.descriptions)
+
+    def as_dataset(self):
+        """The raster as an open rasterio dataset in memory - for GDAL operations such as warping"""
+        if self._memfile is None:
+            self._memfile = MemoryFile()
+            with self._memfile.open(**self.meta) as dst:
+                dst.write(self.array)
+        return self._memfile.open()
+
+    def write(self, path, profile=None):
+        """Write the raster to disk with a raster_profile profile and return the path"""
+        meta = raster_profile.apply(self.meta, profile)
+        with rasterio.open(path, 'w', **meta) as dst:
+            dst.write(self.array.astype(meta['dtype'], copy=False))
+            for i, desc in enumerate(self.descriptions, start=1):
+                if desc is not None:
+                    dst.set_band_description(i, desc)
+        raster_profile.finalise(path, profile)
+        return path
+
+    def close(self):
+        """Only frees the in-memory GDAL copy - the array stays available"""
+        if self._memfile is not None:
+            self._memfile.close()
+            self._memfile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MemoryWriter:
+    """Stands in for a rasterio dataset opened for writing - collects windowed band writes into a RasterData"""
+
+    def __init__(self, meta):
+        self.meta = meta
+        self.raster = RasterData(np.full((meta['count'], meta['height'], meta['width']), meta.get('nodata', NODATA),
+                                         dtype=meta['dtype']), meta['transform'], meta['crs'], meta.get('nodata'))
+        self.crs = meta['crs']
+        self.dtypes = self.raster.dtypes
+
+    def write(self, arr, indexes=None, window=None):
+        if window is None:
+            window = Window(0, 0, self.raster.width, self.raster.height)
+        target = self.raster.array[(slice(None),) + window.toslices()]
+        if indexes is None:
+            target[...] = arr
+        else:
+            target[indexes - 1] = arr
+
+    def set_band_description(self, index, description):
+        descriptions = list(self.raster.descriptions)
+        descriptions[index - 1] = description
+        self.raster.descriptions = tuple(descriptions)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def mask_raster(raster, shp_path, epsg):
+    """Mask an in-memory raster to the AOI in place (as mask_AOI.mask_it) - cropped to the AOI if it is smaller"""
+    outside = mask_AOI.aoi_mask(shp_path, epsg, raster.transform, raster.shape)
+    window = mask_AOI.crop_window(outside)
+    raster.array[:, outside] = mask_AOI.NODATA
+    if window is not None:
+        return raster.window(window)
+    return raster
+
+
+def open_raster(src):
+    """Open a raster path for reading, or pass through an in-memory raster (or a stage result holding one)"""
+    if getattr(src, 'raster', None) is not None:
+        src = src.raster
+    if isinstance(src, RasterData):
+        return src
+    return rasterio.open(src, 'r')
+
+
+def open_output(path, meta):
+    """Open an output raster for writing - in memory if path is None"""
+    if path is None:
+        return MemoryWriter(meta)
+    return rasterio.open(path, 'w', **meta)
@@ -0,0 +1,146 @@
+# Module with the output profile shared by every raster sfm_gridz writes. By default rasters are float32, internally
+# tiled, deflate compressed with the floating point predictor and finished as Cloud-Optimized GeoTIFFs with internal
+# overviews, so windowed reads, plots and masks of the outputs only touch the tiles they need.
+#
+# Each writer takes a profile argument:
+#   None  - the DEFAULT profile
+#   dict  - the DEFAULT profile updated with the given keys, e.g. {"compress": "lzw", "overviews": False}
+#   False - plain striped GeoTIFFs as written before the profiles were added
+
+import os
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+
+DEFAULT = {
+    "dtype": "float32",
+    "tiled": True,
+    "blockxsize": 256,
+    "blockysize": 256,
+    "compress": "deflate",
+    "predictor": 3,   # floating point predictor - 2 is used for integer rasters
+    "zlevel": 6,
+    "num_threads": "ALL_CPUS",  # threads used by GDAL to compress tiles
+    "overviews": True,
+    "cog": True,      # re-copy the finished raster so the overviews and tiles are laid out as a COG
+}
+
+CREATION_KEYS = ("tiled", "blockxsize", "blockysize", "compress", "predictor", "zlevel", "num_threads")
+
+
+def get_profile(profile=None):
+    """The full profile dict for a writer's profile argument, or None for plain GeoTIFFs"""
+    if profile is False:
+        return None
+    if profile is None:
+        return dict(DEFAULT)
+    if not isinstance(profile, dict):
+        raise InputError("profile must be None, False or a dict of profile options")
+
+    unknown = [k for k in profile if k not in DEFAULT]
+    if len(unknown) > 0:
+        raise InputError("unknown profile options: {0} - use: {1}".format(", ".join(unknown), ", ".join(DEFAULT)))
+
+    out = dict(DEFAULT)
+    out.update(profile)
+    return out
+
+
+def creation_options(profile, dtype, final=True):
+    """rasterio/GDAL creation options for the profile and a raster dtype. For cog profiles the working raster
+    (final=False) is left uncompressed as it is only compressed once, when finalise copies it."""
+    opts = {k: profile[k] for k in CREATION_KEYS if profile.get(k) is not None}
+    if final is False and profile.get("cog") is True:
+        opts["compress"] = None
+    if opts.get("tiled") is not True:
+        for k in ("tiled", "blockxsize", "blockysize"):
+            opts.pop(k, None)
+    if opts.get("compress") in (None, "none"):
+        opts = {k: v for k, v in opts.items() if k not in ("compress", "predictor", "zlevel", "num_threads")}
+    elif opts.get("compress") != "deflate":
+        opts.pop("zlevel", None)
+    if opts.get("predictor") == 3 and "float" not in str(dtype):
+        opts["predictor"] = 2
+    return opts
+
+
+def apply(meta, profile=None):
+    """Copy of the rasterio meta with the profile's dtype and creation options"""
+    prof = get_profile(profile)
+    meta = dict(meta)
+    if prof is None:
+        return meta
+
+    meta["driver"] = "GTiff"
+    if prof.get("dtype") is not None:
+        meta["dtype"] = prof["dtype"]
+    meta.update(creation_options(prof, meta["dtype"], final=False))
+    return meta
+
+
+def pdal_options(profile=None):
+    """writers.gdal options giving the same data type and creation options as apply()"""
+    prof = get_profile(profile)
+    if prof is None:
+        return {}
+
+    opts = {}
+    if prof.get("dtype") is not None:
+        opts["data_type"] = prof["dtype"]
+    creation = creation_options(prof, prof.get("dtype") or "float64", final=False)
+    if len(creation) > 0:
+        opts["gdalopts"] = ",".join("{0}={1}".format(k.upper(), "YES" if v is True else v)
+                                    for k, v in creation.items())
+    return opts
+
+
+def overview_factors(width, height, block_size):
+    """Decimation factors (2, 4, 8...) down to roughly a single block"""
+    factors = []
+    f = 2
+    while max(width, height) / f >= block_size / 2:
+        factors.append(f)
+        f *= 2
+    return factors
+
+
+def finalise(path, profile=None):
+    """Add internal overviews to a finished raster and, for cog profiles, re-copy it into COG layout. Call after the
+    raster has been fully written and masked."""
+    prof = get_profile(profile)
+    if prof is None:
+        return
+
+    if prof["overviews"] is True:
+        with rasterio.open(path, 'r+') as dst:
+            factors = overview_factors(dst.width, dst.height, prof.get("blockxsize") or 256)
+            if len(factors) > 0:
+                dst.build_overviews(factors, Resampling.average)
+                dst.update_tags(ns='rio_overview', resampling='average')
+
+    if prof["cog"] is True:
+        with rasterio.open(path) as src:
+            opts = creation_options(prof, src.dtypes[0])
+        opts["copy_src_overviews"] = True
+        if opts.get("tiled") is not True:
+            opts.update(tiled=True, blockxsize=256, blockysize=256)  # COGs must be tiled
+
+        tmp_path = path + '.cog.tif'
+        rasterio.shutil.copy(path, tmp_path, driver='GTiff', **opts)
+        os.replace(tmp_path, path)
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
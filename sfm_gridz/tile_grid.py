@@ -0,0 +1,230 @@
+# Module to build DSM rasters out-of-core. The dense cloud is streamed in chunks and each point is routed to the
+# spatial tiles it can affect (core tile plus a halo of window_size + search radius cells). The tiles are spilled to
+# disk, gridded in parallel worker processes with bin_grid and written into a single GeoTIFF window by window.
+# Cell positions are always worked out from the full grid origin so the result matches a non-tiled 'numpy' run.
+
+import os
+import json
+import math
+import shutil
+import tempfile
+import warnings
+import numpy as np
+import pdal
+import rasterio
+from rasterio.windows import Window
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from sfm_gridz import bin_grid
+from sfm_gridz import raster_profile
+
+POINT_BYTES = 200  # approximate working memory per point while gridding - the tile's x, y, z (24) and bin_points'
+                   # per search offset indices and values (~80 measured), with headroom for the routed chunk copies
+CELL_BYTES = 120   # approximate working memory per cell while gridding and window filling
+MIN_TILE = 16
+
+
+def stream_points(point_cloud, reader, chunk_size):
+    """Yield the X, Y and Z arrays of a point cloud in chunks of at most chunk_size points"""
+    read_pc = {
+        "pipeline": [
+            {
+                "type": reader,
+                "filename": point_cloud
+            }
+        ]
+    }
+
+    pipeline = pdal.Pipeline(json.dumps(read_pc))
+    for arr in pipeline.iterator(chunk_size=chunk_size):
+        yield arr['X'], arr['Y'], arr['Z']
+
+
+def stream_extent(point_cloud, reader, chunk_size):
+    """First pass over the cloud - returns the bounds ([xmin, xmax], [ymin, ymax]) and the number of points"""
+    minx = miny = math.inf
+    maxx = maxy = -math.inf
+    n_points = 0
+
+    for x, y, z in stream_points(point_cloud, reader, chunk_size):
+        if len(x) == 0:
+            continue
+        minx = min(minx, float(np.min(x)))
+        maxx = max(maxx, float(np.max(x)))
+        miny = min(miny, float(np.min(y)))
+        maxy = max(maxy, float(np.max(y)))
+        n_points += len(x)
+
+    return ([minx, maxx], [miny, maxy]), n_points
+
+
+class TilePlan:
+    """Splits a grid into square tiles of tile_size cells. Tile rows are counted up from the southern edge to match
+    bin_grid, each tile is gridded over its core extended by halo cells (clipped to the grid)."""
+
+    def __init__(self, grid, tile_size, window_size, reach):
+        self.grid = grid
+        self.tile_size = int(tile_size)
+        self.window = window_size
+        self.reach = reach
+        self.n_cols = int(math.ceil(grid.width / self.tile_size))
+        self.n_rows = int(math.ceil(grid.height / self.tile_size))
+
+    def tiles(self):
+        for ty in range(self.n_rows):
+            for tx in range(self.n_cols):
+                yield tx, ty
+
+    def core(self, tx, ty):
+        """(col_off, row_off, width, height) of the tile core in cells from the grid's lower-left corner"""
+        col_off = tx * self.tile_size
+        row_off = ty * self.tile_size
+        return (col_off, row_off, min(self.tile_size, self.grid.width - col_off),
+                min(self.tile_size, self.grid.height - row_off))
+
+    def extended(self, tx, ty):
+        """the core grown by window_size cells - every cell the window fill of the core can draw on"""
+        col_off, row_off, width, height = self.core(tx, ty)
+        c0 = max(0, col_off - self.window)
+        r0 = max(0, row_off - self.window)
+        c1 = min(self.grid.width, col_off + width + self.window)
+        r1 = min(self.grid.height, row_off + height + self.window)
+        return c0, r0, c1 - c0, r1 - r0
+
+    def tile_path(self, folder, tx, ty):
+        return os.path.join(folder, "tile_{0}_{1}.bin".format(tx, ty))
+
+    def route(self, x, y, z, folder):
+        """Append each point to the spill file of every tile whose extended area it contributes to"""
+        grid = self.grid
+        col = np.floor((x - grid.minx) / grid.res).astype(np.int64)
+        row = np.floor((y - grid.miny) / grid.res).astype(np.int64)
+        tx0 = np.floor_divide(col, self.tile_size)
+        ty0 = np.floor_divide(row, self.tile_size)
+        k = int(math.ceil((self.window + self.reach) / self.tile_size))
+
+        tile_ids = []
+        point_ids = []
+        for dty in range(-k, k + 1):
+            for dtx in range(-k, k + 1):
+                tx = tx0 + dtx
+                ty = ty0 + dty
+
+                # extended tile extent in cells, as in self.extended, for every point at once
+                c0 = np.maximum(0, tx * self.tile_size - self.window)
+                c1 = np.minimum(grid.width, (tx + 1) * self.tile_size + self.window)
+                r0 = np.maximum(0, ty * self.tile_size - self.window)
+                r1 = np.minimum(grid.height, (ty + 1) * self.tile_size + self.window)
+
+                keep = (tx >= 0) & (tx < self.n_cols) & (ty >= 0) & (ty < self.n_rows) & \
+                       (col >= c0 - self.reach) & (col < c1 + self.reach) & \
+                       (row >= r0 - self.reach) & (row < r1 + self.reach)
+
+                point_ids.append(np.flatnonzero(keep))
+                tile_ids.append(ty[keep] * self.n_cols + tx[keep])
+
+        tile_ids = np.concatenate(tile_ids)
+        point_ids = np.concatenate(point_ids)
+        if len(tile_ids) == 0:
+            return
+
+        # group by tile but keep the file's point order within each tile so the cell sums add up in the same order
+        # as a non-tiled run.
+        order = np.lexsort((point_ids, tile_ids))
+        tile_ids = tile_ids[order]
+        point_ids = point_ids[order]
+        splits = np.flatnonzero(np.diff(tile_ids)) + 1
+
+        for ids, pids in zip(np.split(tile_ids, splits), np.split(point_ids, splits)):
+            t_id = int(ids[0])
+            block = np.column_stack((x[pids], y[pids], z[pids])).astype('f8')
+            with open(self.tile_path(folder, t_id % self.n_cols, t_id // self.n_cols), 'ab') as f:
+                block.tofile(f)
+
+
+def plan_tile_size(grid, n_points, window_size, reach, memory_limit, n_workers):
+    """Largest tile (in cells) whose gridding fits in memory_limit (MB) shared between n_workers"""
+    budget = memory_limit * 1024 ** 2 / n_workers
+    density = n_points / float(grid.width * grid.height)
+    cell_cost = CELL_BYTES + density * POINT_BYTES
+    halo = window_size + reach
+
+    side = int(math.sqrt(budget / cell_cost)) - 2 * halo
+    if side < MIN_TILE:
+        warnings.warn("memory_limit is too small for the point density and window_size - using {0} cell tiles, "
+                      "peak memory may exceed the limit".format(MIN_TILE), Warning)
+        side = MIN_TILE
+
+    return min(side, max(grid.width, grid.height))
+
+
+def grid_tile(tile_file, grid, core, extended, window_size, stats):
+    """Worker process - grid one spilled tile and return the core arrays in raster (north up) order"""
+    ext_grid = grid.window(*extended)
+
+    if os.path.exists(tile_file):
+        pts = np.fromfile(tile_file, dtype='f8').reshape(-1, 3)
+        out = bin_grid.bin_points(pts[:, 0], pts[:, 1], pts[:, 2], ext_grid, stats=stats, window_size=window_size)
+    else:
+        out = {s: np.full(ext_grid.shape, bin_grid.NODATA, dtype='f8') for s in stats}
+
+    col_off, row_off, width, height = core
+    top = (extended[1] + extended[3]) - (row_off + height)
+    left = col_off - extended[0]
+
+    return core, [out[s][top:top + height, left:left + width] for s in stats]
+
+
+def write_tiles(dest, grid, jobs):
+    """Write the core arrays of finished grid_tile jobs into their windows of the open output raster"""
+    for job in jobs:
+        (col_off, row_off, width, height), arrs = job.result()
+        window = Window(col_off, grid.height - (row_off + height), width, height)
+        for band, arr in enumerate(arrs, start=1):
+            dest.write(arr.astype(dest.dtypes[band - 1]), band, window=window)
+
+
+def grid_tiled(point_cloud, reader, out_raster, resolution, bounds, window_size, crs, memory_limit, n_workers,
+               tile_size=None, stats=('mean', 'stdev'), profile=False):
+    """Stream, tile and grid a point cloud into out_raster. Returns the bin_grid.Grid of the raster."""
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    chunk_size = max(10000, int(memory_limit * 1024 ** 2 * 0.25 / POINT_BYTES))
+
+    print("scanning point cloud extent...")
+    extent, n_points = stream_extent(point_cloud, reader, chunk_size)
+    if bounds is None:
+        bounds = extent
+
+    grid = bin_grid.grid_from_bounds(None, None, resolution, bounds)
+    reach = bin_grid.search_reach(resolution)
+
+    if tile_size is None:
+        tile_size = plan_tile_size(grid, n_points, window_size, reach, memory_limit, n_workers)
+
+    plan = TilePlan(grid, tile_size, window_size, reach)
+    print("gridding {0} points in {1} x {2} tiles of {3} cells...".format(n_points, plan.n_cols, plan.n_rows,
+                                                                         plan.tile_size))
+
+    spill_dir = tempfile.mkdtemp(prefix='sfm_gridz_tiles_')
+    try:
+        for x, y, z in stream_points(point_cloud, reader, chunk_size):
+            plan.route(x, y, z, spill_dir)
+
+        meta = raster_profile.apply(bin_grid.raster_meta(grid, crs, len(stats)), profile)
+        with rasterio.open(out_raster, 'w', **meta) as dest:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                # only a couple of tiles per worker are kept in flight so finished tiles don't pile up in memory
+                pending = set()
+                for tx, ty in plan.tiles():
+                    pending.add(pool.submit(grid_tile, plan.tile_path(spill_dir, tx, ty), grid, plan.core(tx, ty),
+                                            plan.extended(tx, ty), window_size, stats))
+                    if len(pending) >= 2 * n_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        write_tiles(dest, grid, done)
+
+                write_tiles(dest, grid, pending)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    return grid
@@ -0,0 +1,194 @@
+# Module for zonal statistics of rasters - e.g. DoD and CHM values within woodland / foraging zones. The zone polygons
+# are rasterised once per raster grid to a label grid (0 - no zone, 1..n - the zones in file order) which is cached,
+# so every raster and band on the same grid reuses it. Each raster is then read once, in blocks, and all zones and
+# bands are aggregated together with np.bincount. Pixels are inside a zone if their centre is (as rasterio.mask).
+
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from rasterio.features import rasterize
+from rasterio.windows import Window
+from sfm_gridz import raster_data
+
+NODATA = -999
+BLOCK_ROWS = 1024
+MAX_CACHED = 8  # label grids kept in memory
+PERCENTILES = (5, 25, 50, 75, 95)
+
+_label_cache = OrderedDict()
+
+
+def zonal_stats(zones, rasters, bands=(1,), percentiles=PERCENTILES, zone_column=None, extract=False,
+                block_rows=BLOCK_ROWS):
+    """Per zone statistics of the bands of each raster in one blockwise pass per raster.
+
+    zones - polygon file path or GeoDataFrame, rasters - {name: raster} or a list of rasters (paths or in-memory
+    rasters), bands - 1-based bands read from every raster. Returns a DataFrame with one row per raster, band and zone:
+    raster, band, zone, count, mean, std, min, max and p<q> for each percentile. zone is the zone_column value of the
+    zone (or its row number if None). With extract=True the pixel values are also returned as a second, long format,
+    DataFrame with columns raster, band, zone, value. No data (-999) pixels are left out; NaN pixels are left out of
+    the statistics but kept in the extracted values (as rasterio.mask does).
+    """
+    if not isinstance(rasters, dict):
+        rasters = {str(r): r for r in rasters}
+
+    zone_gdf = read_zones(zones)
+    if zone_column is not None and zone_column not in zone_gdf.columns:
+        raise InputError("zone_column '{0}' is not a column of the zones".format(zone_column))
+    zone_ids = np.asarray(zone_gdf.index if zone_column is None else zone_gdf[zone_column])
+
+    stats = []
+    values = []
+    for name, ras in rasters.items():
+        print("zonal statistics for {0}...".format(name))
+        with raster_data.open_raster(ras) as src:
+            labels = label_grid(zones, zone_gdf, src.transform, src.shape, src.crs)
+            zone_vals = aggregate(src, labels, len(zone_gdf), bands, percentiles is not None or extract, block_rows)
+
+        for b, (count, total, total_sq, v_min, v_max, per_zone) in zip(bands, zone_vals):
+            table = stats_table(count, total, total_sq, v_min, v_max, per_zone, percentiles)
+            table.insert(0, 'zone', zone_ids)
+            table.insert(0, 'band', b)
+            table.insert(0, 'raster', name)
+            stats.append(table)
+
+            if extract is True:
+                for z, arr in enumerate(per_zone):
+                    values.append(pd.DataFrame({'raster': name, 'band': b, 'zone': zone_ids[z], 'value': arr}))
+
+    stats = pd.concat(stats, ignore_index=True)
+    if extract is True:
+        cols = ['raster', 'band', 'zone', 'value']
+        values = pd.concat(values, ignore_index=True) if len(values) > 0 else pd.DataFrame(columns=cols)
+        return stats, values
+    return stats
+
+
+def extract_values(zones, raster, band=1, zone_column=None, block_rows=BLOCK_ROWS):
+    """Pixel values of one band of a raster within the zones - DataFrame with columns zone and value"""
+    _, values = zonal_stats(zones, {'raster': raster}, (band,), None, zone_column, True, block_rows)
+    return values[['zone', 'value']]
+
+
+def read_zones(zones):
+    if isinstance(zones, gpd.GeoDataFrame):
+        return zones
+    return gpd.read_file(zones)
+
+
+def zones_key(zones, zone_gdf):
+    """Key for a zone file (path and modification time) or GeoDataFrame (its geometries)"""
+    if isinstance(zones, gpd.GeoDataFrame):
+        return 'gdf', hash(tuple(zone_gdf.geometry.to_wkb())), str(zone_gdf.crs)
+    path = os.path.abspath(zones)
+    return path, os.stat(path).st_mtime_ns
+
+
+def label_grid(zones, zone_gdf, transform, shape, crs):
+    """int32 array of the grid - 0 outside all zones, i + 1 inside zone i. Cached for the zones and grid. Where zones
+    overlap the later zone wins."""
+    key = (zones_key(zones, zone_gdf), tuple(transform)[:6], tuple(shape), str(crs))
+
+    if key not in _label_cache:
+        if crs is not None and zone_gdf.crs is not None and zone_gdf.crs != crs:
+            zone_gdf = zone_gdf.to_crs(crs)
+        geoms = json.loads(zone_gdf.geometry.to_json())['features']
+        shapes = [(f['geometry'], i + 1) for i, f in enumerate(geoms) if f['geometry'] is not None]
+
+        if len(shapes) == 0:
+            labels = np.zeros(shape, dtype='int32')
+        else:
+            labels = rasterize(shapes, out_shape=tuple(shape), transform=transform, fill=0, dtype='int32')
+
+        _label_cache[key] = labels
+        while len(_label_cache) > MAX_CACHED:
+            _label_cache.popitem(last=False)
+    _label_cache.move_to_end(key)
+
+    return _label_cache[key]
+
+
+def aggregate(src, labels, n_zones, bands, keep_values, block_rows):
+    """Count, sum, sum of squares, min and max per zone of each band (and the values of each zone if keep_values) -
+    the raster is read in strips of block_rows rows, only rows that hold a zone are read"""
+    n = n_zones + 1
+    out = []
+    for _ in bands:
+        out.append([np.zeros(n, 'int64'), np.zeros(n), np.zeros(n), np.full(n, np.inf), np.full(n, -np.inf),
+                    [[] for _ in range(n)]])
+
+    rows = np.flatnonzero((labels > 0).any(axis=1))
+    if len(rows) == 0:
+        return [finish(o) for o in out]
+
+    for row in range(int(rows[0]), int(rows[-1]) + 1, block_rows):
+        n_rows = min(block_rows, int(rows[-1]) + 1 - row)
+        lab = labels[row:row + n_rows]
+        if not (lab > 0).any():
+            continue
+        window = Window(0, row, src.width, n_rows)
+
+        for b, (count, total, total_sq, v_min, v_max, per_zone) in zip(bands, out):
+            arr = src.read(b, window=window)
+            inside = (lab > 0) & (arr != NODATA)
+            z_all = lab[inside]
+            v_all = arr[inside].astype('float64')
+            finite = np.isfinite(v_all)  # NaN pixels (e.g. the raw DoD band) are kept as values, not in the stats
+            z = z_all[finite]
+            v = v_all[finite]
+
+            count += np.bincount(z, minlength=n)
+            total += np.bincount(z, weights=v, minlength=n)
+            total_sq += np.bincount(z, weights=v * v, minlength=n)
+            np.minimum.at(v_min, z, v)
+            np.maximum.at(v_max, z, v)
+
+            if keep_values:
+                order = np.argsort(z_all, kind='stable')
+                splits = np.searchsorted(z_all[order], np.arange(1, n))
+                for i, part in enumerate(np.split(v_all[order], splits)):
+                    if len(part) > 0:
+                        per_zone[i].append(part)
+
+    return [finish(o) for o in out]
+
+
+def finish(acc):
+    """Drop the no-zone label 0 and join the blocks of values of each zone"""
+    count, total, total_sq, v_min, v_max, per_zone = acc
+    per_zone = [np.concatenate(p) if len(p) > 0 else np.empty(0) for p in per_zone[1:]]
+    return count[1:], total[1:], total_sq[1:], v_min[1:], v_max[1:], per_zone
+
+
+def stats_table(count, total, total_sq, v_min, v_max, per_zone, percentiles):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        std = np.sqrt(np.maximum(total_sq / count - mean * mean, 0))
+
+    empty = count == 0
+    table = pd.DataFrame({'count': count, 'mean': mean, 'std': std,
+                          'min': np.where(empty, np.nan, v_min), 'max': np.where(empty, np.nan, v_max)})
+
+    if percentiles is not None:
+        for q in percentiles:
+            table['p{0:g}'.format(q)] = [np.nanpercentile(v, q) if c > 0 else np.nan for v, c in zip(per_zone, count)]
+    return table
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
@@ -0,0 +1,147 @@
+# Module to break polygons (e.g. woodland / riparian vegetation) up into zones on a regular square grid. The grid is
+# built in one vectorised call, the polygons are intersected with all grid cells in one spatially indexed overlay and
+# the pieces are dissolved per cell with a group-by. Large areas are split into chunks of grid cells which are
+# processed in parallel worker processes. sign_zones splits zones into those that do / do not hold buffered points
+# (e.g. beaver feeding signs); the result is cached on the input files and buffer distance.
+
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from sfm_gridz import zonal_stats
+
+CHUNK_CELLS = 20000  # grid cells per parallel chunk
+MAX_CACHED = 8  # sign zone results kept in memory
+
+_sign_zone_cache = OrderedDict()
+
+
+def tile_zones(polygons, cell_size=20, n_workers=None, chunk_cells=CHUNK_CELLS, grid_out=None, zones_out=None):
+    """Break the polygons up into zones on a grid of cell_size (map units) square cells.
+
+    polygons - file path or GeoDataFrame. Returns (zones, grid) GeoDataFrames - grid is every cell of the grid
+    covering the polygons, zones holds one (multi)polygon per grid cell that holds part of the polygons with the
+    attributes of the first polygon in that cell. Written to GeoPackage if grid_out / zones_out are given.
+    """
+    poly_gdf = polygons if isinstance(polygons, gpd.GeoDataFrame) else gpd.read_file(polygons)
+    if len(poly_gdf) == 0:
+        raise InputError("no polygons to break up into zones")
+
+    grid = grid_cells(poly_gdf.total_bounds, cell_size, poly_gdf.crs)
+    chunks = cell_chunks(grid, poly_gdf, chunk_cells)
+    print("breaking {0} polygons into {1} m zones - {2} grid cells in {3} chunk(s)".format(
+        len(poly_gdf), cell_size, len(grid), len(chunks)))
+
+    if n_workers == 1 or len(chunks) < 2:
+        parts = [dissolve_cells(cells, polys) for cells, polys in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            parts = list(pool.map(dissolve_cells, *zip(*chunks)))
+
+    parts = [p for p in parts if len(p) > 0]
+    if len(parts) > 0:
+        zones = pd.concat(parts).sort_index(kind='stable').reset_index(drop=True)
+        zones = gpd.GeoDataFrame(zones, geometry='geometry', crs=poly_gdf.crs)
+    else:
+        zones = gpd.GeoDataFrame(columns=poly_gdf.columns, geometry=poly_gdf.geometry.name, crs=poly_gdf.crs)
+
+    if grid_out is not None:
+        grid.to_file(grid_out, driver='GPKG')
+    if zones_out is not None:
+        zones.to_file(zones_out, driver='GPKG')
+
+    return zones, grid
+
+
+def grid_cells(bounds, cell_size, crs=None):
+    """GeoDataFrame of cell_size square cells covering bounds (xmin, ymin, xmax, ymax). Column origins run from
+    floor(xmin) and row tops from the last cell_size step below ceil(ymax) down to floor(ymin); cells are ordered by
+    column then row (top down)."""
+    xmin, ymin, xmax, ymax = bounds
+    xs = np.arange(int(np.floor(xmin)), int(np.ceil(xmax)), cell_size)
+    ys = np.arange(int(np.floor(ymin)), int(np.ceil(ymax)), cell_size)[::-1]
+
+    x, y = np.meshgrid(xs, ys, indexing='ij')
+    x = x.ravel().astype('float64')
+    y = y.ravel().astype('float64')
+    cells = shapely.box(x, y - cell_size, x + cell_size, y)
+
+    return gpd.GeoDataFrame(geometry=gpd.GeoSeries(cells), crs=crs)
+
+
+def cell_chunks(grid, poly_gdf, chunk_cells):
+    """Split the grid cells that intersect the polygons, in grid order, into chunks of at most chunk_cells cells,
+    each with the polygons that reach it (from the polygons' spatial index)"""
+    cell_idx, _ = poly_gdf.sindex.query(grid.geometry, predicate='intersects')
+    cell_idx = np.unique(cell_idx)
+
+    chunks = []
+    for start in range(0, len(cell_idx), chunk_cells):
+        cells = grid.iloc[cell_idx[start:start + chunk_cells]]
+        poly_idx = np.unique(poly_gdf.sindex.query(shapely.box(*cells.total_bounds), predicate='intersects'))
+        chunks.append((cells, poly_gdf.iloc[poly_idx]))
+    return chunks
+
+
+def dissolve_cells(cells, polys):
+    """Intersect the polygons with the cells in one overlay and dissolve the pieces of each cell - the result is
+    indexed by the cell's grid index"""
+    cells = gpd.GeoDataFrame({'_cell': cells.index.values}, geometry=cells.geometry.values, crs=cells.crs)
+    polys = polys.copy()
+    polys['_order'] = np.arange(len(polys))
+
+    pieces = gpd.overlay(polys, cells, how='intersection', keep_geom_type=True)
+    if len(pieces) == 0:
+        return pieces.drop(columns=['_cell', '_order'])
+
+    pieces = pieces.sort_values(['_cell', '_order'], kind='stable')
+    zones = pieces.dissolve(by='_cell', aggfunc='first')
+    zones.index.name = None
+    return zones.drop(columns=['_order'])
+
+
+def sign_zones(zones, signs, buffer_dist=10):
+    """Split zones into those within buffer_dist of a sign and the rest. zones / signs - file paths or GeoDataFrames.
+    Returns a GeoDataFrame of two rows with columns signs_YN (1 - union of the zones touched by a buffered sign,
+    0 - the remaining zone area) and geometry. Cached on the input files (path and modification time) and buffer_dist,
+    the returned frame is shared so should not be modified."""
+    key = (zonal_stats.zones_key(zones, zones), zonal_stats.zones_key(signs, signs), buffer_dist)
+
+    if key not in _sign_zone_cache:
+        z_gdf = zones if isinstance(zones, gpd.GeoDataFrame) else gpd.read_file(zones)
+        s_gdf = signs if isinstance(signs, gpd.GeoDataFrame) else gpd.read_file(signs)
+        if s_gdf.crs is not None and z_gdf.crs is not None and s_gdf.crs != z_gdf.crs:
+            s_gdf = s_gdf.to_crs(z_gdf.crs)
+
+        hit = np.zeros(len(z_gdf), dtype=bool)
+        zone_idx = z_gdf.sindex.query(s_gdf.geometry.buffer(buffer_dist), predicate='intersects')[1]
+        hit[zone_idx] = True
+
+        sign_zone = shapely.union_all(z_gdf.geometry.values[hit])
+        other_zone = shapely.difference(shapely.union_all(z_gdf.geometry.values[~hit]), sign_zone)
+
+        _sign_zone_cache[key] = gpd.GeoDataFrame({'signs_YN': [1, 0]}, geometry=[sign_zone, other_zone],
+                                                 crs=z_gdf.crs)
+        while len(_sign_zone_cache) > MAX_CACHED:
+            _sign_zone_cache.popitem(last=False)
+    _sign_zone_cache.move_to_end(key)
+
+    return _sign_zone_cache[key]
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message